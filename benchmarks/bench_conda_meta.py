@@ -0,0 +1,111 @@
+"""Compare reading a prefix's conda-meta directory against spawning `conda list --json`.
+
+A synthetic prefix is generated with the requested number of conda and pip packages.
+Usage:
+
+    python benchmarks/bench_conda_meta.py --conda-packages 300 --pip-packages 50
+
+"""
+
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from anaconda_pre_commit_hooks.conda_meta import read_conda_meta_packages
+
+
+def make_prefix(prefix: Path, n_conda: int, n_pip: int) -> None:
+    """Generate a synthetic conda prefix containing python plus n_conda and n_pip packages."""
+    conda_meta = prefix / "conda-meta"
+    conda_meta.mkdir(parents=True)
+    (conda_meta / "history").write_text("")
+    site_packages = prefix / "lib" / "python3.12" / "site-packages"
+    site_packages.mkdir(parents=True)
+
+    def write_record(name: str, version: str, build: str, files: list[str]) -> None:
+        record = {
+            "name": name,
+            "version": version,
+            "build": build,
+            "build_number": 0,
+            "channel": "https://repo.anaconda.com/pkgs/main/linux-64",
+            "subdir": "linux-64",
+            "depends": [],
+            "files": files,
+            "paths_data": {
+                "paths": [{"_path": f, "path_type": "hardlink"} for f in files],
+                "paths_version": 1,
+            },
+        }
+        (conda_meta / f"{name}-{version}-{build}.json").write_text(json.dumps(record))
+
+    write_record("python", "3.12.4", "h0", ["bin/python3.12"])
+    for i in range(n_conda):
+        name = f"conda-package-{i}"
+        dist_info = f"conda_package_{i}-1.{i}.0.dist-info"
+        files = [
+            f"lib/python3.12/site-packages/{dist_info}/{f}"
+            for f in ("METADATA", "RECORD")
+        ]
+        files += [
+            f"lib/python3.12/site-packages/conda_package_{i}/mod{j}.py"
+            for j in range(20)
+        ]
+        write_record(name, f"1.{i}.0", "py312_0", files)
+        (site_packages / dist_info).mkdir()
+        (site_packages / dist_info / "RECORD").write_text("")
+    for i in range(n_pip):
+        dist_info = site_packages / f"pip_package_{i}-2.{i}.0.dist-info"
+        dist_info.mkdir()
+        (dist_info / "RECORD").write_text("")
+        (dist_info / "METADATA").write_text(
+            f"Metadata-Version: 2.1\nName: pip_package_{i}\nVersion: 2.{i}.0\n\nDescription\n"
+        )
+
+
+def best_of(repeat: int, func: Callable[[], Any]) -> float:
+    """Return the fastest wall time, in seconds, of several calls to func."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conda-packages", type=int, default=300)
+    parser.add_argument("--pip-packages", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix = Path(tmp_dir) / "env"
+        make_prefix(prefix, args.conda_packages, args.pip_packages)
+        n_packages = len(read_conda_meta_packages(prefix) or [])
+        print(f"Synthetic prefix with {n_packages} packages")
+
+        fast = best_of(args.repeat, lambda: read_conda_meta_packages(prefix))
+        print(f"read_conda_meta_packages: {fast * 1000:8.1f} ms")
+
+        conda = shutil.which("conda")
+        if conda is None:
+            print("conda not found on PATH, skipping comparison with `conda list`")
+            return
+        cmd = [conda, "list", "-p", str(prefix), "--json"]
+        slow = best_of(
+            args.repeat, lambda: subprocess.run(cmd, capture_output=True, check=True)
+        )
+        print(f"conda list --json:        {slow * 1000:8.1f} ms")
+        print(f"Speedup:                  {slow / fast:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+"""Time all hooks end-to-end and per stage on a synthetic monorepo.
+
+The monorepo contains N project directories, each with M environment files listing K
+dependencies, plus cog and mjml files. `conda`, `make`, `cog` and `mjml` are replaced by fake
+stand-ins with a configurable latency, so that the results measure the overhead of the hooks
+themselves. Usage:
+
+    python benchmarks/bench_hooks.py --projects 10 --env-files 2 --dependencies 50 \\
+        --tool-latency 0.1 --output results.json
+
+The results are written as JSON, so they can be compared across releases.
+
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime, timezone
+from importlib.metadata import version
+from pathlib import Path
+from typing import Any, Optional
+
+from anaconda_pre_commit_hooks.add_renovate_annotations import (
+    DEFAULT_CREATE_COMMAND,
+    DEFAULT_ENVIRONMENT_SELECTOR,
+    add_comments_to_env_file,
+    list_packages_in_conda_environment,
+    parse_dependencies,
+    setup_conda_environment,
+)
+from anaconda_pre_commit_hooks.run_cog import group_by_working_directory, run_cog
+
+MJML_HOOK = Path(__file__).resolve().parent.parent / "bin" / "mjml_hook.js"
+
+# Each fake tool sleeps for $FAKE_<TOOL>_LATENCY seconds before doing its (minimal) job
+FAKE_TOOLS = {
+    "make": """\
+time.sleep(float(os.environ.get("FAKE_MAKE_LATENCY", 0)))
+""",
+    "conda": """\
+time.sleep(float(os.environ.get("FAKE_CONDA_LATENCY", 0)))
+n = int(os.environ["FAKE_CONDA_PACKAGES"])
+packages = [
+    {"name": f"package-{i}", "version": f"1.{i}.0",
+     "channel": "pypi" if i % 2 else "conda-forge"}
+    for i in range(n)
+]
+print(json.dumps(packages))
+""",
+    "cog": """\
+time.sleep(float(os.environ.get("FAKE_COG_LATENCY", 0)))
+from cogapp import main
+sys.exit(main())
+""",
+    "mjml": """\
+time.sleep(float(os.environ.get("FAKE_MJML_LATENCY", 0)))
+output = sys.argv[sys.argv.index("-o") + 1]
+with open(output, "w") as fp:
+    fp.write("<html></html>\\n")
+""",
+}
+
+COG_FILE = """\
+<!-- [[[cog
+import cog
+cog.outl("generated")
+]]] -->
+<!-- [[[end]]] -->
+"""
+
+MJML_FILE = """\
+<mjml><mj-body><mj-text>Email</mj-text></mj-body></mjml>
+"""
+
+
+def make_fake_tools(bin_dir: Path) -> None:
+    """Write the fake command-line tools into bin_dir."""
+    bin_dir.mkdir(parents=True)
+    for name, body in FAKE_TOOLS.items():
+        path = bin_dir / name
+        path.write_text(f"#!{sys.executable}\nimport json, os, sys, time\n{body}")
+        path.chmod(0o755)
+
+
+def environment_file(n_dependencies: int) -> str:
+    """Generate an environment file listing the packages the fake conda reports."""
+    conda = [f"- package-{i}" for i in range(0, n_dependencies, 2)]
+    pip = [f"  - package-{i}" for i in range(1, n_dependencies, 2)]
+    return "\n".join(["dependencies:", *conda, "- pip:", *pip]) + "\n"
+
+
+def make_monorepo(
+    root: Path, n_projects: int, n_env_files: int, n_dependencies: int
+) -> dict[str, list[Path]]:
+    """Generate the project directories, and return the files to pass to each hook."""
+    files: dict[str, list[Path]] = defaultdict(list)
+    for i in range(n_projects):
+        project = root / f"project-{i}"
+        project.mkdir(parents=True)
+        (project / "Makefile").write_text("setup:\n")
+        for j in range(n_env_files):
+            env_file = project / (
+                "environment.yml" if j == 0 else f"environment-{j}.yml"
+            )
+            env_file.write_text(environment_file(n_dependencies))
+            files["env"].append(env_file)
+    return files
+
+
+def make_templated_files(
+    root: Path, n_projects: int, n_cog_files: int, n_mjml_files: int
+) -> dict[str, list[Path]]:
+    """Generate cog files spread across the projects, and mjml templates."""
+    files: dict[str, list[Path]] = defaultdict(list)
+    for i in range(n_cog_files):
+        path = root / f"project-{i % n_projects}" / "docs" / f"page-{i}.md"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(COG_FILE)
+        files["cog"].append(path)
+    for i in range(n_mjml_files):
+        path = root / "emails" / f"email-{i}.mjml"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(MJML_FILE)
+        files["mjml"].append(path)
+    return files
+
+
+class Timings:
+    """Accumulate the wall time of each stage, keeping the fastest of several repeats."""
+
+    def __init__(self) -> None:
+        self.best: dict[str, float] = {}
+        self._current: dict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[name] += time.perf_counter() - start
+
+    def end_repeat(self) -> None:
+        for name, elapsed in self._current.items():
+            self.best[name] = min(elapsed, self.best.get(name, elapsed))
+        self._current.clear()
+
+
+def restore(paths: list[Path]) -> Callable[[], None]:
+    """Return a function which restores the given files to their current contents."""
+    contents = {p: p.read_text() for p in paths}
+
+    def _restore() -> None:
+        for path, text in contents.items():
+            path.write_text(text)
+
+    return _restore
+
+
+def run_command(cmd: list[str]) -> None:
+    subprocess.run(cmd, capture_output=True, text=True, check=True)
+
+
+def bench_renovate(
+    env_files: list[Path], repeat: int, reset: Callable[[], None]
+) -> dict[str, Any]:
+    end_to_end = Timings()
+    cmd = [
+        sys.executable,
+        "-c",
+        "from anaconda_pre_commit_hooks.add_renovate_annotations import app; app()",
+        *map(str, env_files),
+    ]
+    for _ in range(repeat):
+        reset()
+        with end_to_end.stage("end_to_end"):
+            run_command(cmd)
+        end_to_end.end_repeat()
+
+    stages = Timings()
+    project_dirs = sorted({p.parent for p in env_files})
+    for _ in range(repeat):
+        reset()
+        for project_dir in project_dirs:
+            with stages.stage("setup_conda_environment"):
+                setup_conda_environment(DEFAULT_CREATE_COMMAND, cwd=project_dir)
+            with stages.stage("list_packages_in_conda_environment"):
+                data = list_packages_in_conda_environment(
+                    DEFAULT_ENVIRONMENT_SELECTOR, cwd=project_dir
+                )
+            with stages.stage("parse_dependencies"):
+                dependencies = parse_dependencies(data)
+            with stages.stage("add_comments_to_env_file"):
+                for env_file in env_files:
+                    if env_file.parent == project_dir:
+                        add_comments_to_env_file(env_file, dependencies)
+        stages.end_repeat()
+    return {"end_to_end": end_to_end.best["end_to_end"], "stages": stages.best}
+
+
+def bench_run_cog(
+    cog_files: list[Path], repeat: int, reset: Callable[[], None]
+) -> dict[str, Any]:
+    filenames = [str(p) for p in cog_files]
+    end_to_end = Timings()
+    cmd = [
+        sys.executable,
+        "-m",
+        "anaconda_pre_commit_hooks.run_cog",
+        "--working-directory-level",
+        "-1",
+        *filenames,
+    ]
+    for _ in range(repeat):
+        reset()
+        with end_to_end.stage("end_to_end"):
+            run_command(cmd)
+        end_to_end.end_repeat()
+
+    stages = Timings()
+    for _ in range(repeat):
+        reset()
+        with stages.stage("group_by_working_directory"):
+            group_by_working_directory(filenames, -1)
+        # Keep cog's progress output out of the results
+        with redirect_stdout(io.StringIO()):
+            with stages.stage("run_cog"):
+                run_cog(filenames, -1)
+            reset()
+            with stages.stage("run_cog_in_process"):
+                run_cog(filenames, -1, in_process=True)
+        stages.end_repeat()
+    return {"end_to_end": end_to_end.best["end_to_end"], "stages": stages.best}
+
+
+def bench_mjml(mjml_files: list[Path], repeat: int) -> Optional[dict[str, Any]]:
+    node = shutil.which("node")
+    if node is None:
+        return None
+
+    filenames = [str(p) for p in mjml_files]
+    timings = Timings()
+    for _ in range(repeat):
+        with timings.stage("render"):
+            run_command([node, str(MJML_HOOK), "--force", *filenames])
+        with timings.stage("skip_up_to_date"):
+            run_command([node, str(MJML_HOOK), *filenames])
+        timings.end_repeat()
+    return {"end_to_end": timings.best["render"], "stages": timings.best}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--projects", type=int, default=10, help="N project dirs")
+    parser.add_argument("--env-files", type=int, default=2, help="M files per project")
+    parser.add_argument(
+        "--dependencies", type=int, default=50, help="K dependencies per file"
+    )
+    parser.add_argument("--cog-files", type=int, default=20)
+    parser.add_argument("--mjml-files", type=int, default=20)
+    parser.add_argument(
+        "--tool-latency",
+        type=float,
+        default=0.0,
+        help="Latency of each fake tool, in seconds, unless overridden below",
+    )
+    for tool in FAKE_TOOLS:
+        parser.add_argument(f"--{tool}-latency", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="Write the JSON results here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir) / "monorepo"
+        make_fake_tools(Path(tmp_dir) / "bin")
+        os.environ["PATH"] = f"{Path(tmp_dir) / 'bin'}{os.pathsep}{os.environ['PATH']}"
+        os.environ["FAKE_CONDA_PACKAGES"] = str(args.dependencies)
+        for tool in FAKE_TOOLS:
+            latency = getattr(args, f"{tool}_latency")
+            os.environ[f"FAKE_{tool.upper()}_LATENCY"] = str(
+                args.tool_latency if latency is None else latency
+            )
+
+        files = make_monorepo(root, args.projects, args.env_files, args.dependencies)
+        files.update(
+            make_templated_files(root, args.projects, args.cog_files, args.mjml_files)
+        )
+
+        results = {
+            "generate-renovate-annotations": bench_renovate(
+                files["env"], args.repeat, restore(files["env"])
+            ),
+            "run-cog": bench_run_cog(files["cog"], args.repeat, restore(files["cog"])),
+            "mjml": bench_mjml(files["mjml"], args.repeat),
+        }
+
+    report = {
+        "version": version("anaconda-pre-commit-hooks"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is not None:
+        args.output.write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Compare rendering MJML templates in a subprocess per template against in-process rendering.
+
+Both modes need mjml to be installed, e.g. with `npm install --no-save mjml@4.12.0` in the
+root of the repository. Usage:
+
+    python benchmarks/bench_mjml_hook.py --templates 200
+
+"""
+
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+HOOK = Path(__file__).resolve().parent.parent / "bin" / "mjml_hook.js"
+
+TEMPLATE = """\
+<mjml>
+  <mj-body>
+    <mj-include path="./partials/header.mjml" />
+    <mj-section>
+      <mj-column>
+        <mj-text>Email template number {i}</mj-text>
+        <mj-button href="https://example.com/{i}">Open</mj-button>
+      </mj-column>
+    </mj-section>
+  </mj-body>
+</mjml>
+"""
+
+HEADER = """\
+<mj-section>
+  <mj-column>
+    <mj-text font-size="20px">Header</mj-text>
+  </mj-column>
+</mj-section>
+"""
+
+
+def make_templates(directory: Path, n_templates: int) -> list[str]:
+    """Generate n_templates templates, all including a shared partial."""
+    (directory / "partials").mkdir(parents=True)
+    (directory / "partials" / "header.mjml").write_text(HEADER)
+    templates = []
+    for i in range(n_templates):
+        path = directory / f"template-{i}.mjml"
+        path.write_text(TEMPLATE.format(i=i))
+        templates.append(str(path))
+    return templates
+
+
+def best_of(repeat: int, func: Callable[[], Any]) -> float:
+    """Return the fastest wall time, in seconds, of several calls to func."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--templates", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    node = shutil.which("node")
+    if node is None or shutil.which("mjml") is None:
+        print("node and mjml must be on PATH to run this benchmark")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        templates = make_templates(Path(tmp_dir), args.templates)
+        print(f"Rendering {len(templates)} templates")
+
+        def run_hook(*options: str) -> str:
+            cmd = [node, str(HOOK), "--force", *options, *templates]
+            return subprocess.run(
+                cmd, capture_output=True, check=True, text=True
+            ).stdout
+
+        if "Could not import mjml" in run_hook("--in-process"):
+            print("The mjml library could not be imported by the hook")
+            return
+
+        spawn = best_of(args.repeat, run_hook)
+        print(f"subprocess per template: {spawn:8.2f} s")
+        in_process = best_of(args.repeat, lambda: run_hook("--in-process"))
+        print(f"--in-process:            {in_process:8.2f} s")
+        print(f"Speedup:                 {spawn / in_process:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
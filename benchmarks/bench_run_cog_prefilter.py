@@ -0,0 +1,90 @@
+"""Compare run-cog with and without the cog marker prefilter on a tree of many files.
+
+A synthetic tree is generated with the requested number of files, of which only a small
+fraction contain cog markers, as is typical when the hook is run with `--all-files`. The
+prefilter is also timed on its own, and compared with reading each file into memory. Usage:
+
+    python benchmarks/bench_run_cog_prefilter.py --files 5000 --cog-fraction 0.01
+
+"""
+
+import argparse
+import io
+import tempfile
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from anaconda_pre_commit_hooks.run_cog import DEFAULT_MARKERS, filter_cog_files, run_cog
+
+COG_FILE = """\
+<!-- [[[cog
+import cog
+cog.outl("generated")
+]]] -->
+<!-- [[[end]]] -->
+"""
+
+PLAIN_FILE = "Some documentation without any generated content.\n" * 200
+
+
+def make_tree(root: Path, n_files: int, cog_fraction: float) -> list[str]:
+    """Write the files, spread over directories of 100, returning their paths."""
+    cog_every = max(1, round(1 / cog_fraction)) if cog_fraction > 0 else 0
+    filenames = []
+    for i in range(n_files):
+        path = root / f"dir-{i // 100}" / f"file-{i}.md"
+        path.parent.mkdir(exist_ok=True)
+        is_cog_file = cog_every and i % cog_every == 0
+        path.write_text(COG_FILE if is_cog_file else PLAIN_FILE)
+        filenames.append(path.as_posix())
+    return filenames
+
+
+def filter_by_reading(filenames: list[str], markers: str) -> list[str]:
+    """The naive alternative to the prefilter, which reads every file into memory."""
+    marker_bytes = [marker.encode() for marker in markers.split()]
+    filtered = []
+    for f in filenames:
+        content = Path(f).read_bytes()
+        if any(marker in content for marker in marker_bytes):
+            filtered.append(f)
+    return filtered
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--cog-fraction", type=float, default=0.01)
+    parser.add_argument("--in-process", action="store_true", help="Run cog in-process.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = Path(tmp_dir)
+        filenames = make_tree(root, args.files, args.cog_fraction)
+        n_cog_files = len(filter_cog_files(filenames, DEFAULT_MARKERS))
+        print(f"{len(filenames)} files, of which {n_cog_files} contain cog markers")
+
+        for name, scan in [
+            ("mmap prefilter", filter_cog_files),
+            ("read_bytes", filter_by_reading),
+        ]:
+            start = time.perf_counter()
+            assert len(scan(filenames, DEFAULT_MARKERS)) == n_cog_files
+            elapsed = time.perf_counter() - start
+            print(f"{name:20s} {elapsed * 1000:10.1f} ms")
+
+        for prefilter in [True, False]:
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                return_code = run_cog(
+                    filenames, 1, in_process=args.in_process, prefilter=prefilter
+                )
+            elapsed = time.perf_counter() - start
+            assert return_code == 0
+            name = "run-cog" + ("" if prefilter else " (no prefilter)")
+            print(f"{name:20s} {elapsed * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
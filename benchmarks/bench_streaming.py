@@ -0,0 +1,101 @@
+"""Compare the in-memory and streaming engines of add_comments_to_env_file on a large file.
+
+A synthetic environment file is generated with the requested number of conda and pip
+dependencies, all of which are installed. Usage:
+
+    python benchmarks/bench_streaming.py --dependencies 20000
+
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from anaconda_pre_commit_hooks.add_renovate_annotations import (
+    Dependencies,
+    Dependency,
+    add_comments_to_env_file,
+)
+
+
+def make_environment(path: Path, n_dependencies: int) -> Dependencies:
+    """Write an environment file, returning the dependencies installed in its environment."""
+    n_conda = n_dependencies // 2
+    lines = ["name: aggregated\n", "channels:\n", "- defaults\n", "dependencies:\n"]
+    lines += [f"- conda-package-{i}\n" for i in range(n_conda)]
+    lines += ["- pip:\n"]
+    lines += [f"  - pip-package-{i}\n" for i in range(n_dependencies - n_conda)]
+    path.write_text("".join(lines))
+
+    conda = {
+        f"conda-package-{i}": Dependency(
+            name=f"conda-package-{i}", channel="conda-forge", version=f"1.{i}.0"
+        )
+        for i in range(n_conda)
+    }
+    pip = {
+        f"pip-package-{i}": Dependency(
+            name=f"pip-package-{i}", channel="pypi", version=f"2.{i}.0"
+        )
+        for i in range(n_dependencies - n_conda)
+    }
+    return Dependencies(pip=pip, conda=conda)
+
+
+def measure(
+    original: Path, env_file: Path, dependencies: Dependencies, streaming: bool
+) -> dict[str, tuple[float, float]]:
+    """Measure the wall time and the peak memory of annotating and then re-checking a file."""
+    results = {}
+    for stage in ["annotate", "unchanged"]:
+        # The wall time is measured separately, since tracemalloc slows everything down
+        if stage == "annotate":
+            shutil.copy(original, env_file)
+        snapshot = env_file.read_bytes()
+        start = time.perf_counter()
+        add_comments_to_env_file(env_file, dependencies, streaming=streaming)
+        elapsed = time.perf_counter() - start
+
+        env_file.write_bytes(snapshot)
+        tracemalloc.start()
+        add_comments_to_env_file(env_file, dependencies, streaming=streaming)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[stage] = (elapsed, peak)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dependencies", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        original = Path(tmp_dir) / "original.yml"
+        dependencies = make_environment(original, args.dependencies)
+        size_mb = original.stat().st_size / 1024 / 1024
+        print(
+            f"Environment file with {args.dependencies} dependencies ({size_mb:.1f} MB)"
+        )
+
+        outputs = []
+        for streaming in [False, True]:
+            env_file = Path(tmp_dir) / f"environment-{streaming}.yml"
+            results = measure(original, env_file, dependencies, streaming)
+            name = "streaming" if streaming else "in-memory"
+            # Annotating records a change for every dependency, which dominates the memory
+            for stage, (elapsed, peak) in results.items():
+                print(
+                    f"{name:10s} {stage:10s} {elapsed * 1000:8.1f} ms,"
+                    f" peak memory {peak / 1024 / 1024:6.2f} MB"
+                )
+            outputs.append(env_file.read_bytes())
+
+        print("Outputs identical:", outputs[0] == outputs[1])
+
+
+if __name__ == "__main__":
+    main()
@@ -4,33 +4,279 @@
 // For each one, it replaces the extension from .mjml -> .html
 // and then runs `mjml filename.mjml -o filename.html` in a
 // subprocess.
+//
+// At most `--concurrency` (default: the number of CPUs) templates are
+// rendered at once. Templates whose HTML output is newer than the template
+// and all of its `mj-include`d partials are skipped, unless `--force` is
+// passed. The output of each render is printed once it completes, and the
+// exit code is non-zero if any render fails.
+//
+// With `--in-process`, the `mjml` library is imported once and every template
+// is rendered in this process, avoiding the startup cost of a subprocess per
+// template. Any `--config.<option> <value>` arguments are passed through to
+// mjml in both modes.
 
 import {spawn} from 'child_process';
+import {readFileSync, statSync, writeFileSync} from 'fs';
+import {cpus} from 'os';
+import {dirname, extname, resolve} from 'path';
 
+const INCLUDE_RE = /<mj-include\s[^>]*?path\s*=\s*["']([^"']+)["'][^>]*>/g;
 
-// The first two arguments are node and then mjml_hook
-const templates = process.argv.slice(2);
+// The defaults of the mjml CLI, so both modes render identical HTML
+const DEFAULT_MJML_OPTIONS = {
+  beautify: true,
+  minify: false,
+  validationLevel: 'soft',
+};
 
-for (const template of templates) {
-  const output = template.replace('.mjml', '.html');
-  console.log('Rendering', template, '->', output);
 
-  // https://stackoverflow.com/a/16099450
-  const prc = spawn('mjml', ['-o', output, template]);
+/**
+ * Parse the command-line arguments.
+ * @param {string[]} argv The arguments after node and mjml_hook.
+ * @return {{templates: string[], concurrency: number, force: boolean,
+ *   inProcess: boolean, config: Object<string, string>}}
+ */
+function parseArgs(argv) {
+  const options = {
+    templates: [],
+    concurrency: cpus().length,
+    force: false,
+    inProcess: false,
+    config: {},
+  };
+  for (let i = 0; i < argv.length; i++) {
+    const arg = argv[i];
+    if (arg === '--force') {
+      options.force = true;
+    } else if (arg === '--in-process') {
+      options.inProcess = true;
+    } else if (arg === '--concurrency') {
+      options.concurrency = parseInt(argv[++i], 10);
+    } else if (arg.startsWith('--concurrency=')) {
+      options.concurrency = parseInt(arg.split('=')[1], 10);
+    } else if (arg.startsWith('--config.')) {
+      const [key, ...value] = arg.slice('--config.'.length).split('=');
+      options.config[key] = value.length ? value.join('=') : argv[++i];
+    } else {
+      options.templates.push(arg);
+    }
+  }
+  if (!(options.concurrency >= 1)) {
+    options.concurrency = 1;
+  }
+  return options;
+}
 
-  // Capture stdout
-  let lines = [];
-  prc.stdout.setEncoding('utf8');
-  prc.stdout.on('data', function(data) {
-    const str = data.toString();
-    lines = str.split(/(\r?\n)/g);
-  });
 
-  // Log to console if any non-zero error codes
-  prc.on('close', function(code) {
-    if (code !== 0) {
-      console.log('process exit code ' + code);
-      console.log(lines.join(''));
+/**
+ * Convert a command-line config value to the type mjml expects.
+ * @param {string} value The value as passed on the command line.
+ * @return {*}
+ */
+function parseConfigValue(value) {
+  if (value === 'true' || value === 'false') {
+    return value === 'true';
+  }
+  if (value !== '' && !isNaN(Number(value))) {
+    return Number(value);
+  }
+  return value;
+}
+
+
+/**
+ * Find a template and all the partials it includes, recursively.
+ * @param {string} file The path to the template.
+ * @param {Set<string>} seen The files already found, to guard against cycles.
+ * @return {Set<string>} The resolved paths of the template and its partials.
+ */
+function findDependencies(file, seen = new Set()) {
+  const path = resolve(file);
+  if (seen.has(path)) {
+    return seen;
+  }
+  seen.add(path);
+
+  let contents;
+  try {
+    contents = readFileSync(path, 'utf8');
+  } catch (err) {
+    // A missing partial is reported by mjml itself
+    return seen;
+  }
+  if (extname(path) !== '.mjml') {
+    return seen;
+  }
+  for (const match of contents.matchAll(INCLUDE_RE)) {
+    let include = resolve(dirname(path), match[1]);
+    if (!extname(include)) {
+      include += '.mjml';
     }
+    findDependencies(include, seen);
+  }
+  return seen;
+}
+
+
+/**
+ * Check whether the output is newer than the template and all its partials.
+ * @param {string} template The path to the template.
+ * @param {string} output The path to the rendered HTML.
+ * @return {boolean}
+ */
+function isUpToDate(template, output) {
+  let outputTime;
+  try {
+    outputTime = statSync(output).mtimeMs;
+  } catch (err) {
+    return false;
+  }
+  for (const dependency of findDependencies(template)) {
+    try {
+      if (statSync(dependency).mtimeMs >= outputTime) {
+        return false;
+      }
+    } catch (err) {
+      return false;
+    }
+  }
+  return true;
+}
+
+
+/**
+ * Render a single template in an mjml subprocess, buffering all its output.
+ * @param {string} template The path to the template.
+ * @param {string} output The path to the rendered HTML.
+ * @param {Object<string, string>} config Options passed through to mjml.
+ * @return {Promise<{code: number, output: string}>}
+ */
+function render(template, output, config) {
+  return new Promise(function(resolvePromise) {
+    const configArgs = Object.entries(config).map(
+        ([key, value]) => `--config.${key}=${value}`);
+    // https://stackoverflow.com/a/16099450
+    const prc = spawn('mjml', [...configArgs, '-o', output, template]);
+
+    const chunks = [];
+    prc.stdout.setEncoding('utf8');
+    prc.stderr.setEncoding('utf8');
+    prc.stdout.on('data', (data) => chunks.push(data));
+    prc.stderr.on('data', (data) => chunks.push(data));
+
+    prc.on('error', function(err) {
+      chunks.push(err.message + '\n');
+    });
+    prc.on('close', function(code) {
+      resolvePromise({code: code === null ? 1 : code, output: chunks.join('')});
+    });
   });
 }
+
+
+/**
+ * Render a single template with the already imported mjml library.
+ * @param {function(string, Object): Object} mjml2html The mjml render function.
+ * @param {string} template The path to the template.
+ * @param {string} output The path to the rendered HTML.
+ * @param {Object<string, string>} config Options passed through to mjml.
+ * @return {Promise<{code: number, output: string}>}
+ */
+async function renderInProcess(mjml2html, template, output, config) {
+  const options = {...DEFAULT_MJML_OPTIONS, filePath: template};
+  for (const [key, value] of Object.entries(config)) {
+    options[key] = parseConfigValue(value);
+  }
+  try {
+    // mjml 4 renders synchronously, while later versions return a promise
+    const result = await mjml2html(readFileSync(template, 'utf8'), options);
+    writeFileSync(output, result.html);
+    const warnings = (result.errors || []).map(
+        (error) => error.formattedMessage || error.message);
+    return {code: 0, output: warnings.map((line) => line + '\n').join('')};
+  } catch (err) {
+    return {code: 1, output: err.message + '\n'};
+  }
+}
+
+
+/**
+ * Import the mjml library, if it is installed.
+ * @return {Promise<?function(string, Object): Object>} The render function.
+ */
+async function importMjml() {
+  try {
+    const module = await import('mjml');
+    return module.default;
+  } catch (err) {
+    console.log('Could not import mjml, falling back to subprocesses:',
+        err.message);
+    return null;
+  }
+}
+
+
+/**
+ * Run tasks with at most `concurrency` running at once.
+ * @param {Array<function(): Promise<*>>} tasks The tasks to run.
+ * @param {number} concurrency The maximum number of tasks to run at once.
+ * @return {Promise<Array<*>>} The results, in the same order as the tasks.
+ */
+async function runPool(tasks, concurrency) {
+  const results = new Array(tasks.length);
+  let next = 0;
+  const worker = async function() {
+    while (next < tasks.length) {
+      const index = next++;
+      results[index] = await tasks[index]();
+    }
+  };
+  const workers = [];
+  for (let i = 0; i < Math.min(concurrency, tasks.length); i++) {
+    workers.push(worker());
+  }
+  await Promise.all(workers);
+  return results;
+}
+
+
+/**
+ * Render all templates passed on the command line.
+ */
+async function main() {
+  // The first two arguments are node and then mjml_hook
+  const options = parseArgs(process.argv.slice(2));
+  const mjml2html = options.inProcess ? await importMjml() : null;
+
+  const tasks = [];
+  for (const template of options.templates) {
+    const output = template.replace('.mjml', '.html');
+    if (!options.force && isUpToDate(template, output)) {
+      console.log('Skipping', template, '(up to date)');
+      continue;
+    }
+    tasks.push(async function() {
+      const result = mjml2html ?
+        await renderInProcess(mjml2html, template, output, options.config) :
+        await render(template, output, options.config);
+      console.log('Rendering', template, '->', output);
+      if (result.code !== 0) {
+        console.log('process exit code ' + result.code);
+      }
+      if (result.output) {
+        process.stdout.write(result.output);
+      }
+      return result.code;
+    });
+  }
+
+  const codes = await runPool(tasks, options.concurrency);
+  const failures = codes.filter((code) => code !== 0).length;
+  if (failures > 0) {
+    console.log(failures + ' template(s) failed to render');
+    process.exitCode = 1;
+  }
+}
+
+main();
@@ -1,7 +1,25 @@
+"""Embed the output of a command into a file via cog, e.g. the `--help` output of a CLI.
+
+The same command is often embedded in many blocks and files, so its output is memoized for the
+lifetime of the process, and optionally on disk (in `$GENERATE_CLI_OUTPUT_CACHE_DIR`) across
+runs. Entries are keyed by the command, the working directory, the terminal width, and a
+fingerprint of the executable: its path and modification time and, for Python console scripts,
+the version and source files of the package providing it. Set `GENERATE_CLI_OUTPUT_REFRESH=1`
+to ignore, and overwrite, the output memoized on disk, or call `clear_cache`.
+
+"""
+
+import hashlib
+import json
+import os
 import shlex
+import shutil
 import subprocess
-
-import cog
+from functools import lru_cache
+from importlib.metadata import distributions
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Optional
 
 OUTPUT_STR_FORMAT = """\
 ```{language}
@@ -9,10 +27,105 @@ OUTPUT_STR_FORMAT = """\
 ```\
 """
 
+CACHE_DIR_ENV_VAR = "GENERATE_CLI_OUTPUT_CACHE_DIR"
+REFRESH_ENV_VAR = "GENERATE_CLI_OUTPUT_REFRESH"
+
+# The output of each command run by this process, keyed by `command_key`
+_memo: dict[str, str] = {}
+
+
+@lru_cache(maxsize=None)
+def executable_fingerprint(executable: str) -> str:
+    """Fingerprint an executable, so that memoized output is invalidated when it changes."""
+    parts: list[object] = [executable]
+    path = shutil.which(executable)
+    if path is not None:
+        stat = os.stat(path)
+        parts += [path, stat.st_mtime_ns, stat.st_size]
+
+    # For console scripts, the script itself rarely changes, unlike the package behind it.
+    # The entry points are found via their distributions, since `EntryPoint.dist` and
+    # `entry_points(group=...)` require Python 3.10.
+    for dist in distributions():
+        for entry_point in dist.entry_points:
+            if (
+                entry_point.group == "console_scripts"
+                and entry_point.name == executable
+            ):
+                parts += [dist.metadata["Name"], dist.version]
+                parts += _package_sources(entry_point.value)
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def _package_sources(entry_point_value: str) -> list[object]:
+    """Return the path, modification time and size of each source file of a package."""
+    parts: list[object] = []
+    module = entry_point_value.partition(":")[0].strip()
+    spec = find_spec(module.partition(".")[0])
+    if spec is not None and spec.submodule_search_locations:
+        for location in spec.submodule_search_locations:
+            for source in sorted(Path(location).rglob("*.py")):
+                stat = source.stat()
+                parts += [str(source), stat.st_mtime_ns, stat.st_size]
+    return parts
+
+
+def command_key(args: list[str], cwd: Path) -> str:
+    """Compute the key under which the output of a command is memoized."""
+    parts = [
+        args,
+        str(cwd.resolve()),
+        # The help output of rich-based CLIs is wrapped to the terminal width
+        os.environ.get("COLUMNS", ""),
+        executable_fingerprint(args[0]),
+    ]
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def _cache_dir() -> Optional[Path]:
+    cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+    return Path(cache_dir) if cache_dir else None
+
+
+def clear_cache() -> None:
+    """Forget all memoized output, both in this process and on disk."""
+    _memo.clear()
+    executable_fingerprint.cache_clear()
+    cache_dir = _cache_dir()
+    if cache_dir is not None:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def run_command(command: str) -> str:
+    """Run a command, or return its memoized output."""
+    args = shlex.split(command)
+    key = command_key(args, Path.cwd())
+    refresh = os.environ.get(REFRESH_ENV_VAR, "") not in ("", "0")
+    cache_dir = _cache_dir()
+    cache_file = cache_dir / key if cache_dir is not None else None
+
+    # Even when refreshing, identical blocks are rendered from a single execution
+    if key in _memo:
+        return _memo[key]
+    if not refresh and cache_file is not None and cache_file.is_file():
+        _memo[key] = cache_file.read_text()
+        return _memo[key]
+
+    raw_text = subprocess.check_output(args, text=True)
+    _memo[key] = raw_text
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(raw_text)
+        os.replace(tmp_file, cache_file)
+    return raw_text
+
 
 def main(command: str, language: str = "shell"):
     """Run a command in a subprocess and send the resulting output to cog's output, wrapped in a shell code block."""
-    raw_text = subprocess.check_output(shlex.split(command), text=True)
+    import cog
+
+    raw_text = run_command(command)
     output = OUTPUT_STR_FORMAT.format(language=language, text=raw_text.strip())
     for line in output.splitlines():
         cog.outl(line.rstrip())
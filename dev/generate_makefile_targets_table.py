@@ -1,9 +1,40 @@
+"""Generate a Markdown table of the targets in the Makefile, from their `##` help comments.
+
+The help comments are read directly from the Makefile and any files it includes, in the same
+way as the `help` target of the Makefile, without running `make`. The result is cached on disk,
+keyed by the path of the Makefile and validated against the modification time (or failing
+that, the hash) of each file read, so that regenerating the README is free while the Makefile
+is unchanged. The cache lives in `$GENERATE_MAKEFILE_TARGETS_CACHE_DIR`, defaulting to
+`~/.cache`; set it to an empty string to disable the cache. Failing to write the cache, e.g.
+to a read-only home directory, is not an error.
+
+If an include can't be resolved without make, e.g. because its path contains variables, the
+targets are listed by running `make` instead.
+
+"""
+
+import glob
+import hashlib
+import json
+import os
 import re
+import shlex
 import subprocess
+import tempfile
+from collections.abc import Callable
+from pathlib import Path
 from textwrap import dedent
-from typing import NamedTuple
+from typing import NamedTuple, Optional
+
+# The makefiles which make looks for, in order of precedence
+MAKEFILE_NAMES = ("GNUmakefile", "makefile", "Makefile")
+
+INCLUDE_RE = re.compile(r"^\s*(-?include|sinclude)\s+(.*)$")
 
-import cog
+# Bumped whenever the parsing changes, so that stale cache entries are ignored
+CACHE_VERSION = 1
+
+CACHE_DIR_ENV_VAR = "GENERATE_MAKEFILE_TARGETS_CACHE_DIR"
 
 
 class MakefileTarget(NamedTuple):
@@ -11,41 +42,214 @@ class MakefileTarget(NamedTuple):
     description: str
 
 
-def main():
-    raw_text = dedent(subprocess.check_output("make", text=True))
+class UnresolvableInclude(Exception):
+    """An include directive which can only be resolved by make itself."""
+
+
+def find_makefile(directory: Path) -> Path:
+    """Find the makefile that make would read in a directory."""
+    for name in MAKEFILE_NAMES:
+        if (directory / name).is_file():
+            return directory / name
+    raise FileNotFoundError(f"No makefile found in {directory}")
+
+
+def makefile_list(makefile: Path) -> list[Path]:
+    """Return the makefiles read by make, in order, i.e. the value of `$(MAKEFILE_LIST)`.
+
+    Included paths are relative to the directory of the main makefile, in which make runs.
 
+    """
+    directory = makefile.parent
+    paths: list[Path] = []
+
+    def read(path: Path) -> None:
+        paths.append(path)
+        for line in path.read_text().splitlines():
+            m = INCLUDE_RE.match(line)
+            if m is None:
+                continue
+            directive, args = m.groups()
+            if "$" in args:
+                raise UnresolvableInclude(line)
+            for pattern in shlex.split(args.partition("#")[0]):
+                pattern = str(directory / pattern)
+                for match in sorted(glob.glob(pattern)) or [pattern]:
+                    included = Path(match)
+                    if included.is_file():
+                        read(included)
+                    elif directive == "include":
+                        # make would try to remake it from a rule
+                        raise UnresolvableInclude(line)
+
+    read(makefile)
+    return paths
+
+
+def _help_line(line: str) -> Optional[str]:
+    """Format a line of a makefile as the `help` target does, or None if it is filtered out."""
+    if "##" not in line or "fgrep" in line or "sed -e" in line:
+        return None
+    line = line.removesuffix("\\").replace("##", "", 1)
+    fields = line.split(":")
+    return f"{fields[0]:<15s} {fields[1] if len(fields) > 1 else ''}"
+
+
+def parse_help_output(raw_text: str) -> list[MakefileTarget]:
+    """Parse the output of the `help` target into a list of targets."""
     makefile_targets = []
-    for line in raw_text.splitlines():
+    for line in dedent(raw_text).splitlines():
         target, _, description = line.partition(" ")
+        # In GitHub Actions, we get superfluous lines like `make[1]: Entering directory`
+        if re.search(r"make\[[0-9]+]", target):
+            continue
         makefile_targets.append(
             MakefileTarget(target=target.strip(), description=description.strip())
         )
+    return makefile_targets
+
+
+def parse_makefile(makefile: Path) -> list[MakefileTarget]:
+    """Read the targets from the help comments of a makefile and its includes."""
+    help_lines = []
+    for path in makefile_list(makefile):
+        for line in path.read_text().splitlines():
+            help_line = _help_line(line)
+            if help_line is not None:
+                help_lines.append(help_line + "\n")
+    return parse_help_output("".join(help_lines))
+
+
+def run_make(directory: Path) -> list[MakefileTarget]:
+    """List the targets by running the `help` target with make."""
+    return parse_help_output(subprocess.check_output("make", text=True, cwd=directory))
+
 
+def _file_state(path: Path) -> list:
+    stat = path.stat()
+    return [str(path), stat.st_mtime_ns, stat.st_size]
+
+
+def _file_hash(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def default_cache_dir() -> Optional[Path]:
+    """Return the directory of the cache, or None if it is disabled."""
+    cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+    if cache_dir is not None:
+        return Path(cache_dir) if cache_dir else None
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "anaconda-pre-commit-hooks" / "makefile-targets"
+
+
+class TargetsCache:
+    """An on-disk cache of the targets of each makefile.
+
+    An entry is valid while every file read to produce it has the same modification time and
+    size, or otherwise the same content hash, as when it was written.
+
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    def _entry(self, makefile: Path) -> Path:
+        key = hashlib.sha256(str(makefile.resolve()).encode()).hexdigest()
+        return self.directory / f"{key}.json"
+
+    def get(self, makefile: Path) -> Optional[list[MakefileTarget]]:
+        try:
+            entry = json.loads(self._entry(makefile).read_text())
+            if entry["version"] != CACHE_VERSION:
+                return None
+            touched = False
+            for path, mtime_ns, size, digest in entry["files"]:
+                if _file_state(Path(path)) != [path, mtime_ns, size]:
+                    if _file_hash(Path(path)) != digest:
+                        return None
+                    touched = True
+            targets = [MakefileTarget(*t) for t in entry["targets"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if touched:
+            # Record the new modification times, so that the files aren't hashed every time
+            self.put(makefile, targets)
+        return targets
+
+    def put(self, makefile: Path, targets: list[MakefileTarget]) -> None:
+        # The makefiles are read again, which is cheap, to record exactly what was parsed
+        files = [
+            [*_file_state(path), _file_hash(path)] for path in makefile_list(makefile)
+        ]
+        entry = {"version": CACHE_VERSION, "files": files, "targets": targets}
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            # The cache is only an optimisation, e.g. the home directory may be read-only
+            return
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(entry, fp)
+            os.replace(tmp_name, self._entry(makefile))
+        except BaseException as e:
+            os.unlink(tmp_name)
+            if not isinstance(e, OSError):
+                raise
+
+
+def load_targets(
+    directory: Path, cache: Optional[TargetsCache] = None
+) -> list[MakefileTarget]:
+    """Load the targets of the makefile in a directory, from the cache if possible."""
+    makefile = find_makefile(directory)
+    if cache is not None:
+        targets = cache.get(makefile)
+        if targets is not None:
+            return targets
+
+    try:
+        targets = parse_makefile(makefile)
+    except UnresolvableInclude:
+        return run_make(directory)
+    if cache is not None:
+        cache.put(makefile, targets)
+    return targets
+
+
+def render_table(makefile_targets: list[MakefileTarget]) -> list[str]:
+    """Render the targets as the lines of a Markdown table."""
     # Add two since we will surround with backticks
     max_target_len = max(len(t.target) for t in makefile_targets) + 2
     max_description_len = max(len(t.description) for t in makefile_targets)
 
-    cog.outl(
-        "<!-- THE FOLLOWING CODE IS GENERATED BY COG VIA PRE-COMMIT. ANY MANUAL CHANGES WILL BE LOST. -->"
-    )
-    cog.outl(
-        f"| {'Target':{max_target_len}s} | {'Description':{max_description_len}s} |"
-    )
-    cog.outl(
-        f"|{'-' * (max_target_len + 2)}|{'-' * (max_description_len + 2):{max_description_len}s}|"
-    )
+    lines = [
+        "<!-- THE FOLLOWING CODE IS GENERATED BY COG VIA PRE-COMMIT. ANY MANUAL CHANGES WILL BE LOST. -->",
+        f"| {'Target':{max_target_len}s} | {'Description':{max_description_len}s} |",
+        f"|{'-' * (max_target_len + 2)}|{'-' * (max_description_len + 2):{max_description_len}s}|",
+    ]
     for t in makefile_targets:
-        # In GitHub Actions, we get superfluous targets like `make[1]`, so ignore those
-        if re.search(r"make\[[0-9]+]", t.target):
-            continue
-
         target_str = f"`{t.target}`"
-        cog.outl(
+        lines.append(
             f"| {target_str:{max_target_len}s} | {t.description:{max_description_len}s} |"
         )
+    return lines
+
+
+def main(outl: Optional[Callable[[str], None]] = None) -> None:
+    if outl is None:
+        # The cog module only exists while cog is running
+        import cog
+
+        outl = cog.outl
+
+    cache_dir = default_cache_dir()
+    cache = TargetsCache(cache_dir) if cache_dir is not None else None
+    for line in render_table(load_targets(Path.cwd(), cache)):
+        outl(line)
 
 
 if __name__ == "__main__":
-    # If we run this file as a script, we just make `cog.outl` emit print statements for debugging purposes.
-    cog.outl = print
-    main()
+    # If we run this file as a script, we just emit print statements for debugging purposes.
+    main(outl=print)
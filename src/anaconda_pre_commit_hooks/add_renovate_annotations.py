@@ -7,18 +7,70 @@ based on its own include rules specified in .pre-commit-config.yaml.
 
 """
 
+import hashlib
 import json
+import os
 import re
 import shlex
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from functools import partial
 from pathlib import Path
-from typing import Annotated, NamedTuple, Optional, TypedDict
+from typing import TYPE_CHECKING, Annotated, Any, NamedTuple, Optional, Union
 
 import typer
 
+from anaconda_pre_commit_hooks.command_runner import OutputCallback, run_command
+from anaconda_pre_commit_hooks.conda_meta import (
+    parse_name_selector,
+    parse_prefix_selector,
+    read_conda_meta_packages,
+)
+from anaconda_pre_commit_hooks.dependencies import Dependencies, Dependency
+from anaconda_pre_commit_hooks.environment_templates import (
+    DEFAULT_TEMPLATES_MAX_COUNT,
+    EnvironmentTemplates,
+)
+from anaconda_pre_commit_hooks.lockfile import read_lockfile_packages
+from anaconda_pre_commit_hooks.timings import Timings, maybe_stage
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
 DEFAULT_ENVIRONMENT_SELECTOR = "-p ./env"
 DEFAULT_CREATE_COMMAND = "make setup"
 
+# Environment files larger than this are streamed, instead of being loaded into memory
+STREAMING_THRESHOLD_BYTES = 1024 * 1024
+
+# Environment variables to enable timings, e.g. when running under pre-commit
+TIMINGS_ENV_VAR = "GENERATE_RENOVATE_ANNOTATIONS_TIMINGS"
+TRACE_FILE_ENV_VAR = "GENERATE_RENOVATE_ANNOTATIONS_TRACE_FILE"
+
+# The Unix socket of the daemon, shared by the daemon and the CLI
+SOCKET_ENV_VAR = "GENERATE_RENOVATE_ANNOTATIONS_SOCKET"
+
+# The directory of template environments, e.g. one restored from a CI cache
+TEMPLATE_DIR_ENV_VAR = "GENERATE_RENOVATE_ANNOTATIONS_TEMPLATE_DIR"
+
+# Files in a project directory whose contents determine the state of its environment
+ENVIRONMENT_INPUT_PATTERNS = (
+    "environment*.yml",
+    "environment*.yaml",
+    "*.lock",
+    "conda-lock.yml",
+    "Makefile",
+)
+
+# Match the package name (including any extras) in a dependency spec, and the bare name
+DEPENDENCY_SPEC_RE = re.compile(r"-\s*([\w\-\[\],.]+)")
+PACKAGE_NAME_RE = re.compile(r"([\w.-]+)")
+SPEC_NAME_RE = re.compile(r"^[\w\-\[\],.]+")
+
 CondaOrPip = str
 PackageName = str
 PackageVersion = str
@@ -30,73 +82,269 @@ IndexOverrides = dict[PackageName, IndexUrl]
 
 app = typer.Typer(rich_markup_mode="markdown", add_completion=False)
 
+# Serializes failure reports so that output from concurrent projects is not interleaved
+_output_lock = threading.Lock()
 
-class Dependency(TypedDict):
-    name: str
-    channel: str
-    version: str
 
+class LineChange(NamedTuple):
+    """A change made to the lines of a single dependency in an environment file."""
 
-class Dependencies(NamedTuple):
-    pip: dict[str, Dependency]
-    conda: dict[str, Dependency]
+    line_number: int
+    package: str
+    datasource: str
+    channel: Optional[str]
+    old_spec: str
+    new_spec: str
+    old_comment: Optional[str]
+    new_comment: Optional[str]
 
+    @property
+    def old_pin(self) -> Optional[str]:
+        """The version constraint of the dependency before the change, if any."""
+        return _spec_pin(self.old_spec)
 
-def setup_conda_environment(command: str, *, cwd: Optional[Path] = None) -> None:
-    """Ensure the conda environment is setup and updated."""
-    cwd = cwd or Path.cwd()
-    result = subprocess.run(
-        shlex.split(command), capture_output=True, text=True, cwd=cwd
+    @property
+    def new_pin(self) -> Optional[str]:
+        """The version constraint of the dependency after the change, if any."""
+        return _spec_pin(self.new_spec)
+
+    def to_dict(self) -> dict:
+        return {**self._asdict(), "old_pin": self.old_pin, "new_pin": self.new_pin}
+
+
+class AnnotationResult(NamedTuple):
+    """The annotated contents of an environment file, and the changes made to it."""
+
+    path: Path
+    content: str
+    changes: list[LineChange]
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.changes)
+
+
+class EnvironmentKey(NamedTuple):
+    """Identifies an environment, along with the command used to create it."""
+
+    identity: str
+    create_command: Optional[str]
+
+
+def _spec_pin(spec: str) -> Optional[str]:
+    return SPEC_NAME_RE.sub("", spec, count=1).strip() or None
+
+
+def _write_temp_file(path: Path, lines: Iterable[str]) -> str:
+    """Write lines to a new temporary file next to a path, returning the temporary file name.
+
+    If the path is a symlink, the temporary file is created next to its target instead, so
+    that it can replace the target.
+
+    """
+    path = path.resolve()
+    fd, tmp_name = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
     )
-    if result.returncode != 0:
-        print(f"Failed to run setup command in {cwd}")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.writelines(lines)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return tmp_name
+
+
+def _replace_with_temp_file(path: Path, tmp_name: str) -> None:
+    """Atomically replace a file with a temporary file, keeping the file mode.
+
+    Symlinks are followed, so that the target is updated rather than the link replaced.
+
+    """
+    path = path.resolve()
+    try:
+        if path.exists():
+            shutil.copymode(path, tmp_name)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    """Write a file via a temporary file and a rename, so that readers never see a partial file."""
+    _replace_with_temp_file(path, _write_temp_file(path, [text]))
+
+
+def _report_failure(
+    header: str,
+    result: Union[subprocess.CompletedProcess, subprocess.TimeoutExpired],
+) -> None:
+    """Print the captured output of a failed command as a single, uninterrupted block."""
+    with _output_lock:
+        print(header)
         print(result.stdout)
-        print(result.stderr)
+        print(result.stderr, flush=True)
+
+
+def _print_progress(project_directory: Path, stream: str, line: str) -> None:
+    """Print a line of output from the create command of a project to stderr."""
+    with _output_lock:
+        print(f"[{project_directory}] {line}", end="", file=sys.stderr, flush=True)
+
+
+def setup_conda_environment(
+    command: str,
+    *,
+    cwd: Optional[Path] = None,
+    timeout: Optional[float] = None,
+    on_output: Optional[OutputCallback] = None,
+) -> None:
+    """Ensure the conda environment is setup and updated.
+
+    The output of the command is streamed, and only its tail is printed if it fails or times out.
+
+    """
+    cwd = cwd or Path.cwd()
+    try:
+        result = run_command(
+            shlex.split(command), cwd=cwd, timeout=timeout, on_line=on_output
+        )
+    except subprocess.TimeoutExpired as e:
+        _report_failure(
+            f"Timed out after {timeout} s running setup command in {cwd}", e
+        )
+        raise
+    if result.returncode != 0:
+        _report_failure(f"Failed to run setup command in {cwd}", result)
         result.check_returncode()
 
 
 def list_packages_in_conda_environment(
-    environment_selector: str, *, cwd: Optional[Path] = None
+    environment_selector: str,
+    *,
+    cwd: Optional[Path] = None,
+    timeout: Optional[float] = None,
 ) -> list[dict]:
-    # Then we list the actual versions of each package in the environment
-    result = subprocess.run(
+    # For prefix-based environments, we can usually read the package records directly,
+    # which avoids paying the startup cost of the conda CLI
+    prefix = parse_prefix_selector(environment_selector)
+    if prefix is not None:
+        prefix_path = (cwd or Path.cwd()) / Path(prefix).expanduser()
+        data = read_conda_meta_packages(prefix_path)
+        if data is not None:
+            return data
+
+    # Otherwise, we list the actual versions of each package in the environment
+    result = run_command(
         ["conda", "list", *shlex.split(environment_selector), "--json"],
-        capture_output=True,
-        text=True,
         cwd=cwd,
+        timeout=timeout,
+        keep_stdout=True,
     )
     if result.returncode != 0:
-        print(result.stdout)
-        print(result.stderr)
+        _report_failure(f"Failed to list packages in {cwd or Path.cwd()}", result)
         result.check_returncode()
 
     return json.loads(result.stdout)
 
 
-def load_dependencies(
-    project_directory: Optional[Path] = None,
-    create_command: Optional[str] = DEFAULT_CREATE_COMMAND,
-    environment_selector: str = DEFAULT_ENVIRONMENT_SELECTOR,
-) -> Dependencies:
-    """Load the dependencies from a live conda environment.
+def environment_key(
+    project_directory: Path,
+    create_command: Optional[str],
+    environment_selector: str,
+) -> EnvironmentKey:
+    """Resolve the environment selected from a project directory to an identity.
 
-    Args:
-        project_directory: The directory in which the project is located.
-        create_command: A command used to create a new conda environment from the environment file(s).
-        environment_selector: A string used to select the environment (-p ./env or -n name for a named environment).
-
-    Returns:
-        An object containing all dependencies in the installed environment, split between conda and pip packages.
+    Project directories which select the same environment, either by name or by a prefix
+    which resolves to the same absolute path, share the same key. If the selector can't be
+    parsed, the environment is assumed to be specific to the project directory.
 
     """
-    if create_command is not None:
-        setup_conda_environment(create_command, cwd=project_directory or Path.cwd())
+    prefix = parse_prefix_selector(environment_selector)
+    name = parse_name_selector(environment_selector)
+    if prefix is not None:
+        identity = f"prefix:{(project_directory / Path(prefix).expanduser()).resolve()}"
+    elif name is not None:
+        identity = f"name:{name}"
+    else:
+        identity = f"selector:{project_directory.resolve()}:{environment_selector}"
+    return EnvironmentKey(identity, create_command)
+
 
-    data = list_packages_in_conda_environment(
-        environment_selector, cwd=project_directory
+def environment_input_files(project_directory: Path) -> list[Path]:
+    """Return the files in a project directory which determine the state of its environment."""
+    return sorted(
+        {
+            p
+            for pattern in ENVIRONMENT_INPUT_PATTERNS
+            for p in project_directory.glob(pattern)
+        }
     )
 
-    # We split the list separately into pip & conda dependencies
+
+def environment_cache_key(
+    project_directory: Path,
+    create_command: Optional[str],
+    environment_selector: str,
+    *,
+    shared_with: Sequence[Path] = (),
+) -> str:
+    """Compute a key which changes whenever the environment of a project may have changed.
+
+    The key is a hash of the contents of all environment input files in the project directory,
+    along with the command used to create the environment and the environment selector. The
+    input files of the project directories in `shared_with`, which share the environment, are
+    included too.
+
+    """
+    digest = hashlib.sha256()
+    for value in (create_command or "", environment_selector):
+        digest.update(value.encode())
+        digest.update(b"\0")
+    for directory in [project_directory, *shared_with]:
+        directory = directory.resolve()
+        digest.update(str(directory).encode())
+        digest.update(b"\0")
+        for input_file in environment_input_files(directory):
+            digest.update(input_file.name.encode())
+            digest.update(b"\0")
+            digest.update(input_file.read_bytes())
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def environment_template_features(directories: Sequence[Path]) -> set[str]:
+    """Return the features of an environment, used to find the closest template for it.
+
+    These are the lines of the environment input files of the project directories, ignoring
+    blank lines and comments, e.g. the dependency specs of the environment files.
+
+    """
+    features = set()
+    for directory in directories:
+        for input_file in environment_input_files(directory):
+            for line in input_file.read_text().splitlines():
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    features.add(line)
+    return features
+
+
+def _read_cached_dependencies(cache_file: Path) -> Optional[Dependencies]:
+    try:
+        return Dependencies.from_json(cache_file.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached_dependencies(cache_file: Path, dependencies: Dependencies) -> None:
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    _atomic_write_text(cache_file, dependencies.to_json())
+
+
+def parse_dependencies(data: list[dict]) -> Dependencies:
+    """Split the output of `conda list --json` into pip & conda dependencies."""
     pip_deps = {
         x["name"]: Dependency(
             name=x["name"], channel=x["channel"], version=x["version"]
@@ -120,95 +368,636 @@ def load_dependencies(
     return Dependencies(pip=pip_deps, conda=conda_deps)
 
 
-def add_comments_to_env_file(
-    env_file: Path,
+def load_dependencies(
+    project_directory: Optional[Path] = None,
+    create_command: Optional[str] = DEFAULT_CREATE_COMMAND,
+    environment_selector: str = DEFAULT_ENVIRONMENT_SELECTOR,
+    *,
+    cache_dir: Optional[Path] = None,
+    daemon_socket: Optional[Path] = None,
+    templates: Optional[EnvironmentTemplates] = None,
+    command_timeout: Optional[float] = None,
+    progress: bool = False,
+    timings: Optional[Timings] = None,
+    shared_with: Sequence[Path] = (),
+) -> Dependencies:
+    """Load the dependencies from a live conda environment.
+
+    Args:
+        project_directory: The directory in which the project is located.
+        create_command: A command used to create a new conda environment from the environment file(s).
+        environment_selector: A string used to select the environment (-p ./env or -n name for a named environment).
+        cache_dir: If provided, the installed dependencies are cached in this directory, keyed by
+            `environment_cache_key`. On a cache hit, the environment is neither created nor listed.
+        daemon_socket: If provided, the packages are requested from the daemon listening on this
+            Unix socket first. If it isn't running, the packages are loaded as usual.
+        templates: If provided, a missing prefix-based environment is cloned from the template
+            with the same `environment_cache_key` instead of running the create command.
+            Without one, the closest template of any project is cloned and then updated by the
+            create command. Environments created from scratch are saved as templates.
+        command_timeout: The maximum time in seconds for the create command and for listing the
+            packages, each. Commands which time out are terminated, along with their children.
+        progress: If set, the output of the create command is printed to stderr as it arrives.
+        timings: If provided, the time spent in each stage is recorded.
+        shared_with: Other project directories which share the environment. Their environment
+            input files invalidate the cache, the templates and the daemon too.
+
+    Returns:
+        An object containing all dependencies in the installed environment, split between conda and pip packages.
+
+    """
+    project = project_directory or Path.cwd()
+    if daemon_socket is not None:
+        from anaconda_pre_commit_hooks.daemon import request_packages
+
+        with maybe_stage(timings, "request_daemon", project):
+            daemon_data = request_packages(
+                daemon_socket,
+                project,
+                create_command,
+                environment_selector,
+                shared_with=shared_with,
+            )
+        if daemon_data is not None:
+            with maybe_stage(timings, "parse_dependencies", project):
+                return parse_dependencies(daemon_data)
+
+    cache_file = None
+    if cache_dir is not None:
+        with maybe_stage(timings, "read_cache", project):
+            key = environment_cache_key(
+                project, create_command, environment_selector, shared_with=shared_with
+            )
+            cache_file = cache_dir / f"{key}.json"
+            cached_dependencies = _read_cached_dependencies(cache_file)
+        if cached_dependencies is not None:
+            return cached_dependencies
+
+    if create_command is not None:
+        setup = partial(
+            setup_conda_environment,
+            create_command,
+            cwd=project,
+            timeout=command_timeout,
+            on_output=partial(_print_progress, project) if progress else None,
+        )
+        prefix = parse_prefix_selector(environment_selector)
+        if templates is not None and prefix is not None:
+            _setup_conda_environment_from_template(
+                templates,
+                environment_cache_key(
+                    project,
+                    create_command,
+                    environment_selector,
+                    shared_with=shared_with,
+                ),
+                project / Path(prefix).expanduser(),
+                setup,
+                features=environment_template_features([project, *shared_with]),
+                project=project,
+                timings=timings,
+            )
+        else:
+            with maybe_stage(timings, "setup_conda_environment", project):
+                setup()
+
+    with maybe_stage(timings, "list_packages_in_conda_environment", project):
+        data = list_packages_in_conda_environment(
+            environment_selector, cwd=project_directory, timeout=command_timeout
+        )
+    with maybe_stage(timings, "parse_dependencies", project):
+        dependencies = parse_dependencies(data)
+
+    if cache_file is not None:
+        _write_cached_dependencies(cache_file, dependencies)
+    return dependencies
+
+
+def _setup_conda_environment_from_template(
+    templates: EnvironmentTemplates,
+    key: str,
+    prefix: Path,
+    setup: Callable[[], None],
+    *,
+    features: set[str],
+    project: Path,
+    timings: Optional[Timings] = None,
+) -> None:
+    """Restore a missing environment from its template, or create it and save it as one.
+
+    Without a template of its own, the environment is created on top of the closest template,
+    which may belong to another project, so the create command always runs, and must update
+    the existing environment, e.g. with `conda env update`. If it fails to do so, the
+    environment is created from scratch. Environments created on top of another template
+    may contain packages left over from it, so only those created from scratch are saved.
+
+    """
+    with maybe_stage(timings, "restore_template", project):
+        restored = templates.restore(key, prefix)
+    if restored:
+        return
+    with maybe_stage(timings, "restore_closest_template", project):
+        base_key = templates.restore_closest(features, prefix)
+
+    with maybe_stage(timings, "setup_conda_environment", project):
+        try:
+            setup()
+        except subprocess.CalledProcessError:
+            if base_key is None:
+                raise
+            with _output_lock:
+                print(f"Creating the environment in {project} without a template")
+            shutil.rmtree(prefix, ignore_errors=True)
+            setup()
+            base_key = None
+    if base_key is None:
+        with maybe_stage(timings, "save_template", project):
+            templates.save(key, prefix, features)
+
+
+def load_lockfile_dependencies(
+    project_directory: Optional[Path] = None,
+    lockfile: str = "conda-lock.yml",
+    *,
+    timings: Optional[Timings] = None,
+) -> Dependencies:
+    """Load the dependencies from a lock file, without requiring a live conda environment.
+
+    Args:
+        project_directory: The directory in which the project is located.
+        lockfile: The path to a `conda-lock.yml` file, an `@EXPLICIT` spec file, or the output of
+            `conda env export --json`, relative to the project directory.
+        timings: If provided, the time spent in each stage is recorded.
+
+    Returns:
+        An object containing all dependencies in the lock file, split between conda and pip packages.
+
+    """
+    project = project_directory or Path.cwd()
+    with maybe_stage(timings, "read_lockfile", project):
+        data = read_lockfile_packages(project / lockfile)
+    with maybe_stage(timings, "parse_dependencies", project):
+        return parse_dependencies(data)
+
+
+def iter_project_dependencies(
+    project_dirs: Sequence[Path],
+    *,
+    create_command: Optional[str] = DEFAULT_CREATE_COMMAND,
+    environment_selector: str = DEFAULT_ENVIRONMENT_SELECTOR,
+    jobs: int = 1,
+    cache_dir: Optional[Path] = None,
+    lockfile: Optional[str] = None,
+    daemon_socket: Optional[Path] = None,
+    templates: Optional[EnvironmentTemplates] = None,
+    command_timeout: Optional[float] = None,
+    progress: bool = False,
+    timings: Optional[Timings] = None,
+    executor: Optional["Executor"] = None,
+) -> Iterator[tuple[Path, Dependencies]]:
+    """Load the dependencies for each project directory, optionally on a bounded worker pool.
+
+    Project directories which select the same environment (see `environment_key`) share it,
+    so that each environment is only created and listed once, from the first of its project
+    directories. The cache, the templates and the daemon still account for the environment
+    input files of all of them.
+
+    With `jobs > 1`, or an `executor`, the environments are loaded concurrently and yielded in
+    order of completion. If loading any project fails, pending projects are cancelled, projects
+    already running are allowed to finish, and the first error is re-raised.
+
+    Args:
+        project_dirs: The project directories to load.
+        create_command: A command used to create a new conda environment from the environment file(s).
+        environment_selector: A string used to select the environment (-p ./env or -n name for a named environment).
+        jobs: The maximum number of environments to load concurrently.
+        cache_dir: An optional directory in which to cache the installed packages of each project.
+        lockfile: If provided, the dependencies are loaded from this lock file in each project directory,
+            instead of from a live conda environment.
+        daemon_socket: An optional Unix socket of a daemon to request the installed packages from.
+        templates: Optional template environments from which to restore missing environments.
+        command_timeout: An optional maximum time in seconds for each command that is run.
+        progress: If set, the output of each create command is printed to stderr as it arrives.
+        timings: If provided, the time spent in each stage of each project is recorded.
+        executor: An optional executor on which to load the environments, instead of a thread
+            pool of `jobs` workers. It isn't shut down afterwards. Timings can't be recorded
+            on a process pool.
+
+    Yields:
+        Tuples of the project directory and its loaded dependencies.
+
+    """
+    load: Callable[..., Dependencies]
+    if lockfile is not None:
+        load = partial(load_lockfile_dependencies, lockfile=lockfile, timings=timings)
+    else:
+        load = partial(
+            load_dependencies,
+            create_command=create_command,
+            environment_selector=environment_selector,
+            cache_dir=cache_dir,
+            daemon_socket=daemon_socket,
+            templates=templates,
+            command_timeout=command_timeout,
+            progress=progress,
+            timings=timings,
+        )
+
+    groups: dict[Union[EnvironmentKey, Path], list[Path]] = {}
+    for project_dir in project_dirs:
+        key = (
+            environment_key(project_dir, create_command, environment_selector)
+            if lockfile is None
+            else project_dir
+        )
+        groups.setdefault(key, []).append(project_dir)
+
+    def group_kwargs(group: list[Path]) -> dict[str, Any]:
+        # Lock files aren't shared, so only environments have more than one project directory
+        return {"shared_with": group[1:]} if len(group) > 1 else {}
+
+    if executor is None and (jobs <= 1 or len(groups) <= 1):
+        for group in groups.values():
+            dependencies = load(group[0], **group_kwargs(group))
+            for project_dir in group:
+                yield project_dir, dependencies
+        return
+
+    # Deferred until a pool is actually needed, see DEFERRED_MODULES in test_entry_points.py
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    own_executor = executor is None
+    pool = ThreadPoolExecutor(max_workers=jobs) if executor is None else executor
+    futures = {
+        pool.submit(load, group[0], **group_kwargs(group)): group
+        for group in groups.values()
+    }
+    try:
+        for future in as_completed(futures):
+            dependencies = future.result()
+            for project_dir in futures[future]:
+                yield project_dir, dependencies
+    finally:
+        # On failure (or early exit by the consumer), don't start any new projects
+        if own_executor:
+            pool.shutdown(wait=True, cancel_futures=True)
+        else:
+            for future in futures:
+                future.cancel()
+
+
+def iter_annotated_lines(
+    in_lines: Iterable[str],
     dependencies: Dependencies,
     *,
     conda_channel_overrides: Optional[ChannelOverrides] = None,
     pip_index_overrides: Optional[IndexOverrides] = None,
-) -> None:
-    """Process an environment file, which entails adding renovate comments and pinning the installed version."""
+    changes: Optional[list[LineChange]] = None,
+) -> Iterator[str]:
+    """Add renovate comments to, and pin the installed version in, the lines of an environment file.
+
+    The lines are processed lazily, one at a time, so that arbitrarily large files can be
+    processed in constant memory. Output is delayed by one line, since an existing renovate
+    comment is only known to be replaced once the dependency below it is reached.
+
+    Args:
+        in_lines: The lines of the environment file, including line endings.
+        dependencies: The installed dependencies.
+        conda_channel_overrides: Channels to use for specific conda packages.
+        pip_index_overrides: Index URLs to use for specific pip packages.
+        changes: If provided, the dependencies whose lines were changed are appended to it.
+
+    Yields:
+        The output lines.
+
+    """
     conda_channel_overrides = conda_channel_overrides or {}
     pip_index_overrides = pip_index_overrides or {}
 
-    with env_file.open() as fp:
-        in_lines = fp.readlines()
-
-    out_lines: list[str] = []
+    # The last output line, which is dropped if it turns out to be a renovate comment
+    pending: Optional[str] = None
     in_dependencies = False
     in_pip_dependencies = False
-    for raw_line in in_lines:
+    for line_number, raw_line in enumerate(in_lines, start=1):
         line = raw_line.strip()
         if line == "dependencies:":
             in_dependencies = True
-        elif in_dependencies and not (line.startswith("#") or line.startswith("-")):
+        elif in_dependencies and not line.startswith(("#", "-")):
             in_dependencies = False
         elif line == "- pip:":
             in_pip_dependencies = True
 
-        if in_dependencies and line.startswith("-") and not line.endswith(":"):
-            # It's a dependency spec
-            m = re.search(r"-\s*([\w\-\[\],.]+)", line)
+        if not (in_dependencies and line.startswith("-") and not line.endswith(":")):
+            if pending is not None:
+                yield pending
+            pending = raw_line
+            continue
+
+        # It's a dependency spec
+        m = DEPENDENCY_SPEC_RE.match(line)
+        if m is None:
+            raise ValueError(f"Could not parse line: {line}")
+        package_name_with_extras = m.group(1).lower()
+        if in_pip_dependencies:
+            # Unlike pip, conda treats `_` and `-` as distinct, e.g. `python_abi`
+            package_name_with_extras = package_name_with_extras.replace("_", "-")
+        if package_name_with_extras.startswith((".", "-e")):
+            package_name = "."
+        else:
+            m = PACKAGE_NAME_RE.search(package_name_with_extras)
             if m is None:
-                raise ValueError(f"Could not parse line: {line}")
-            package_name_with_extras = m.group(1).lower().replace("_", "-")
-            if package_name_with_extras.startswith(
-                "."
-            ) or package_name_with_extras.startswith("-e"):
-                package_name = "."
-            else:
-                m = re.search(r"([\w-]+)", package_name_with_extras)
-                if m is None:
-                    raise ValueError(
-                        f"Could not parse package: {package_name_with_extras}"
-                    )
-                package_name = m.group(1)
-
-            matching_dependency: Optional[Dependency] = (
-                dependencies.pip.get(package_name)
-                if in_pip_dependencies
-                else dependencies.conda.get(package_name)
-            )
-            if in_pip_dependencies:
-                datasource, dep_name = "pypi", package_name
+                raise ValueError(f"Could not parse package: {package_name_with_extras}")
+            package_name = m.group(1)
+
+        matching_dependency: Optional[Dependency] = (
+            dependencies.find_pip(package_name)
+            if in_pip_dependencies
+            else dependencies.find_conda(package_name)
+        )
+        channel: Optional[str]
+        if in_pip_dependencies:
+            datasource, dep_name = "pypi", package_name
+            channel = pip_index_overrides.get(dep_name)
+        else:
+            channel = "main"
+            if package_name in conda_channel_overrides:
+                channel = conda_channel_overrides[package_name]
+            elif matching_dependency:
+                channel = matching_dependency.channel
+            datasource, dep_name = "conda", f"{channel}/{package_name}"
+
+        indent = " " * (len(raw_line.rstrip()) - len(line))
+        old_comment = None
+        if pending is not None and pending.strip().startswith("# renovate"):
+            old_comment = pending
+        elif pending is not None:
+            yield pending
+        pending = None
+
+        new_comment = None
+        if package_name != ".":
+            if datasource == "conda":
+                new_comment = (
+                    f"{indent}# renovate: datasource={datasource} depName={dep_name}\n"
+                )
+            elif channel is not None:
+                new_comment = f"{indent}# renovate: datasource={datasource} registryUrl={channel}\n"
             else:
-                channel_name = "main"
-                if package_name in conda_channel_overrides:
-                    channel_name = conda_channel_overrides[package_name]
-                elif matching_dependency:
-                    channel_name = matching_dependency["channel"]
-                datasource, dep_name = "conda", f"{channel_name}/{package_name}"
-
-            indentation = len(raw_line.rstrip()) - len(line)
-            if out_lines[-1].strip().startswith("# renovate"):
-                out_lines.pop(-1)
-            if package_name != ".":
-                if datasource == "conda":
-                    renovate_line = f"{' ' * indentation}# renovate: datasource={datasource} depName={dep_name}\n"
-                elif (index_url := pip_index_overrides.get(dep_name)) is not None:
-                    renovate_line = f"{' ' * indentation}# renovate: datasource={datasource} registryUrl={index_url}\n"
-                else:
-                    renovate_line = (
-                        f"{' ' * indentation}# renovate: datasource={datasource}\n"
-                    )
-                out_lines.append(renovate_line)
-
-            # Attempt to load the actual version from the dependencies dictionary to write to the file
-            if matching_dependency:
-                versioned_line = None
-                if datasource == "conda":
-                    versioned_line = f"{' ' * indentation}- {package_name}={matching_dependency['version']}\n"
-                else:
-                    versioned_line = f"{' ' * indentation}- {package_name_with_extras}=={matching_dependency['version']}\n"
-                out_lines.append(versioned_line)
+                new_comment = f"{indent}# renovate: datasource={datasource}\n"
+            yield new_comment
+
+        # Attempt to load the actual version from the dependencies dictionary to write to the file
+        new_line = raw_line
+        if matching_dependency:
+            if datasource == "conda":
+                new_line = f"{indent}- {package_name}={matching_dependency.version}\n"
             else:
-                out_lines.append(raw_line)
+                new_line = f"{indent}- {package_name_with_extras}=={matching_dependency.version}\n"
+        pending = new_line
+
+        if changes is not None and (new_line != raw_line or new_comment != old_comment):
+            changes.append(
+                LineChange(
+                    line_number=line_number,
+                    package=package_name,
+                    datasource=datasource,
+                    channel=channel,
+                    old_spec=line.lstrip("-").strip(),
+                    new_spec=new_line.strip().lstrip("-").strip(),
+                    old_comment=old_comment.strip() if old_comment else None,
+                    new_comment=new_comment.strip() if new_comment else None,
+                )
+            )
+
+    if pending is not None:
+        yield pending
+
+
+def annotate_env_lines(
+    in_lines: Sequence[str],
+    dependencies: Dependencies,
+    *,
+    conda_channel_overrides: Optional[ChannelOverrides] = None,
+    pip_index_overrides: Optional[IndexOverrides] = None,
+) -> tuple[list[str], list[LineChange]]:
+    """Add renovate comments to, and pin the installed version in, the lines of an environment file.
+
+    The lines are processed in a single pass, without modifying any files.
+
+    Returns:
+        A tuple of the output lines, and a list of the dependencies whose lines were changed.
+
+    """
+    changes: list[LineChange] = []
+    out_lines = list(
+        iter_annotated_lines(
+            in_lines,
+            dependencies,
+            conda_channel_overrides=conda_channel_overrides,
+            pip_index_overrides=pip_index_overrides,
+            changes=changes,
+        )
+    )
+    return out_lines, changes
+
+
+def add_comments_to_env_file(
+    env_file: Path,
+    dependencies: Dependencies,
+    *,
+    conda_channel_overrides: Optional[ChannelOverrides] = None,
+    pip_index_overrides: Optional[IndexOverrides] = None,
+    dry_run: bool = False,
+    streaming: bool = False,
+    timings: Optional[Timings] = None,
+) -> list[LineChange]:
+    """Process an environment file, which entails adding renovate comments and pinning the installed version.
+
+    The file is only rewritten if its contents change, in which case it is replaced atomically.
+    With `dry_run`, the file is never written, and only the changes are computed.
+    With `streaming`, the file is processed line by line and written to the temporary file as
+    it goes, instead of being loaded into memory, which produces the same output.
+    If `timings` is provided, the time spent is recorded against the file's project directory.
+
+    Returns:
+        A list of the dependencies whose lines were changed.
+
+    """
+    with maybe_stage(timings, "add_comments_to_env_file", env_file.parent):
+        if streaming:
+            return _add_comments_to_env_file_streaming(
+                env_file,
+                dependencies,
+                conda_channel_overrides=conda_channel_overrides,
+                pip_index_overrides=pip_index_overrides,
+                dry_run=dry_run,
+            )
+
+        result = annotate_env_file(
+            env_file,
+            dependencies,
+            conda_channel_overrides=conda_channel_overrides,
+            pip_index_overrides=pip_index_overrides,
+        )
+
+        # Leave the file untouched if nothing changed, to avoid bumping its modification time
+        if result.changed and not dry_run:
+            _atomic_write_text(env_file, result.content)
+    return result.changes
+
+
+def annotate_env_file(
+    env_file: Path,
+    dependencies: Dependencies,
+    *,
+    conda_channel_overrides: Optional[ChannelOverrides] = None,
+    pip_index_overrides: Optional[IndexOverrides] = None,
+) -> AnnotationResult:
+    """Compute the annotated contents of an environment file, without modifying it."""
+    with env_file.open() as fp:
+        out_lines, changes = annotate_env_lines(
+            fp.readlines(),
+            dependencies,
+            conda_channel_overrides=conda_channel_overrides,
+            pip_index_overrides=pip_index_overrides,
+        )
+    return AnnotationResult(path=env_file, content="".join(out_lines), changes=changes)
+
+
+def _add_comments_to_env_file_streaming(
+    env_file: Path,
+    dependencies: Dependencies,
+    *,
+    conda_channel_overrides: Optional[ChannelOverrides],
+    pip_index_overrides: Optional[IndexOverrides],
+    dry_run: bool,
+) -> list[LineChange]:
+    changes: list[LineChange] = []
+    tmp_name = None
+    with env_file.open() as fp:
+        out_lines = iter_annotated_lines(
+            fp,
+            dependencies,
+            conda_channel_overrides=conda_channel_overrides,
+            pip_index_overrides=pip_index_overrides,
+            changes=changes,
+        )
+        if dry_run:
+            for _ in out_lines:
+                pass
+        else:
+            tmp_name = _write_temp_file(env_file, out_lines)
+
+    # Every changed line is recorded, so the file is unchanged if there are no changes
+    if tmp_name is not None:
+        if changes:
+            _replace_with_temp_file(env_file, tmp_name)
         else:
-            out_lines.append(raw_line)
+            os.unlink(tmp_name)
+    return changes
+
 
-    # Overwrite the file now
-    with env_file.open("w") as fp:
-        fp.writelines(out_lines)
+def _annotate_project_env_files(
+    env_files: Sequence[Path],
+    dependencies: Dependencies,
+    *,
+    conda_channel_overrides: Optional[ChannelOverrides],
+    pip_index_overrides: Optional[IndexOverrides],
+    write: bool,
+) -> list[AnnotationResult]:
+    results = []
+    for env_file in env_files:
+        result = annotate_env_file(
+            env_file,
+            dependencies,
+            conda_channel_overrides=conda_channel_overrides,
+            pip_index_overrides=pip_index_overrides,
+        )
+        if write and result.changed:
+            _atomic_write_text(env_file, result.content)
+        results.append(result)
+    return results
+
+
+def annotate_env_files(
+    env_files: Sequence[Path],
+    *,
+    create_command: Optional[str] = DEFAULT_CREATE_COMMAND,
+    environment_selector: str = DEFAULT_ENVIRONMENT_SELECTOR,
+    cache_dir: Optional[Path] = None,
+    lockfile: Optional[str] = None,
+    daemon_socket: Optional[Path] = None,
+    templates: Optional[EnvironmentTemplates] = None,
+    command_timeout: Optional[float] = None,
+    conda_channel_overrides: Optional[ChannelOverrides] = None,
+    pip_index_overrides: Optional[IndexOverrides] = None,
+    write: bool = False,
+    executor: Optional["Executor"] = None,
+) -> list[AnnotationResult]:
+    """Annotate many environment files at once, for use as a library.
+
+    The dependencies of each environment are loaded once, and shared by all files in the
+    project directories which select it. By default, no files are modified.
+
+    Args:
+        env_files: The environment files to annotate, in any number of project directories.
+        create_command: A command used to create a new conda environment from the environment file(s),
+            or None to skip creating environments.
+        environment_selector: A string used to select the environment (-p ./env or -n name for a named environment).
+        cache_dir: An optional directory in which to cache the installed packages of each project.
+        lockfile: If provided, the dependencies are loaded from this lock file in each project directory,
+            instead of from a live conda environment.
+        daemon_socket: An optional Unix socket of a daemon to request the installed packages from.
+        templates: Optional template environments from which to restore missing environments.
+        command_timeout: An optional maximum time in seconds for each command that is run.
+        conda_channel_overrides: Channels to use for specific conda packages.
+        pip_index_overrides: Index URLs to use for specific pip packages.
+        write: If set, the files which change are also rewritten.
+        executor: An optional thread or process pool executor, on which the environments are
+            loaded and the files of each project are annotated. Otherwise, everything runs
+            sequentially in the calling thread.
+
+    Returns:
+        The annotated contents and changes of each file, in the same order as `env_files`.
+
+    """
+    project_files: dict[Path, list[Path]] = {}
+    for env_file in env_files:
+        project_files.setdefault(env_file.parent, []).append(env_file)
+
+    dependencies = dict(
+        iter_project_dependencies(
+            sorted(project_files),
+            create_command=create_command,
+            environment_selector=environment_selector,
+            cache_dir=cache_dir,
+            lockfile=lockfile,
+            daemon_socket=daemon_socket,
+            templates=templates,
+            command_timeout=command_timeout,
+            executor=executor,
+        )
+    )
+
+    # The files of each project are annotated together, so that its dependencies are only
+    # sent to a process pool once
+    annotate = partial(
+        _annotate_project_env_files,
+        conda_channel_overrides=conda_channel_overrides,
+        pip_index_overrides=pip_index_overrides,
+        write=write,
+    )
+    project_dirs = list(project_files)
+    files_per_project = [project_files[d] for d in project_dirs]
+    dependencies_per_project = [dependencies[d] for d in project_dirs]
+    batches: Iterator[list[AnnotationResult]]
+    if executor is None:
+        batches = map(annotate, files_per_project, dependencies_per_project)
+    else:
+        batches = executor.map(annotate, files_per_project, dependencies_per_project)
+
+    results = {result.path: result for batch in batches for result in batch}
+    return [results[env_file] for env_file in env_files]
 
 
 def parse_pip_index_overrides(
@@ -260,6 +1049,79 @@ def cli(
             help="If set, environment will not be created/updated before annotations are added.",
         ),
     ] = False,
+    jobs: Annotated[
+        int,
+        typer.Option(
+            help="The maximum number of project directories for which to set up and list environments concurrently",
+        ),
+    ] = 1,
+    cache_dir: Annotated[
+        Optional[Path],
+        typer.Option(
+            help="If set, the installed packages of each environment are cached in this directory, and environment creation is skipped while the environment files are unchanged",
+        ),
+    ] = None,
+    check: Annotated[
+        bool,
+        typer.Option(
+            "--check",
+            help="If set, files are not modified. Instead, a JSON report of the changes that would be made is printed, and the exit code is non-zero if any file would change.",
+        ),
+    ] = False,
+    lockfile: Annotated[
+        Optional[str],
+        typer.Option(
+            help="If set, dependencies are read from this lock file in each project directory (conda-lock.yml, @EXPLICIT or `conda env export --json`), instead of from a live environment",
+        ),
+    ] = None,
+    timings: Annotated[
+        bool,
+        typer.Option(
+            "--timings",
+            envvar=TIMINGS_ENV_VAR,
+            help="If set, the wall time spent in each stage of each project is recorded, and a summary table is printed to stderr",
+        ),
+    ] = False,
+    trace_file: Annotated[
+        Optional[Path],
+        typer.Option(
+            envvar=TRACE_FILE_ENV_VAR,
+            help="If set, the recorded timings are written to this file in the Chrome trace-event format, which can be viewed as a flame chart. Implies --timings.",
+        ),
+    ] = None,
+    daemon_socket: Annotated[
+        Optional[Path],
+        typer.Option(
+            envvar=SOCKET_ENV_VAR,
+            help="If set, the installed packages are requested from a daemon listening on this Unix socket, falling back to loading them directly if it isn't running",
+        ),
+    ] = None,
+    template_dir: Annotated[
+        Optional[Path],
+        typer.Option(
+            envvar=TEMPLATE_DIR_ENV_VAR,
+            help="If set, each prefix-based environment is saved as a template in this directory once created from scratch, and cloned from it instead of running the create command while its environment files are unchanged. Otherwise, the closest template is cloned and updated by the create command.",
+        ),
+    ] = None,
+    template_max_count: Annotated[
+        int,
+        typer.Option(
+            help="The maximum number of templates to keep in --template-dir, evicting the least recently used",
+        ),
+    ] = DEFAULT_TEMPLATES_MAX_COUNT,
+    command_timeout: Annotated[
+        Optional[float],
+        typer.Option(
+            help="If set, the maximum time in seconds for each create command and `conda list`. Commands which time out are terminated, along with any processes they started.",
+        ),
+    ] = None,
+    progress: Annotated[
+        bool,
+        typer.Option(
+            "--progress",
+            help="If set, the output of each create command is printed to stderr as it arrives, prefixed with its project directory",
+        ),
+    ] = False,
 ) -> None:
     """Generate Renovate comments for a list of `conda` environment files.
 
@@ -285,14 +1147,53 @@ def cli(
     # Group into a list of parent directories. This prevents us from running
     # `make setup` for each file, and only once per project.
     project_dirs = sorted({env_file.parent for env_file in env_files})
-    for project_dir in project_dirs:
-        deps = load_dependencies(
-            project_dir,
-            create_command=create_command if not disable_environment_creation else None,
-            environment_selector=environment_selector,
-        )
+    recorder = Timings() if timings or trace_file is not None else None
+    report: dict[str, list[LineChange]] = {}
+    for project_dir, deps in iter_project_dependencies(
+        project_dirs,
+        create_command=create_command if not disable_environment_creation else None,
+        environment_selector=environment_selector,
+        jobs=jobs,
+        cache_dir=cache_dir,
+        lockfile=lockfile,
+        daemon_socket=daemon_socket,
+        templates=(
+            EnvironmentTemplates(template_dir, max_count=template_max_count)
+            if template_dir is not None
+            else None
+        ),
+        command_timeout=command_timeout,
+        progress=progress,
+        timings=recorder,
+    ):
         project_env_files = (e for e in env_files if e.parent == project_dir)
         for env_file in project_env_files:
-            add_comments_to_env_file(
-                env_file, deps, pip_index_overrides=pip_index_overrides
+            changes = add_comments_to_env_file(
+                env_file,
+                deps,
+                pip_index_overrides=pip_index_overrides,
+                dry_run=check,
+                streaming=env_file.stat().st_size > STREAMING_THRESHOLD_BYTES,
+                timings=recorder,
             )
+            if changes:
+                report[str(env_file)] = changes
+
+    if recorder is not None:
+        # Use stderr, to keep the output of --check machine-readable
+        typer.echo(recorder.summary_table(), err=True)
+        if trace_file is not None:
+            recorder.write_chrome_trace(trace_file)
+
+    if check:
+        print(
+            json.dumps(
+                [
+                    {"path": path, "changes": [c.to_dict() for c in report[path]]}
+                    for path in sorted(report)
+                ],
+                indent=2,
+            )
+        )
+        if report:
+            raise typer.Exit(1)
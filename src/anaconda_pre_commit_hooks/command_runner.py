@@ -0,0 +1,221 @@
+"""Run commands with their output streamed into bounded buffers.
+
+Create commands such as `make setup` can log hundreds of MB while solving an environment.
+Rather than buffering all of it, as `subprocess.run(..., capture_output=True)` does, output is
+read as it arrives, passed line by line to an optional callback, and only the last lines of
+each stream are kept, to be shown if the command fails.
+
+Commands run in a new process group, so that on timeout (or cancellation) the whole tree of
+processes they started is terminated, instead of being left behind holding locks on the
+environment.
+
+The commands run on asyncio, so that several of them can be multiplexed from one event loop
+with `run_command_async`. `run_command` is a synchronous wrapper, which runs its own event loop.
+It can be called from any thread: if the thread already runs an event loop, e.g. when called
+from async code, its own loop runs on a worker thread instead.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+from collections import deque
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from typing import Optional, Union
+
+# The number of lines kept from the end of each output stream
+DEFAULT_TAIL_LINES = 200
+
+# The maximum length of a single line, beyond which it is split
+MAX_LINE_BYTES = 64 * 1024
+
+# How long to wait for a process group to exit after SIGTERM, before killing it
+TERMINATE_GRACE_PERIOD = 5.0
+
+_READ_CHUNK_BYTES = 64 * 1024
+
+# Called with the name of the stream ("stdout" or "stderr") and each line of output
+OutputCallback = Callable[[str, str], None]
+
+
+class _StreamOutput:
+    """The output of a stream, either in full or only its last lines."""
+
+    __slots__ = ("lines", "omitted")
+
+    def __init__(self, max_lines: Optional[int]) -> None:
+        self.lines: Union[deque[str], list[str]] = (
+            deque(maxlen=max_lines) if max_lines is not None else []
+        )
+        self.omitted = 0
+
+    def append(self, line: str) -> None:
+        if isinstance(self.lines, deque) and len(self.lines) == self.lines.maxlen:
+            self.omitted += 1
+        self.lines.append(line)
+
+    def text(self) -> str:
+        text = "".join(self.lines)
+        if self.omitted:
+            return f"[... {self.omitted} earlier lines omitted ...]\n{text}"
+        return text
+
+
+async def _pump(
+    stream: asyncio.StreamReader,
+    name: str,
+    output: _StreamOutput,
+    on_line: Optional[OutputCallback],
+) -> None:
+    def emit(data: bytes) -> None:
+        line = data.decode(errors="replace")
+        output.append(line)
+        if on_line is not None:
+            on_line(name, line)
+
+    partial = b""
+    while True:
+        chunk = await stream.read(_READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        *lines, partial = (partial + chunk).split(b"\n")
+        for data in lines:
+            emit(data + b"\n")
+        while len(partial) > MAX_LINE_BYTES:
+            emit(partial[:MAX_LINE_BYTES])
+            partial = partial[MAX_LINE_BYTES:]
+    if partial:
+        emit(partial)
+
+
+async def _terminate(process: asyncio.subprocess.Process) -> None:
+    """Terminate a process and its process group, killing them if they don't exit in time."""
+
+    def send(sig: signal.Signals) -> None:
+        try:
+            if os.name == "posix":
+                os.killpg(process.pid, sig)
+            else:  # pragma: nocover
+                process.kill()
+        except ProcessLookupError:
+            pass
+
+    send(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATE_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        send(signal.SIGKILL)
+        await process.wait()
+
+
+async def run_command_async(
+    args: Sequence[str],
+    *,
+    cwd: Optional[Path] = None,
+    timeout: Optional[float] = None,
+    on_line: Optional[OutputCallback] = None,
+    tail_lines: int = DEFAULT_TAIL_LINES,
+    keep_stdout: bool = False,
+) -> subprocess.CompletedProcess:
+    """Run a command, streaming its output.
+
+    Args:
+        args: The command and its arguments.
+        cwd: The working directory of the command.
+        timeout: The maximum time in seconds to wait for the command, or None to wait forever.
+        on_line: If provided, called with each line of output as it arrives.
+        tail_lines: The number of lines to keep from the end of each stream.
+        keep_stdout: If set, stdout is kept in full, e.g. to parse it, instead of only its tail.
+
+    Returns:
+        The completed process. Its stdout and stderr are the kept output, as text.
+
+    Raises:
+        subprocess.TimeoutExpired: If the command didn't finish in time. It is terminated,
+            along with all processes in its process group.
+
+    """
+    stdout = _StreamOutput(None if keep_stdout else tail_lines)
+    stderr = _StreamOutput(tail_lines)
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=os.name == "posix",
+    )
+    assert process.stdout is not None and process.stderr is not None
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _pump(process.stdout, "stdout", stdout, on_line),
+                _pump(process.stderr, "stderr", stderr, on_line),
+                process.wait(),
+            ),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        await _terminate(process)
+        raise subprocess.TimeoutExpired(
+            list(args), timeout or 0, output=stdout.text(), stderr=stderr.text()
+        ) from None
+    except BaseException:
+        # E.g. cancelled by the caller, which must not leave the command running
+        await _terminate(process)
+        raise
+
+    assert process.returncode is not None
+    return subprocess.CompletedProcess(
+        list(args), process.returncode, stdout.text(), stderr.text()
+    )
+
+
+def run_command(
+    args: Sequence[str],
+    *,
+    cwd: Optional[Path] = None,
+    timeout: Optional[float] = None,
+    on_line: Optional[OutputCallback] = None,
+    tail_lines: int = DEFAULT_TAIL_LINES,
+    keep_stdout: bool = False,
+) -> subprocess.CompletedProcess:
+    """Run a command, streaming its output, in a new event loop. See `run_command_async`."""
+
+    def run() -> subprocess.CompletedProcess:
+        return asyncio.run(
+            run_command_async(
+                args,
+                cwd=cwd,
+                timeout=timeout,
+                on_line=on_line,
+                tail_lines=tail_lines,
+                keep_stdout=keep_stdout,
+            )
+        )
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return run()
+
+    # Event loops can't be nested, so block the running loop like subprocess.run would
+    outcome: list[Union[subprocess.CompletedProcess, BaseException]] = []
+
+    def run_in_thread() -> None:
+        try:
+            outcome.append(run())
+        except BaseException as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=run_in_thread, name="run_command")
+    thread.start()
+    thread.join()
+    if isinstance(outcome[0], BaseException):
+        raise outcome[0]
+    return outcome[0]
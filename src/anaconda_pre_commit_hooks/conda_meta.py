@@ -0,0 +1,221 @@
+"""Read the packages installed in a conda prefix directly from disk.
+
+This produces the same records as `conda list --prefix <prefix> --json`, without paying the
+startup cost of the `conda` CLI. Only the common layouts are supported. Whenever the prefix
+looks unusual, `None` is returned, and callers are expected to fall back to `conda list`.
+
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import shlex
+from pathlib import Path
+
+# Channel URL prefixes which conda strips when displaying a channel's canonical name
+CANONICAL_CHANNEL_URL_PREFIXES = (
+    "https://conda.anaconda.org/",
+    "https://repo.anaconda.com/",
+)
+
+# The platform subdirectories known to conda, which are stripped from channel URLs
+KNOWN_SUBDIRS = frozenset(
+    {
+        "noarch",
+        "emscripten-wasm32",
+        "wasi-wasm32",
+        "freebsd-64",
+        "linux-32",
+        "linux-64",
+        "linux-aarch64",
+        "linux-armv6l",
+        "linux-armv7l",
+        "linux-ppc64",
+        "linux-ppc64le",
+        "linux-riscv64",
+        "linux-s390x",
+        "osx-64",
+        "osx-arm64",
+        "win-32",
+        "win-64",
+        "win-arm64",
+        "zos-z",
+    }
+)
+
+# Matches the metadata directory of a python distribution installed into site-packages
+SITE_PACKAGES_ANCHOR_RE = re.compile(
+    r"^(?:lib/python[^/]+|Lib)/site-packages/([^/]+\.(?:dist-info|egg-info))(?:/|$)"
+)
+
+
+def parse_prefix_selector(environment_selector: str) -> str | None:
+    """Extract the prefix path from a prefix-based environment selector.
+
+    Returns:
+        The prefix path, or None if the selector refers to a named environment or can't be parsed.
+
+    """
+    args = shlex.split(environment_selector)
+    if len(args) == 2 and args[0] in ("-p", "--prefix"):
+        return args[1]
+    if len(args) == 1 and args[0].startswith("--prefix="):
+        return args[0].partition("=")[2]
+    return None
+
+
+def parse_name_selector(environment_selector: str) -> str | None:
+    """Extract the environment name from a named environment selector.
+
+    Returns:
+        The environment name, or None if the selector is prefix-based or can't be parsed.
+
+    """
+    args = shlex.split(environment_selector)
+    if len(args) == 2 and args[0] in ("-n", "--name"):
+        return args[1]
+    if len(args) == 1 and args[0].startswith("--name="):
+        return args[0].partition("=")[2]
+    return None
+
+
+def channel_base_url(channel: str) -> str:
+    """Strip the platform subdirectory from the channel URL stored in a conda-meta record."""
+    channel = channel.rstrip("/")
+    base, _, last = channel.rpartition("/")
+    return base if base and last in KNOWN_SUBDIRS else channel
+
+
+def canonical_channel_name(channel: str) -> str:
+    """Convert the channel URL stored in a conda-meta record to the name shown by `conda list`."""
+    channel = channel_base_url(channel)
+    for url_prefix in CANONICAL_CHANNEL_URL_PREFIXES:
+        if channel.startswith(url_prefix):
+            return channel[len(url_prefix) :]
+    return channel
+
+
+def norm_package_name(name: str) -> str:
+    """Normalize a python distribution name in the same way as conda."""
+    return name.replace(".", "-").replace("_", "-").lower()
+
+
+def _read_metadata_headers(path: Path) -> dict[str, str]:
+    """Read the Name & Version headers from a METADATA or PKG-INFO file."""
+    headers = {}
+    with path.open(encoding="utf-8", errors="replace") as fp:
+        for line in fp:
+            if not line.strip():
+                # The body follows the first blank line
+                break
+            key, sep, value = line.partition(":")
+            if sep and key in ("Name", "Version"):
+                headers[key] = value.strip()
+                if len(headers) == 2:
+                    break
+    return headers
+
+
+def _find_site_packages(prefix: Path) -> Path | None:
+    candidates = [
+        *prefix.glob("lib/python*/site-packages"),
+        prefix / "Lib" / "site-packages",
+    ]
+    candidates = [c for c in candidates if c.is_dir()]
+    if len(candidates) != 1:
+        return None
+    return candidates[0]
+
+
+def read_conda_meta_packages(prefix: Path) -> list[dict] | None:
+    """Load the list of installed packages from the conda-meta directory and site-packages.
+
+    Args:
+        prefix: The path to the conda environment.
+
+    Returns:
+        A list of package records, in the same format as `conda list --json`, or None if the
+        layout of the prefix isn't supported.
+
+    """
+    conda_meta_dir = prefix / "conda-meta"
+    if not conda_meta_dir.is_dir():
+        return None
+
+    packages = []
+    conda_anchors = set()
+    has_python = False
+    for record_path in sorted(conda_meta_dir.glob("*.json")):
+        try:
+            with record_path.open() as fp:
+                record = json.load(fp)
+            name, version, build = record["name"], record["version"], record["build"]
+            # Without a channel, e.g. for local builds, conda list knows more than we do
+            channel_url = record["channel"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        packages.append(
+            {
+                "base_url": channel_base_url(channel_url),
+                "build_number": record.get("build_number", 0),
+                "build_string": build,
+                "channel": canonical_channel_name(channel_url),
+                "dist_name": f"{name}-{version}-{build}",
+                "name": name,
+                "platform": record.get("subdir", ""),
+                "version": version,
+            }
+        )
+        has_python = has_python or name == "python"
+        for file in record.get("files", ()):
+            if m := SITE_PACKAGES_ANCHOR_RE.match(file):
+                conda_anchors.add(m.group(1))
+
+    if not has_python:
+        return packages
+
+    site_packages = _find_site_packages(prefix)
+    if site_packages is None:
+        return None
+
+    for entry in sorted(site_packages.iterdir(), key=lambda p: p.name):
+        if entry.name.endswith((".egg-link", ".egg")):
+            # Development installs are reported with a special channel by conda
+            return None
+        if entry.name in conda_anchors:
+            conda_anchors.discard(entry.name)
+            continue
+        if entry.name.endswith(".dist-info"):
+            metadata_path = entry / "METADATA"
+        elif entry.name.endswith(".egg-info"):
+            metadata_path = entry / "PKG-INFO" if entry.is_dir() else entry
+        else:
+            continue
+        try:
+            headers = _read_metadata_headers(metadata_path)
+        except OSError:
+            # Broken distributions are also skipped by conda
+            continue
+        if "Name" not in headers or "Version" not in headers:
+            return None
+        name = norm_package_name(headers["Name"])
+        packages.append(
+            {
+                "base_url": "https://conda.anaconda.org/pypi",
+                "build_number": 0,
+                "build_string": "pypi_0",
+                "channel": "pypi",
+                "dist_name": f"{name}-{headers['Version']}-pypi_0",
+                "name": name,
+                "platform": "pypi",
+                "version": headers["Version"],
+            }
+        )
+
+    if conda_anchors:
+        # Some conda-managed python packages were overwritten, which conda resolves specially
+        return None
+
+    return packages
@@ -0,0 +1,333 @@
+"""A long-running local server which keeps the installed packages of each project warm.
+
+generate-renovate-annotations must normally run the create command and list the packages of
+each environment on every invocation. The daemon keeps the package list of each project in
+memory instead, and only loads it again once the environment may have changed, as detected
+by a change to the environment input files of the project or to the `conda-meta` directory of
+the environment. Named environments are resolved to their prefix with `conda info`, and
+environments which can't be resolved to a prefix aren't cached.
+
+The CLI talks to the daemon over a Unix socket, sending a single JSON request per line and
+receiving JSON responses, one per line. While the packages are being loaded, the daemon sends
+a heartbeat response every few seconds, and the CLI keeps waiting for as long as they arrive,
+so that it never runs the create command in the same environment concurrently. If the daemon
+isn't running, stops responding, or fails to load the packages, e.g. because a command timed
+out, the CLI falls back to loading them itself.
+
+Usage:
+
+    generate-renovate-annotations-daemon --socket ~/.cache/renovate-annotations.sock \
+        --command-timeout 1800
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+
+from anaconda_pre_commit_hooks.add_renovate_annotations import (
+    SOCKET_ENV_VAR,
+    environment_input_files,
+    list_packages_in_conda_environment,
+    setup_conda_environment,
+)
+from anaconda_pre_commit_hooks.command_runner import run_command
+from anaconda_pre_commit_hooks.conda_meta import (
+    parse_name_selector,
+    parse_prefix_selector,
+)
+
+# How often the daemon tells a waiting client that it is still loading the packages
+HEARTBEAT_INTERVAL = 5.0
+
+# How long a client waits for any response from the daemon before loading the packages itself
+DEFAULT_CLIENT_TIMEOUT = 30.0
+
+Signature = tuple[tuple[str, int, int], ...]
+
+
+class CacheKey(NamedTuple):
+    project_directory: str
+    create_command: Optional[str]
+    environment_selector: str
+    shared_with: tuple[str, ...] = ()
+
+
+class CacheEntry(NamedTuple):
+    signature: Signature
+    packages: list[dict]
+    prefix: Path
+
+
+def find_named_environment(conda_info: dict[str, Any], name: str) -> Optional[Path]:
+    """Find the prefix of a named environment in the output of `conda info --json`."""
+    if name in ("base", "root"):
+        return Path(conda_info["root_prefix"])
+    envs_dirs = {Path(d) for d in conda_info.get("envs_dirs", ())}
+    for env in map(Path, conda_info.get("envs", ())):
+        if env.name == name and env.parent in envs_dirs:
+            return env
+    return None
+
+
+def environment_prefix(
+    project_directory: Path,
+    environment_selector: str,
+    *,
+    timeout: Optional[float] = None,
+) -> Optional[Path]:
+    """Resolve the prefix of the environment selected from a project directory, if possible."""
+    prefix = parse_prefix_selector(environment_selector)
+    if prefix is not None:
+        return project_directory / Path(prefix).expanduser()
+    name = parse_name_selector(environment_selector)
+    if name is None:
+        return None
+    result = run_command(["conda", "info", "--json"], timeout=timeout, keep_stdout=True)
+    if result.returncode != 0:
+        return None
+    try:
+        return find_named_environment(json.loads(result.stdout), name)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def environment_signature(
+    project_directory: Path,
+    prefix: Path,
+    shared_with: Sequence[Path] = (),
+) -> Signature:
+    """Return a snapshot of the files whose changes may change the environment of a project.
+
+    These are the environment input files of the project and of the project directories in
+    `shared_with`, which share its environment, and the `conda-meta` directory of the prefix
+    and its `history` file, which conda updates on every change to the environment.
+
+    """
+    paths = [
+        path
+        for directory in [project_directory, *shared_with]
+        for path in environment_input_files(directory)
+    ]
+    conda_meta = prefix / "conda-meta"
+    paths += [conda_meta, conda_meta / "history"]
+
+    signature = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            signature.append((str(path), -1, -1))
+        else:
+            signature.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class PackageCache:
+    """The package lists of each project, reloaded when their signature changes.
+
+    Each command run to load the packages is terminated after `command_timeout` seconds.
+
+    """
+
+    def __init__(self, command_timeout: Optional[float] = None) -> None:
+        self.command_timeout = command_timeout
+        self._entries: dict[CacheKey, CacheEntry] = {}
+        self._locks: dict[CacheKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: CacheKey) -> list[dict]:
+        # Requests for the same project wait for each other, instead of loading it twice
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            project_directory = Path(key.project_directory)
+            shared_with = [Path(p) for p in key.shared_with]
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.signature == environment_signature(
+                project_directory, entry.prefix, shared_with
+            ):
+                self._entries[key] = entry
+                return entry.packages
+
+            if key.create_command is not None:
+                setup_conda_environment(
+                    key.create_command,
+                    cwd=project_directory,
+                    timeout=self.command_timeout,
+                )
+            packages = list_packages_in_conda_environment(
+                key.environment_selector,
+                cwd=project_directory,
+                timeout=self.command_timeout,
+            )
+            prefix = environment_prefix(
+                project_directory,
+                key.environment_selector,
+                timeout=self.command_timeout,
+            )
+            # Without a prefix, changes to the environment can't be detected
+            if prefix is not None:
+                # Take the signature after loading, since the create command may change the environment
+                signature = environment_signature(
+                    project_directory, prefix, shared_with
+                )
+                self._entries[key] = CacheEntry(signature, packages, prefix)
+            return packages
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: DaemonServer
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            # The client disconnected, e.g. another daemon checking whether we are running
+            return
+
+        try:
+            request = json.loads(line)
+            key = CacheKey(
+                project_directory=request["project_directory"],
+                create_command=request["create_command"],
+                environment_selector=request["environment_selector"],
+                shared_with=tuple(request.get("shared_with", ())),
+            )
+        except Exception as e:
+            self._respond({"error": f"{type(e).__name__}: {e}"})
+            return
+
+        responses: list[dict[str, Any]] = []
+        worker = threading.Thread(target=self._load, args=(key, responses), daemon=True)
+        worker.start()
+        worker.join(HEARTBEAT_INTERVAL)
+        while worker.is_alive():
+            if not self._respond({"status": "working"}):
+                # The packages are still cached for the next request
+                return
+            worker.join(HEARTBEAT_INTERVAL)
+        self._respond(responses[0])
+
+    def _load(self, key: CacheKey, responses: list[dict[str, Any]]) -> None:
+        try:
+            responses.append({"packages": self.server.package_cache.get(key)})
+        except Exception as e:
+            responses.append({"error": f"{type(e).__name__}: {e}"})
+
+    def _respond(self, response: dict[str, Any]) -> bool:
+        """Send a response, returning whether the client is still connected."""
+        try:
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting, and will load the packages itself
+            return False
+        return True
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self, socket_path: Path, *, command_timeout: Optional[float] = None
+    ) -> None:
+        self.package_cache = PackageCache(command_timeout)
+        super().__init__(str(socket_path), _RequestHandler)
+
+
+def request_packages(
+    socket_path: Path,
+    project_directory: Path,
+    create_command: Optional[str],
+    environment_selector: str,
+    *,
+    shared_with: Sequence[Path] = (),
+    timeout: float = DEFAULT_CLIENT_TIMEOUT,
+) -> Optional[list[dict]]:
+    """Ask the daemon for the installed packages of a project.
+
+    The environment input files of the project directories in `shared_with`, which share the
+    environment of the project, are watched by the daemon too. The daemon is waited for as long
+    as it keeps sending heartbeats, and at most `timeout` seconds between them.
+
+    Returns:
+        The same list of packages as `conda list --json`, or None if the daemon isn't
+        running or failed to load the packages.
+
+    """
+    request = {
+        "project_directory": str(project_directory.resolve()),
+        "create_command": create_command,
+        "environment_selector": environment_selector,
+        "shared_with": [str(p.resolve()) for p in shared_with],
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(socket_path))
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            with sock.makefile("rb") as fp:
+                response = json.loads(fp.readline())
+                while response.get("status") == "working":
+                    response = json.loads(fp.readline())
+    except (OSError, ValueError):
+        return None
+    return response.get("packages")
+
+
+def serve(socket_path: Path, *, command_timeout: Optional[float] = None) -> None:
+    """Serve requests on a Unix socket until interrupted or terminated."""
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+    # Remove a socket left behind by a previous daemon, unless it is still running
+    if socket_path.exists():
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(socket_path))
+            except OSError:
+                socket_path.unlink()
+            else:
+                raise SystemExit(f"A daemon is already listening on {socket_path}")
+
+    # Exit cleanly on SIGTERM too, so that the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with DaemonServer(socket_path, command_timeout=command_timeout) as server:
+        os.chmod(socket_path, 0o600)
+        print(f"Listening on {socket_path}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        default=os.environ.get(SOCKET_ENV_VAR),
+        required=SOCKET_ENV_VAR not in os.environ,
+        help=f"The path of the Unix socket to listen on. Defaults to ${SOCKET_ENV_VAR}.",
+    )
+    parser.add_argument(
+        "--command-timeout",
+        type=float,
+        help="If set, the maximum time in seconds for each create command and `conda list`. Commands which time out are terminated, and the request fails.",
+    )
+    args = parser.parse_args(argv)
+    serve(args.socket, command_timeout=args.command_timeout)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,151 @@
+"""An index of the packages installed in an environment.
+
+Names are normalised once, when the index is built, so that looking up a dependency spec from
+an environment file costs a single dictionary lookup. pip names are compared as per PEP 503,
+i.e. case-insensitively and treating runs of `.`, `_` and `-` as equivalent. conda names are
+only compared case-insensitively, since e.g. `typing_extensions` and `typing-extensions` are
+distinct conda packages.
+
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from collections.abc import Iterable, Mapping
+from typing import Any, Union
+
+# Runs of separators which PEP 503 treats as equivalent
+NAME_SEPARATORS_RE = re.compile(r"[-_.]+")
+
+# Bumped whenever the serialised format changes, so that stale cache files are ignored
+SERIALIZATION_VERSION = 1
+
+
+def canonical_name(name: str) -> str:
+    """Normalise a package name as per PEP 503."""
+    return NAME_SEPARATORS_RE.sub("-", name).lower()
+
+
+def strip_extras(name: str) -> str:
+    """Remove the extras from a package name, e.g. `requests[socks]` -> `requests`."""
+    return name.partition("[")[0]
+
+
+class Dependency:
+    """A package installed in an environment."""
+
+    __slots__ = ("name", "channel", "version")
+
+    def __init__(self, name: str, channel: str, version: str) -> None:
+        self.name = name
+        self.channel = channel
+        self.version = version
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Dependency):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    def __hash__(self) -> int:
+        return hash(self._astuple())
+
+    def __repr__(self) -> str:
+        return f"Dependency(name={self.name!r}, channel={self.channel!r}, version={self.version!r})"
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return (Dependency, self._astuple())
+
+    def _astuple(self) -> tuple[str, str, str]:
+        return (self.name, self.channel, self.version)
+
+
+DependencyRecords = Union[Mapping[str, Dependency], Iterable[Dependency]]
+
+
+def _records(dependencies: DependencyRecords) -> Iterable[Dependency]:
+    if isinstance(dependencies, Mapping):
+        return dependencies.values()
+    return dependencies
+
+
+class Dependencies:
+    """The pip & conda packages installed in an environment, indexed by name and channel.
+
+    Attributes:
+        pip: The pip packages, keyed by their canonical name.
+        conda: The conda packages, keyed by their lowercase name.
+
+    """
+
+    __slots__ = ("pip", "conda", "_by_channel")
+
+    def __init__(self, pip: DependencyRecords, conda: DependencyRecords) -> None:
+        self.pip: dict[str, Dependency] = {
+            canonical_name(dep.name): dep for dep in _records(pip)
+        }
+        self.conda: dict[str, Dependency] = {
+            dep.name.lower(): dep for dep in _records(conda)
+        }
+        self._by_channel: dict[str, list[Dependency]] = {}
+        for dep in self.conda.values():
+            self._by_channel.setdefault(dep.channel, []).append(dep)
+        for dep in self.pip.values():
+            self._by_channel.setdefault(dep.channel, []).append(dep)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Dependencies):
+            return NotImplemented
+        return self.pip == other.pip and self.conda == other.conda
+
+    def __len__(self) -> int:
+        return len(self.pip) + len(self.conda)
+
+    def __repr__(self) -> str:
+        return f"Dependencies(pip={self.pip!r}, conda={self.conda!r})"
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # Only pickle the records, the indexes are cheaper to rebuild than to transfer
+        return (Dependencies, (list(self.pip.values()), list(self.conda.values())))
+
+    def find_pip(self, name: str) -> Dependency | None:
+        """Look up a pip package by any spelling of its name, with or without extras."""
+        return self.pip.get(canonical_name(strip_extras(name)))
+
+    def find_conda(self, name: str) -> Dependency | None:
+        """Look up a conda package by its exact, case-insensitive, name."""
+        return self.conda.get(strip_extras(name).lower())
+
+    def in_channel(self, channel: str) -> list[Dependency]:
+        """Return the packages installed from a channel, e.g. `main` or `pypi`."""
+        return list(self._by_channel.get(channel, ()))
+
+    def to_json(self) -> str:
+        """Serialise the dependencies, e.g. to store them in a cache file."""
+        return json.dumps(
+            {
+                "version": SERIALIZATION_VERSION,
+                "pip": [dep._astuple() for dep in self.pip.values()],
+                "conda": [dep._astuple() for dep in self.conda.values()],
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, text: str) -> Dependencies:
+        """Load dependencies serialised by `to_json`.
+
+        Raises:
+            ValueError: If the text isn't valid or was written in another format.
+
+        """
+        data = json.loads(text)
+        if not isinstance(data, dict) or data.get("version") != SERIALIZATION_VERSION:
+            raise ValueError("Unsupported serialisation format")
+        try:
+            return cls(
+                pip=[Dependency(*row) for row in data["pip"]],
+                conda=[Dependency(*row) for row in data["conda"]],
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Malformed dependencies: {e}") from e
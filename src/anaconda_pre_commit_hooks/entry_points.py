@@ -0,0 +1,48 @@
+"""Lightweight console script entry points.
+
+pre-commit invokes the hooks many times per commit, so this module must stay cheap to import.
+The CLI of generate-renovate-annotations is built with typer, which is slow to import, so it
+is only imported once we know there is work to do.
+
+"""
+
+import sys
+from collections.abc import Sequence
+
+# The options of generate-renovate-annotations which don't take a value
+GENERATE_RENOVATE_ANNOTATIONS_FLAGS = frozenset(
+    {"--disable-environment-creation", "--check", "--timings", "--progress"}
+)
+
+
+def has_positional_args(args: Sequence[str], flags: frozenset[str]) -> bool:
+    """Check whether the arguments contain any positional arguments, i.e. filenames.
+
+    Any option other than the given flags is assumed to take a value, unless it is passed
+    as `--option=value`. Unknown short options count as positional, so that the real parser
+    gets to report them.
+
+    """
+    args_iter = iter(args)
+    for arg in args_iter:
+        if arg == "--":
+            return next(args_iter, None) is not None
+        if arg.startswith("--"):
+            if arg not in flags and "=" not in arg:
+                next(args_iter, None)
+        else:
+            return True
+    return False
+
+
+def generate_renovate_annotations() -> None:
+    """Run generate-renovate-annotations, exiting early when no files are passed."""
+    args = sys.argv[1:]
+    # Without any arguments, the CLI shows its help
+    if args and "--help" not in args:
+        if not has_positional_args(args, GENERATE_RENOVATE_ANNOTATIONS_FLAGS):
+            return
+
+    from anaconda_pre_commit_hooks.add_renovate_annotations import app
+
+    app()
@@ -0,0 +1,194 @@
+"""Template environments, from which missing project environments are cloned.
+
+Creating an environment from scratch means solving it and linking all of its packages, which
+can take minutes, e.g. on a CI runner with a cold disk. Once the create command of a project has
+created its prefix from scratch, the prefix is cloned into the template directory, keyed by
+`environment_cache_key`. The next time the prefix is missing with the same inputs, e.g. in a
+fresh checkout at the same location, it is cloned from the template with `conda create --clone`
+instead, which hardlinks the packages from the package cache without solving, and the create
+command is skipped.
+
+Projects often share most of their dependencies. If there is no template with the same key,
+the template whose features (e.g. dependency specs) overlap the most with those of the project
+is cloned instead, so that the create command only needs to update it with the difference.
+As it may belong to another project, e.g. with an editable install of that project, the create
+command always runs, and the result isn't saved as a template.
+
+Only the most recently used templates are kept. A template is only used once it is complete,
+as marked by a `<key>.ready` file next to it, which contains its features, and whose
+modification time records its last use.
+
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import subprocess
+import time
+from collections.abc import Collection, Iterable
+from pathlib import Path
+
+DEFAULT_TEMPLATES_MAX_COUNT = 5
+
+# Templates which are still locked after this long were left behind by a crashed run
+STALE_LOCK_AGE = 24 * 60 * 60
+
+
+def clone_environment(source: Path, target: Path) -> bool:
+    """Clone the environment in one prefix into another, new, prefix.
+
+    Returns:
+        Whether the clone succeeded.
+
+    """
+    result = subprocess.run(
+        [
+            "conda",
+            "create",
+            "--clone",
+            str(source),
+            "--prefix",
+            str(target),
+            "--offline",
+            "--yes",
+            "--quiet",
+        ],
+        capture_output=True,
+        text=True,
+    )
+    return result.returncode == 0
+
+
+class EnvironmentTemplates:
+    """A directory of template environments, evicted in order of least recent use."""
+
+    def __init__(
+        self, directory: Path, *, max_count: int = DEFAULT_TEMPLATES_MAX_COUNT
+    ) -> None:
+        self.directory = directory
+        self.max_count = max_count
+
+    def _template(self, key: str) -> Path:
+        return self.directory / key
+
+    def _marker(self, key: str) -> Path:
+        return self.directory / f"{key}.ready"
+
+    def _lock(self, key: str) -> Path:
+        return self.directory / f"{key}.lock"
+
+    def _features(self, key: str) -> frozenset[str]:
+        try:
+            return frozenset(json.loads(self._marker(key).read_text())["features"])
+        except (OSError, ValueError, KeyError, TypeError):
+            # Markers written without features are only restored by their key
+            return frozenset()
+
+    def restore(self, key: str, prefix: Path) -> bool:
+        """Clone the template with the given key into a prefix, unless the prefix exists.
+
+        Returns:
+            Whether the prefix was restored. If not, the environment must be created as usual.
+
+        """
+        if prefix.exists() or not self._marker(key).exists():
+            return False
+        return self._clone_template(key, prefix)
+
+    def restore_closest(self, features: Collection[str], prefix: Path) -> str | None:
+        """Clone the template most similar to an environment into a prefix, unless it exists.
+
+        The similarity of two environments is the Jaccard index of their features. Ties are
+        broken in favour of the most recently used template.
+
+        Returns:
+            The key of the restored template, if any. The environment must then be updated
+            to match its own inputs.
+
+        """
+        if prefix.exists() or not features or not self.directory.is_dir():
+            return None
+        features = frozenset(features)
+        best_key, best_score = None, (0.0, 0.0)
+        for marker in self.directory.glob("*.ready"):
+            template_features = self._features(marker.stem)
+            try:
+                score = (
+                    len(features & template_features)
+                    / len(features | template_features),
+                    marker.stat().st_mtime,
+                )
+            except OSError:
+                continue
+            if score[0] > 0 and score > best_score:
+                best_key, best_score = marker.stem, score
+        if best_key is None or not self._clone_template(best_key, prefix):
+            return None
+        return best_key
+
+    def _clone_template(self, key: str, prefix: Path) -> bool:
+        if not clone_environment(self._template(key), prefix):
+            # Leave the prefix as we found it, i.e. missing, for the create command
+            shutil.rmtree(prefix, ignore_errors=True)
+            return False
+        try:
+            os.utime(self._marker(key))
+        except OSError:
+            pass
+        return True
+
+    def save(self, key: str, prefix: Path, features: Iterable[str] = ()) -> None:
+        """Clone a prefix into the template with the given key, unless it already exists.
+
+        The features of the environment are used to find the closest template for other
+        environments, see `restore_closest`.
+
+        """
+        if self._marker(key).exists() or not prefix.is_dir():
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lock = self._lock(key)
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # Another run is saving the same template
+            return
+
+        template = self._template(key)
+        try:
+            shutil.rmtree(template, ignore_errors=True)
+            if clone_environment(prefix, template):
+                self._marker(key).write_text(json.dumps({"features": sorted(features)}))
+            else:
+                shutil.rmtree(template, ignore_errors=True)
+        finally:
+            lock.unlink(missing_ok=True)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used templates, and any left behind by crashed runs."""
+        if not self.directory.is_dir():
+            return
+        markers = []
+        for marker in self.directory.glob("*.ready"):
+            try:
+                markers.append((marker.stat().st_mtime, marker))
+            except OSError:
+                continue
+        markers.sort()
+        for _, marker in markers[: max(len(markers) - self.max_count, 0)]:
+            # Remove the marker first, so that the template is no longer cloned from
+            marker.unlink(missing_ok=True)
+            shutil.rmtree(self._template(marker.stem), ignore_errors=True)
+
+        now = time.time()
+        for lock in self.directory.glob("*.lock"):
+            try:
+                if now - lock.stat().st_mtime <= STALE_LOCK_AGE:
+                    continue
+            except OSError:
+                continue
+            shutil.rmtree(self._template(lock.stem), ignore_errors=True)
+            lock.unlink(missing_ok=True)
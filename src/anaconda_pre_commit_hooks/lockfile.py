@@ -0,0 +1,154 @@
+"""Read the packages of an environment from a lock file, instead of a live environment.
+
+Three formats are supported, and detected from the contents of the file:
+
+* A `conda-lock.yml` file, as generated by `conda-lock`
+* An explicit spec file, as generated by `conda list --explicit`
+* An environment snapshot, as generated by `conda env export --json`
+
+In all cases, a list of package records is returned, containing the same `name`, `version`
+and `channel` keys as `conda list --json`.
+
+"""
+
+from __future__ import annotations
+
+import json
+import platform
+import re
+import sys
+from pathlib import Path
+
+from anaconda_pre_commit_hooks.conda_meta import (
+    canonical_channel_name,
+    norm_package_name,
+)
+
+# Matches the filename of a conda package, split into name, version & build
+PACKAGE_FILENAME_RE = re.compile(
+    r"^(?P<name>.+)-(?P<version>[^-]+)-(?P<build>[^-]+)\.(?:conda|tar\.bz2)$"
+)
+
+# Matches a pinned pip requirement, as written by `conda env export`
+PIP_REQUIREMENT_RE = re.compile(r"^(?P<name>[\w.\-]+)(?:\[[^\]]*\])?==(?P<version>\S+)")
+
+
+def current_subdir() -> str:
+    """Return the conda platform subdirectory of the running interpreter, e.g. linux-64."""
+    os_name = {"darwin": "osx", "win32": "win"}.get(sys.platform, sys.platform)
+    machine = platform.machine().lower()
+    arch = {
+        "x86_64": "64",
+        "amd64": "64",
+        "arm64": "arm64" if os_name != "linux" else "aarch64",
+        "aarch64": "aarch64" if os_name == "linux" else "arm64",
+    }.get(machine, machine)
+    return f"{os_name}-{arch}"
+
+
+def _record(name: str, version: str, channel: str) -> dict:
+    return {"name": name, "version": version, "channel": channel}
+
+
+def _default_channel(channels: list[str]) -> str:
+    channel = channels[0] if channels else "defaults"
+    return "pkgs/main" if channel == "defaults" else canonical_channel_name(channel)
+
+
+def parse_explicit_file(text: str) -> list[dict]:
+    """Parse the package URLs in an explicit spec file."""
+    packages = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(("#", "@")):
+            continue
+        url = line.partition("#")[0]
+        channel_url, _, filename = url.rpartition("/")
+        m = PACKAGE_FILENAME_RE.match(filename)
+        if m is None:
+            raise ValueError(f"Could not parse package URL: {line}")
+        packages.append(
+            _record(m["name"], m["version"], canonical_channel_name(channel_url))
+        )
+    return packages
+
+
+def parse_environment_export(data: dict) -> list[dict]:
+    """Parse the output of `conda env export --json`.
+
+    An exported environment doesn't record the channel of each package, unless it is given
+    explicitly as `channel::name=version`. Otherwise, the first listed channel is assumed.
+
+    """
+    default_channel = _default_channel(data.get("channels", []))
+    packages = []
+    for spec in data.get("dependencies", []):
+        if isinstance(spec, dict):
+            for requirement in spec.get("pip", []):
+                m = PIP_REQUIREMENT_RE.match(requirement)
+                if m is None:
+                    # Unpinned, editable or URL requirements have no known version
+                    continue
+                packages.append(
+                    _record(norm_package_name(m["name"]), m["version"], "pypi")
+                )
+            continue
+
+        channel, sep, spec = spec.rpartition("::")
+        name, _, rest = spec.partition("=")
+        version = rest.partition("=")[0]
+        packages.append(
+            _record(
+                name,
+                version,
+                canonical_channel_name(channel) if sep else default_channel,
+            )
+        )
+    return packages
+
+
+def parse_conda_lock(data: dict, subdir: str | None = None) -> list[dict]:
+    """Parse a `conda-lock.yml` file, selecting the packages for a single platform.
+
+    Args:
+        data: The loaded contents of the lock file.
+        subdir: The platform to select. Defaults to the current platform if it is locked,
+            otherwise the first locked platform.
+
+    """
+    packages = data.get("package", [])
+    platforms = data.get("metadata", {}).get("platforms") or sorted(
+        {p["platform"] for p in packages}
+    )
+    subdir = subdir or current_subdir()
+    if subdir not in platforms and platforms:
+        subdir = platforms[0]
+
+    records = []
+    for package in packages:
+        if package.get("platform") != subdir:
+            continue
+        if package.get("manager") == "pip":
+            name, channel = norm_package_name(package["name"]), "pypi"
+        else:
+            channel_url = package["url"].rpartition("/")[0]
+            name, channel = package["name"], canonical_channel_name(channel_url)
+        records.append(_record(name, package["version"], channel))
+    return records
+
+
+def read_lockfile_packages(path: Path) -> list[dict]:
+    """Load the list of packages in a lock file, detecting its format from its contents."""
+    # Imported here, since yaml is slow to import and only needed for conda-lock.yml files
+    import yaml
+
+    text = path.read_text()
+    if re.search(r"^@EXPLICIT\s*$", text, flags=re.MULTILINE):
+        return parse_explicit_file(text)
+    if text.lstrip().startswith("{"):
+        return parse_environment_export(json.loads(text))
+
+    data = yaml.safe_load(text)
+    if not isinstance(data, dict) or "package" not in data:
+        raise ValueError(f"Unrecognized lock file format: {path}")
+    return parse_conda_lock(data)
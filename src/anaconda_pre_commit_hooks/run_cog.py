@@ -1,19 +1,323 @@
 from __future__ import annotations
 
 import argparse
+import glob
+import hashlib
+import io
+import mmap
+import os
 import subprocess
-from collections.abc import Sequence
+import tempfile
+import time
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Any
+
+# If set, cog always runs in isolated subprocesses, even if --in-process is passed
+ISOLATED_ENV_VAR = "RUN_COG_ISOLATED"
+
+DEFAULT_CACHE_MAX_SIZE_MB = 64
+DEFAULT_CACHE_MAX_AGE_DAYS = 30.0
+
+# The begin, end and end-output markers of cog, as passed to its --markers option
+DEFAULT_MARKERS = "[[[cog ]]] [[[end]]]"
+
+
+class CogCache:
+    """An on-disk cache of the output of cog for each file, keyed by a hash of its inputs.
+
+    The inputs are the contents and path of the file, the working directory, the version of
+    cog, the markers, and the contents of all files matching a declared list of dependency
+    globs. Cog generators which depend on anything else must not be used with the cache.
+
+    Entries are evicted when they are older than `max_age` seconds, and then in order of
+    least recent use until the cache is smaller than `max_size` bytes.
+
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        dependency_globs: Sequence[str] = (),
+        *,
+        markers: str = DEFAULT_MARKERS,
+        max_size: int = DEFAULT_CACHE_MAX_SIZE_MB * 1024 * 1024,
+        max_age: float = DEFAULT_CACHE_MAX_AGE_DAYS * 24 * 60 * 60,
+    ) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self._base_digest = self._compute_base_digest(dependency_globs, markers)
+
+    @staticmethod
+    def _compute_base_digest(dependency_globs: Sequence[str], markers: str) -> bytes:
+        # Only needed with --cache-dir, and importlib.metadata alone would double the
+        # import time of the hook
+        from importlib.metadata import version
+
+        digest = hashlib.sha256(version("cogapp").encode())
+        digest.update(b"\0" + markers.encode())
+        dependencies = {
+            Path(p)
+            for pattern in dependency_globs
+            for p in glob.glob(pattern, recursive=True)
+        }
+        for path in sorted(p for p in dependencies if p.is_file()):
+            digest.update(b"\0" + path.as_posix().encode() + b"\0")
+            digest.update(path.read_bytes())
+        return digest.digest()
+
+    def key(self, file_path: Path, cwd: Path, content: bytes) -> str:
+        """Compute the cache key of a file with the given content."""
+        digest = hashlib.sha256(self._base_digest)
+        for value in (file_path.resolve().as_posix(), cwd.resolve().as_posix()):
+            digest.update(value.encode() + b"\0")
+        digest.update(content)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        """Return the cached output for a key, marking the entry as recently used."""
+        entry = self.directory / key
+        try:
+            content = entry.read_bytes()
+            os.utime(entry)
+        except OSError:
+            return None
+        return content
+
+    def put(self, key: str, content: bytes) -> None:
+        """Store the output for a key, replacing the entry atomically."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(content)
+            os.replace(tmp_name, self.directory / key)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def evict(self) -> None:
+        """Remove stale entries, and then the least recently used until below the size limit."""
+        if not self.directory.is_dir():
+            return
+        now = time.time()
+        entries = []
+        for entry in self.directory.iterdir():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                entry.unlink(missing_ok=True)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries, key=lambda e: e[0]):
+            if total_size <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total_size -= size
+
+
+def working_directory(file_path: Path, working_directory_level: int) -> Path:
+    """Compute the directory from which cog should be run for a file.
+
+    See `run_cog` for a description of `working_directory_level`.
+
+    """
+    if working_directory_level == 0:
+        return Path.cwd()
+    elif working_directory_level == -1:
+        return file_path.parent
+    else:
+        path_str = file_path.as_posix()
+        elements = path_str.split("/")
+        return Path(*elements[:working_directory_level])
+
+
+def group_by_working_directory(
+    filenames: Sequence[str], working_directory_level: int
+) -> dict[Path, list[Path]]:
+    """Group files by the directory from which cog should be run, preserving their order."""
+    groups: dict[Path, list[Path]] = {}
+    for filename in filenames:
+        file_path = Path(filename)
+        cwd = working_directory(file_path, working_directory_level)
+        groups.setdefault(cwd, []).append(file_path)
+    return groups
+
+
+def has_cog_markers(file_path: Path, markers: Sequence[bytes]) -> bool:
+    """Check whether a file contains any of the cog markers, without reading it into memory.
+
+    Cog leaves files without any markers unchanged, so they can be skipped. Files which can't
+    be scanned are assumed to contain markers, so that cog gets to report the error.
+
+    """
+    try:
+        with file_path.open("rb") as fp:
+            # Empty files can't be memory-mapped
+            if os.fstat(fp.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return any(mm.find(marker) != -1 for marker in markers)
+    except (OSError, ValueError):
+        return True
+
+
+def filter_cog_files(filenames: Sequence[str], markers: str) -> list[str]:
+    """Return the files which contain any cog marker, i.e. the files cog may change."""
+    # The end markers must be searched for too, since cog reports any unexpected ones
+    marker_bytes = [marker.encode() for marker in markers.split()]
+    return [f for f in filenames if has_cog_markers(Path(f), marker_bytes)]
+
+
+def _last_processed_file(output: str, file_paths: Sequence[Path]) -> Path | None:
+    """Find the last file that cog reported processing, which is the one that failed."""
+    by_name = {p.resolve().as_posix(): p for p in file_paths}
+    for line in reversed(output.splitlines()):
+        if line.startswith("Cogging "):
+            name = line[len("Cogging ") :].replace("(changed)", "").strip()
+            if name in by_name:
+                return by_name[name]
+    return None
+
+
+@contextmanager
+def _change_dir(new_dir: Path) -> Iterator[None]:
+    """Change the working directory, and always change back afterwards."""
+    old_dir = os.getcwd()
+    os.chdir(new_dir)
+    try:
+        yield
+    finally:
+        os.chdir(old_dir)
+
+
+def _run_cog_subprocess(
+    cwd: Path, file_paths: Sequence[Path], markers: str = DEFAULT_MARKERS
+) -> tuple[int, str]:
+    """Run cog on a group of files sharing a working directory in a single subprocess.
+
+    Returns:
+        A tuple of cog's exit code, and its captured output.
+
+    """
+    result = subprocess.run(
+        [
+            "cog",
+            "-r",
+            f"--markers={markers}",
+            *(p.resolve().as_posix() for p in file_paths),
+        ],
+        cwd=str(cwd),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    output = result.stdout
+    if result.returncode != 0:
+        failed_file = _last_processed_file(result.stdout, file_paths)
+        if failed_file is not None:
+            output += (
+                f"cog failed on {failed_file} with exit code {result.returncode}\n"
+            )
+    return result.returncode, output
+
+
+_cog_engine = None
+
+
+def _get_cog_engine() -> Any:
+    """Return the cog engine of the current process, creating it on first use.
+
+    A single engine must be shared by all files, since generator modules cached in
+    sys.modules hold a reference to the `cog` module of the engine which imported them.
+
+    """
+    global _cog_engine
+    if _cog_engine is None:
+        from cogapp import Cog
+
+        _cog_engine = Cog()
+    return _cog_engine
+
+
+def _run_cog_in_process(
+    cwd: Path, file_paths: Sequence[Path], markers: str = DEFAULT_MARKERS
+) -> tuple[int, str]:
+    """Run cog on a group of files sharing a working directory within the current interpreter.
+
+    Returns:
+        A tuple of the exit code of the first failure (or zero), and the captured output.
+
+    """
+    cog = _get_cog_engine()
+    output = io.StringIO()
+    cog.set_output(stdout=output, stderr=output)
+
+    # Paths must be resolved before changing directory, since they may be relative
+    resolved_paths = [(p, p.resolve().as_posix()) for p in file_paths]
+    with _change_dir(cwd):
+        for file_path, resolved_path in resolved_paths:
+            return_code = cog.main(["cog", "-r", f"--markers={markers}", resolved_path])
+            if return_code != 0:
+                output.write(
+                    f"cog failed on {file_path} with exit code {return_code}\n"
+                )
+                return return_code, output.getvalue()
+    return 0, output.getvalue()
+
+
+def _split_by_directory(
+    groups: dict[Path, list[Path]],
+) -> list[tuple[Path, list[Path]]]:
+    """Split each group of files further by the directory containing each file."""
+    units: list[tuple[Path, list[Path]]] = []
+    for cwd, file_paths in groups.items():
+        by_directory: dict[Path, list[Path]] = {}
+        for file_path in file_paths:
+            by_directory.setdefault(file_path.parent, []).append(file_path)
+        units.extend((cwd, paths) for paths in by_directory.values())
+    return units
 
 
 def run_cog(
     filenames: Sequence[str],
     working_directory_level: int,
+    *,
+    in_process: bool = False,
+    jobs: int = 1,
+    cache: CogCache | None = None,
+    markers: str = DEFAULT_MARKERS,
+    prefilter: bool = True,
 ) -> int:
     """Execute cog in a subprocess on a sequence of files in rewrite mode.
 
     We wrap cog with a subprocess call so that we can optionally remove parts of the
-    path, which makes it easier to work within a mono-repo.
+    path, which makes it easier to work within a mono-repo. Files are grouped by their
+    working directory, and cog is invoked once for each group. Processing stops at the
+    first failure, whose exit code is returned.
+
+    With `in_process`, cog is instead run within the current interpreter, changing the
+    working directory for each group. This avoids the interpreter startup for each group,
+    and modules imported by the generators are only imported once. However, generators are
+    no longer isolated from each other, so any global state they modify is shared.
+
+    With `jobs > 1`, the groups are further split by the directory containing each file,
+    and these are processed concurrently. Files in the same directory are still processed
+    one after the other, so that generators writing to sibling files don't race. The output
+    of each group is printed in order, and the exit code is that of the first failing group.
+
+    With a `cache`, files whose output is already cached are restored without running cog,
+    and the output of all other files is cached after cog succeeds for their group.
+
+    With `prefilter`, files which don't contain any of the `markers` are skipped up front,
+    since cog would leave them unchanged. They are scanned with a memory-mapped search, so
+    this is much cheaper than passing them to cog.
 
     Args:
         filenames: A list of filenames, passed in from pre-commit.
@@ -24,25 +328,114 @@ def run_cog(
             directory. A value of 0 indicates cog will run from the repo root. A value
             of -1 indicates that cog should run from the parent directory of the file
             being processed.
+        in_process: Whether to run cog within the current interpreter, rather than in
+            isolated subprocesses.
+        jobs: The maximum number of groups of files to process concurrently.
+        cache: An optional cache of cog's output.
+        markers: The begin, end and end-output markers of cog, separated by spaces.
+        prefilter: Whether to skip files which don't contain any markers.
 
     """
+    if prefilter:
+        n_files = len(filenames)
+        filenames = filter_cog_files(filenames, markers)
+        if len(filenames) < n_files:
+            print(
+                f"Skipped {n_files - len(filenames)} file(s) without cog markers",
+                flush=True,
+            )
 
+    if cache is None:
+        return _run_cog_groups(
+            filenames, working_directory_level, in_process, jobs, markers=markers
+        )
+
+    cache_keys = {}
+    uncached_filenames = []
+    n_restored = 0
     for filename in filenames:
         file_path = Path(filename)
-        if working_directory_level == 0:
-            cwd = Path.cwd()
-        elif working_directory_level == -1:
-            cwd = file_path.parent
-        else:
-            path_str = file_path.as_posix()
-            elements = path_str.split("/")
-            cwd = Path(*elements[:working_directory_level])
-
-        result = subprocess.run(
-            ["cog", "-r", file_path.resolve().as_posix()], cwd=str(cwd)
+        cwd = working_directory(file_path, working_directory_level)
+        content = file_path.read_bytes()
+        key = cache.key(file_path, cwd, content)
+        cached_content = cache.get(key)
+        if cached_content is None:
+            cache_keys[file_path] = key
+            uncached_filenames.append(filename)
+            continue
+        if cached_content != content:
+            file_path.write_bytes(cached_content)
+        n_restored += 1
+
+    if n_restored:
+        print(f"Restored the output of {n_restored} file(s) from the cog cache")
+
+    def on_success(cwd: Path, file_paths: Sequence[Path]) -> None:
+        for file_path in file_paths:
+            content = file_path.read_bytes()
+            cache.put(cache_keys[file_path], content)
+            # Cogging the output again should give the same output, so it can be cached too
+            cache.put(cache.key(file_path, cwd, content), content)
+
+    try:
+        return _run_cog_groups(
+            uncached_filenames,
+            working_directory_level,
+            in_process,
+            jobs,
+            markers=markers,
+            on_success=on_success,
         )
-        if result.returncode != 0:
-            return result.returncode
+    finally:
+        cache.evict()
+
+
+def _run_cog_groups(
+    filenames: Sequence[str],
+    working_directory_level: int,
+    in_process: bool,
+    jobs: int,
+    *,
+    markers: str = DEFAULT_MARKERS,
+    on_success: Callable[[Path, Sequence[Path]], None] | None = None,
+) -> int:
+    """Run cog on groups of files, calling `on_success` for each group that succeeds."""
+    groups = group_by_working_directory(filenames, working_directory_level)
+    run_group = _run_cog_in_process if in_process else _run_cog_subprocess
+
+    def finish(cwd: Path, file_paths: Sequence[Path], result: tuple[int, str]) -> int:
+        return_code, output = result
+        print(output, end="")
+        if return_code == 0 and on_success is not None:
+            on_success(cwd, file_paths)
+        return return_code
+
+    if jobs <= 1:
+        for cwd, file_paths in groups.items():
+            return_code = finish(cwd, file_paths, run_group(cwd, file_paths, markers))
+            if return_code != 0:
+                return return_code
+        return 0
+
+    # Most runs are sequential, so don't pay for importing concurrent.futures up front
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    # Each subprocess is already a separate process, so threads suffice to run them
+    # concurrently. In-process runs change the working directory, so need separate processes.
+    executor_class = ProcessPoolExecutor if in_process else ThreadPoolExecutor
+    with executor_class(max_workers=jobs) as executor:
+        units = _split_by_directory(groups)
+        futures = [
+            executor.submit(run_group, cwd, file_paths, markers)
+            for cwd, file_paths in units
+        ]
+        try:
+            for (cwd, file_paths), future in zip(units, futures):
+                return_code = finish(cwd, file_paths, future.result())
+                if return_code != 0:
+                    return return_code
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
     return 0
 
@@ -60,11 +453,68 @@ def main(argv: Sequence[str] | None = None) -> int:
         type=int,
         help="The number of levels from the repo root to traverse into when setting cog's working directory.",
     )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help=f"Run cog within this process instead of isolated subprocesses, sharing imports between files. Ignored if the {ISOLATED_ENV_VAR} environment variable is set.",
+    )
+    parser.add_argument(
+        "--jobs",
+        default=1,
+        type=int,
+        help="The maximum number of directories to process concurrently.",
+    )
+    parser.add_argument(
+        "--markers",
+        default=DEFAULT_MARKERS,
+        help=f"The begin, end and end-output markers of cog, separated by spaces. Files which contain none of them are skipped without running cog. Defaults to '{DEFAULT_MARKERS}'.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="If set, the output of cog for each file is cached in this directory, and cog is skipped for files whose inputs are unchanged.",
+    )
+    parser.add_argument(
+        "--cache-dependency",
+        action="append",
+        default=[],
+        help="A glob of files on which the cog generators depend, which are included in the cache key (multiple allowed).",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        default=DEFAULT_CACHE_MAX_SIZE_MB,
+        type=int,
+        help="The maximum size of the cache, in MB.",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        default=DEFAULT_CACHE_MAX_AGE_DAYS,
+        type=float,
+        help="The maximum age of unused cache entries, in days.",
+    )
     args = parser.parse_args(argv)
+    if not args.filenames:
+        return 0
+    if len(args.markers.split()) != 3:
+        parser.error("--markers must be three values separated by spaces")
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = CogCache(
+            args.cache_dir,
+            args.cache_dependency,
+            markers=args.markers,
+            max_size=args.cache_max_size * 1024 * 1024,
+            max_age=args.cache_max_age * 24 * 60 * 60,
+        )
 
     return run_cog(
         args.filenames,
         args.working_directory_level,
+        in_process=args.in_process and not os.environ.get(ISOLATED_ENV_VAR),
+        jobs=args.jobs,
+        cache=cache,
+        markers=args.markers,
     )
 
 
@@ -0,0 +1,108 @@
+"""Record the wall time spent in each stage of a hook, per project.
+
+The recorded spans can be summarized as a table, or written as a Chrome trace-event file,
+which can be viewed as a flame chart in `chrome://tracing` or https://ui.perfetto.dev.
+
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import ContextManager, NamedTuple
+
+
+class Span(NamedTuple):
+    stage: str
+    project: str
+    start: float
+    duration: float
+    thread_id: int
+
+
+class Timings:
+    """A thread-safe recorder of the time spent in each stage, for each project."""
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, stage: str, project: Path | str) -> Iterator[None]:
+        """Record the wall time of the body as a span of a stage for a project."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            span = Span(
+                stage=stage,
+                project=str(project),
+                start=start - self._origin,
+                duration=time.perf_counter() - start,
+                thread_id=threading.get_ident(),
+            )
+            with self._lock:
+                self.spans.append(span)
+
+    def summary_table(self) -> str:
+        """Format the total time per project and stage as a plain-text table, in seconds."""
+        stages = list(dict.fromkeys(s.stage for s in self.spans))
+        totals: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for span in self.spans:
+            totals[span.project][span.stage] += span.duration
+            totals["TOTAL"][span.stage] += span.duration
+
+        header = ["Project", *stages, "total"]
+        rows = [
+            [
+                project,
+                *(f"{totals[project][stage]:.3f}" for stage in stages),
+                f"{sum(totals[project].values()):.3f}",
+            ]
+            for project in [*sorted(p for p in totals if p != "TOTAL"), "TOTAL"]
+            if project in totals
+        ]
+        widths = [
+            max(len(row[i]) for row in [header, *rows]) for i in range(len(header))
+        ]
+        lines = []
+        for row in [header, *rows]:
+            cells = [row[0].ljust(widths[0])]
+            cells += [cell.rjust(width) for cell, width in zip(row[1:], widths[1:])]
+            lines.append("  ".join(cells).rstrip())
+        lines.insert(1, "  ".join("-" * width for width in widths))
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: Path) -> None:
+        """Write the spans as complete ("X") events in the Chrome trace-event format."""
+        pid = os.getpid()
+        events = [
+            {
+                "name": span.stage,
+                "cat": "stage",
+                "ph": "X",
+                "ts": round(span.start * 1e6),
+                "dur": round(span.duration * 1e6),
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": {"project": span.project},
+            }
+            for span in sorted(self.spans, key=lambda s: s.start)
+        ]
+        path.write_text(json.dumps({"traceEvents": events}, indent=1) + "\n")
+
+
+def maybe_stage(
+    timings: Timings | None, stage: str, project: Path | str
+) -> ContextManager[None]:
+    """Record a stage if timings are enabled, otherwise do nothing."""
+    if timings is None:
+        return nullcontext()
+    return timings.stage(stage, project)
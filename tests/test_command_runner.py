@@ -0,0 +1,120 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from anaconda_pre_commit_hooks import command_runner
+from anaconda_pre_commit_hooks.add_renovate_annotations import setup_conda_environment
+from anaconda_pre_commit_hooks.command_runner import run_command, run_command_async
+
+
+def python_command(code):
+    return [sys.executable, "-c", code]
+
+
+def test_run_command_keeps_tail():
+    result = run_command(
+        python_command(
+            "import sys\n"
+            "for i in range(1000): print(i)\n"
+            "print('error', file=sys.stderr)\n"
+            "sys.exit(3)"
+        ),
+        tail_lines=2,
+    )
+
+    assert result.returncode == 3
+    assert result.stdout == "[... 998 earlier lines omitted ...]\n998\n999\n"
+    assert result.stderr == "error\n"
+
+
+def test_run_command_keep_stdout():
+    result = run_command(
+        python_command("for i in range(1000): print(i)"),
+        tail_lines=2,
+        keep_stdout=True,
+    )
+    assert result.stdout.splitlines() == [str(i) for i in range(1000)]
+
+
+def test_run_command_streams_lines(tmp_path):
+    lines = []
+    run_command(
+        python_command("print('a'); print('b', end='')"),
+        cwd=tmp_path,
+        on_line=lambda stream, line: lines.append((stream, line)),
+    )
+    assert lines == [("stdout", "a\n"), ("stdout", "b")]
+
+
+def test_run_command_splits_long_lines(monkeypatch):
+    monkeypatch.setattr(command_runner, "MAX_LINE_BYTES", 10)
+    result = run_command(python_command("print('x' * 25)"))
+    assert result.stdout == "x" * 25 + "\n"
+
+
+@pytest.mark.skipif(os.name != "posix", reason="Process groups are POSIX only")
+def test_run_command_timeout_kills_process_group(tmp_path):
+    pid_file = tmp_path / "pid"
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as exc_info:
+        run_command(
+            ["sh", "-c", f"sleep 60 & echo $! > {pid_file}; echo started; wait"],
+            timeout=1,
+        )
+
+    assert time.monotonic() - start < 10
+    assert exc_info.value.stdout == "started\n"
+    # The background process started by the command is gone too
+    pid = int(pid_file.read_text())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        time.sleep(0.1)
+    else:
+        pytest.fail("The child process was not terminated")
+
+
+def test_run_command_async_multiplexes():
+    async def main():
+        return await asyncio.gather(
+            *(
+                run_command_async(python_command(f"print({i})"), keep_stdout=True)
+                for i in range(3)
+            )
+        )
+
+    results = asyncio.run(main())
+    assert [r.stdout for r in results] == ["0\n", "1\n", "2\n"]
+
+
+def test_run_command_in_running_event_loop():
+    async def main():
+        return run_command(python_command("print('inside')"), keep_stdout=True)
+
+    assert asyncio.run(main()).stdout == "inside\n"
+
+
+def test_run_command_in_running_event_loop_timeout():
+    async def main():
+        return run_command(python_command("import time; time.sleep(60)"), timeout=0.5)
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(main())
+
+
+def test_setup_conda_environment_timeout(tmp_path, capsys):
+    with pytest.raises(subprocess.TimeoutExpired):
+        setup_conda_environment(
+            f"{sys.executable} -c \"print('solving', flush=True); import time; time.sleep(60)\"",
+            cwd=tmp_path,
+            timeout=1,
+        )
+    out = capsys.readouterr().out
+    assert f"Timed out after 1 s running setup command in {tmp_path}" in out
+    assert "solving" in out
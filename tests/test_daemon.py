@@ -0,0 +1,212 @@
+import json
+import subprocess
+import threading
+import time
+
+import pytest
+
+from anaconda_pre_commit_hooks import daemon
+from anaconda_pre_commit_hooks.add_renovate_annotations import (
+    Dependencies,
+    Dependency,
+    load_dependencies,
+)
+from anaconda_pre_commit_hooks.daemon import (
+    DaemonServer,
+    PackageCache,
+    find_named_environment,
+    request_packages,
+)
+
+PACKAGES = [{"name": "python", "version": "3.10.14", "channel": "pkgs/main"}]
+
+
+@pytest.fixture()
+def project_dir(tmp_path):
+    project_dir = tmp_path / "project"
+    (project_dir / "env" / "conda-meta").mkdir(parents=True)
+    (project_dir / "environment.yml").write_text("dependencies:\n- python\n")
+    return project_dir
+
+
+@pytest.fixture()
+def mock_load(mocker):
+    setup = mocker.patch.object(daemon, "setup_conda_environment")
+    list_packages = mocker.patch.object(
+        daemon, "list_packages_in_conda_environment", return_value=PACKAGES
+    )
+    return setup, list_packages
+
+
+@pytest.fixture()
+def conda_info(tmp_path, mocker):
+    """A conda installation with a named environment "shared"."""
+    info = {
+        "root_prefix": str(tmp_path / "conda"),
+        "envs_dirs": [str(tmp_path / "conda" / "envs")],
+        "envs": [str(tmp_path / "conda"), str(tmp_path / "conda" / "envs" / "shared")],
+    }
+    (tmp_path / "conda" / "envs" / "shared" / "conda-meta").mkdir(parents=True)
+    return mocker.patch.object(
+        daemon,
+        "run_command",
+        return_value=subprocess.CompletedProcess([], 0, json.dumps(info), ""),
+    )
+
+
+@pytest.fixture()
+def socket_path(tmp_path, mock_load):
+    socket_path = tmp_path / "daemon.sock"
+    with DaemonServer(socket_path) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield socket_path
+        server.shutdown()
+        thread.join()
+
+
+def test_request_packages_without_daemon(tmp_path, project_dir):
+    assert (
+        request_packages(
+            tmp_path / "missing.sock", project_dir, "make setup", "-p ./env"
+        )
+        is None
+    )
+
+
+def test_daemon_reloads_on_change(socket_path, project_dir, mock_load):
+    setup, list_packages = mock_load
+
+    def request():
+        return request_packages(socket_path, project_dir, "make setup", "-p ./env")
+
+    assert request() == PACKAGES
+    assert request() == PACKAGES
+    assert setup.call_count == list_packages.call_count == 1
+
+    # Changing an environment file invalidates the packages
+    (project_dir / "environment.yml").write_text("dependencies:\n- python=3.10\n")
+    assert request() == PACKAGES
+    assert setup.call_count == list_packages.call_count == 2
+
+    # As does a change to the environment itself
+    (project_dir / "env" / "conda-meta" / "history").write_text("==> update <==\n")
+    assert request() == PACKAGES
+    assert setup.call_count == list_packages.call_count == 3
+
+    # Projects with different create commands are cached separately
+    assert request_packages(socket_path, project_dir, None, "-p ./env") == PACKAGES
+    assert setup.call_count == 3
+    assert list_packages.call_count == 4
+
+
+def test_daemon_watches_shared_projects(
+    socket_path, project_dir, mock_load, conda_info
+):
+    setup, _ = mock_load
+    other_dir = project_dir.with_name("other")
+    other_dir.mkdir()
+    (other_dir / "environment.yml").write_text("dependencies:\n- python\n")
+
+    def request():
+        return request_packages(
+            socket_path, project_dir, "make setup", "-n shared", shared_with=[other_dir]
+        )
+
+    assert request() == PACKAGES
+    assert request() == PACKAGES
+    assert setup.call_count == 1
+
+    # The environment files of other projects sharing the environment invalidate it too
+    (other_dir / "environment.yml").write_text("dependencies:\n- python=3.10\n")
+    assert request() == PACKAGES
+    assert setup.call_count == 2
+
+
+def test_daemon_watches_named_environments(
+    socket_path, tmp_path, project_dir, mock_load, conda_info
+):
+    setup, _ = mock_load
+
+    def request(selector="-n shared"):
+        return request_packages(socket_path, project_dir, "make setup", selector)
+
+    assert request() == PACKAGES
+    assert request() == PACKAGES
+    assert setup.call_count == 1
+
+    # Changes to the named environment invalidate the packages
+    history = tmp_path / "conda" / "envs" / "shared" / "conda-meta" / "history"
+    history.write_text("==> update <==\n")
+    assert request() == PACKAGES
+    assert setup.call_count == 2
+
+    # Environments which can't be resolved to a prefix aren't cached
+    assert request("-n missing") == PACKAGES
+    assert request("-n missing") == PACKAGES
+    assert setup.call_count == 4
+
+
+def test_find_named_environment(tmp_path):
+    info = {
+        "root_prefix": "/opt/conda",
+        "envs_dirs": ["/opt/conda/envs", "/home/user/.conda/envs"],
+        "envs": ["/opt/conda", "/home/user/.conda/envs/app", "/somewhere/else/app2"],
+    }
+    assert str(find_named_environment(info, "base")) == "/opt/conda"
+    assert str(find_named_environment(info, "app")) == "/home/user/.conda/envs/app"
+    # Environments outside the envs directories have no name
+    assert find_named_environment(info, "app2") is None
+
+
+def test_daemon_heartbeats(socket_path, project_dir, mock_load, monkeypatch):
+    setup, _ = mock_load
+    setup.side_effect = lambda *args, **kwargs: time.sleep(0.5)
+    monkeypatch.setattr(daemon, "HEARTBEAT_INTERVAL", 0.05)
+
+    # The client waits for as long as the daemon is working, however long that takes
+    packages = request_packages(
+        socket_path, project_dir, "make setup", "-p ./env", timeout=0.2
+    )
+    assert packages == PACKAGES
+
+
+def test_package_cache_command_timeout(project_dir, mock_load):
+    setup, list_packages = mock_load
+    setup.side_effect = subprocess.TimeoutExpired("make setup", 5)
+    key = daemon.CacheKey(str(project_dir), "make setup", "-p ./env")
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        PackageCache(command_timeout=5).get(key)
+    assert setup.call_args.kwargs["timeout"] == 5
+
+
+def test_daemon_reports_failure(socket_path, project_dir, mock_load):
+    _, list_packages = mock_load
+    list_packages.side_effect = RuntimeError("conda is broken")
+
+    assert request_packages(socket_path, project_dir, None, "-p ./env") is None
+
+
+@pytest.mark.parametrize("daemon_running", [True, False])
+def test_load_dependencies_with_daemon(
+    socket_path, project_dir, mocker, daemon_running
+):
+    setup = mocker.patch(
+        "anaconda_pre_commit_hooks.add_renovate_annotations.setup_conda_environment"
+    )
+    list_packages = mocker.patch(
+        "anaconda_pre_commit_hooks.add_renovate_annotations.list_packages_in_conda_environment",
+        return_value=PACKAGES,
+    )
+    if not daemon_running:
+        socket_path = socket_path.with_name("missing.sock")
+
+    dependencies = load_dependencies(project_dir, daemon_socket=socket_path)
+
+    assert dependencies == Dependencies(
+        pip={},
+        conda={"python": Dependency(name="python", channel="main", version="3.10.14")},
+    )
+    # The CLI only loads the packages itself if the daemon isn't running
+    assert setup.call_count == list_packages.call_count == int(not daemon_running)
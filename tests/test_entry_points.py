@@ -0,0 +1,119 @@
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import click
+import pytest
+import typer
+
+from anaconda_pre_commit_hooks.add_renovate_annotations import app
+from anaconda_pre_commit_hooks.entry_points import (
+    GENERATE_RENOVATE_ANNOTATIONS_FLAGS,
+    generate_renovate_annotations,
+    has_positional_args,
+)
+
+SRC_DIR = Path(__file__).parents[1] / "src"
+
+# Cumulative import time budgets for the modules loaded on every invocation, as multiples of
+# the import time of a baseline module, so that they hold on slower machines too
+BASELINE_MODULE = "json"
+IMPORT_TIME_BUDGETS = {
+    "anaconda_pre_commit_hooks.entry_points": 2.5,
+    "anaconda_pre_commit_hooks.run_cog": 10.0,
+}
+
+# Slow modules which must only be imported once they are needed
+DEFERRED_MODULES = {
+    "typer",
+    "click",
+    "rich",
+    "yaml",
+    "cogapp",
+    "concurrent.futures",
+    "importlib.metadata",
+}
+
+IMPORT_TIME_RE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$")
+
+
+def measure_import_time(module: str) -> tuple[int, set[str]]:
+    """Import a module in a fresh interpreter.
+
+    Returns:
+        The cumulative import time of the module in microseconds, and the names of all
+        modules imported alongside it.
+
+    """
+    # Like pytest, import the package from the source tree, even if it isn't installed
+    pythonpath = os.pathsep.join(
+        filter(None, [str(SRC_DIR), os.environ.get("PYTHONPATH")])
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "PYTHONPATH": pythonpath},
+    )
+    cumulative_us, imported = None, set()
+    for line in result.stderr.splitlines():
+        m = IMPORT_TIME_RE.match(line)
+        if m is None:
+            continue
+        imported.add(m[3])
+        if m[3] == module:
+            cumulative_us = int(m[1])
+    assert cumulative_us is not None
+    return cumulative_us, imported
+
+
+@pytest.mark.parametrize("module, budget", IMPORT_TIME_BUDGETS.items())
+def test_import_time(module, budget):
+    # Take the best of a few interleaved runs, to reduce noise from the machine running the tests
+    measurements, baseline_us = [], []
+    for _ in range(5):
+        measurements.append(measure_import_time(module))
+        baseline_us.append(measure_import_time(BASELINE_MODULE)[0])
+    cumulative_us = min(us for us, _ in measurements)
+    assert cumulative_us < budget * min(baseline_us)
+    assert not DEFERRED_MODULES & measurements[0][1]
+
+
+def test_generate_renovate_annotations_flags():
+    command = typer.main.get_command(app)
+    flags = {
+        opt
+        for param in command.params
+        if isinstance(param, click.Option) and param.is_flag
+        for opt in param.opts
+    }
+    assert flags == GENERATE_RENOVATE_ANNOTATIONS_FLAGS
+
+
+@pytest.mark.parametrize(
+    "args, expected",
+    [
+        ([], False),
+        (["--jobs", "4", "--check"], False),
+        (["--environment-selector", "-p ./env", "--jobs=4"], False),
+        (["--jobs", "4", "environment.yml"], True),
+        (["--check", "environment.yml"], True),
+        (["--", "-environment.yml"], True),
+        (["--jobs", "4", "--"], False),
+    ],
+)
+def test_has_positional_args(args, expected):
+    assert has_positional_args(args, GENERATE_RENOVATE_ANNOTATIONS_FLAGS) is expected
+
+
+def test_generate_renovate_annotations_without_files(mocker):
+    mocker.patch.object(sys, "argv", ["generate-renovate-annotations", "--jobs", "4"])
+    mocker.patch.dict(sys.modules)
+    sys.modules.pop("anaconda_pre_commit_hooks.add_renovate_annotations")
+
+    generate_renovate_annotations()
+
+    assert "anaconda_pre_commit_hooks.add_renovate_annotations" not in sys.modules
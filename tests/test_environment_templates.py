@@ -0,0 +1,200 @@
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from anaconda_pre_commit_hooks import add_renovate_annotations, environment_templates
+from anaconda_pre_commit_hooks.add_renovate_annotations import load_dependencies
+from anaconda_pre_commit_hooks.environment_templates import EnvironmentTemplates
+
+PACKAGES = [{"name": "python", "version": "3.10.14", "channel": "pkgs/main"}]
+
+
+@pytest.fixture()
+def mock_clone(mocker):
+    def clone(source, target):
+        shutil.copytree(source, target)
+        return True
+
+    return mocker.patch.object(
+        environment_templates, "clone_environment", side_effect=clone
+    )
+
+
+def make_prefix(prefix, contents="python"):
+    (prefix / "conda-meta").mkdir(parents=True, exist_ok=True)
+    (prefix / "conda-meta" / "history").write_text(contents)
+
+
+@pytest.fixture()
+def mock_load(mocker):
+    # Like `make setup`, which updates the environment if it exists
+    setup = mocker.patch.object(
+        add_renovate_annotations,
+        "setup_conda_environment",
+        side_effect=lambda command, cwd, **kwargs: make_prefix(cwd / "env"),
+    )
+    mocker.patch.object(
+        add_renovate_annotations,
+        "list_packages_in_conda_environment",
+        return_value=PACKAGES,
+    )
+    return setup
+
+
+def make_project(project_dir, dependencies):
+    project_dir.mkdir(exist_ok=True)
+    (project_dir / "environment.yml").write_text(
+        "dependencies:\n" + "".join(f"- {d}\n" for d in dependencies)
+    )
+
+
+def test_save_and_restore(tmp_path, mock_clone):
+    templates = EnvironmentTemplates(tmp_path / "templates")
+    prefix = tmp_path / "project" / "env"
+    make_prefix(prefix)
+
+    assert not templates.restore("key", tmp_path / "restored")
+    templates.save("key", prefix)
+    assert templates.restore("key", tmp_path / "restored")
+    assert (tmp_path / "restored" / "conda-meta" / "history").read_text() == "python"
+
+    # Existing prefixes are never overwritten
+    assert not templates.restore("key", prefix)
+    # Nor are existing templates saved again
+    templates.save("key", prefix)
+    assert mock_clone.call_count == 2
+
+
+def test_restore_failure(tmp_path, mock_clone):
+    templates = EnvironmentTemplates(tmp_path / "templates")
+    make_prefix(tmp_path / "env")
+    templates.save("key", tmp_path / "env")
+
+    def failing_clone(source, target):
+        (target / "conda-meta").mkdir(parents=True)
+        return False
+
+    mock_clone.side_effect = failing_clone
+    assert not templates.restore("key", tmp_path / "restored")
+    assert not (tmp_path / "restored").exists()
+
+
+def test_restore_closest(tmp_path, mock_clone):
+    templates = EnvironmentTemplates(tmp_path / "templates")
+    for key, features in [
+        ("data", ["- python", "- numpy", "- pandas"]),
+        ("web", ["- python", "- flask"]),
+        ("other", []),
+    ]:
+        make_prefix(tmp_path / key, contents=key)
+        templates.save(key, tmp_path / key, features)
+
+    restored = tmp_path / "restored"
+    assert templates.restore_closest(["- python", "- numpy"], restored) == "data"
+    assert (restored / "conda-meta" / "history").read_text() == "data"
+    # Existing prefixes are never overwritten
+    assert templates.restore_closest(["- python", "- flask"], restored) is None
+    # Templates without any features in common aren't used
+    assert templates.restore_closest(["- r-base"], tmp_path / "r") is None
+    assert json.loads((tmp_path / "templates" / "web.ready").read_text()) == {
+        "features": ["- flask", "- python"]
+    }
+
+
+def test_evict_least_recently_used(tmp_path, mock_clone):
+    templates = EnvironmentTemplates(tmp_path / "templates", max_count=2)
+    for i, key in enumerate(["a", "b"]):
+        make_prefix(tmp_path / key)
+        templates.save(key, tmp_path / key)
+        os.utime(tmp_path / "templates" / f"{key}.ready", (i, i))
+
+    # Using a template marks it as recently used
+    assert templates.restore("a", tmp_path / "restored")
+    make_prefix(tmp_path / "c")
+    templates.save("c", tmp_path / "c")
+
+    assert sorted(p.name for p in (tmp_path / "templates").iterdir()) == [
+        "a",
+        "a.ready",
+        "c",
+        "c.ready",
+    ]
+
+
+def test_evict_stale_locks(tmp_path, mock_clone):
+    templates = EnvironmentTemplates(tmp_path / "templates")
+    make_prefix(tmp_path / "templates" / "crashed")
+    (tmp_path / "templates" / "crashed.lock").touch()
+    (tmp_path / "templates" / "running.lock").touch()
+    os.utime(tmp_path / "templates" / "crashed.lock", (0, 0))
+
+    # A template which is being saved by another run is skipped
+    make_prefix(tmp_path / "env")
+    templates.save("running", tmp_path / "env")
+    assert mock_clone.call_count == 0
+
+    templates.evict()
+    assert sorted(p.name for p in (tmp_path / "templates").iterdir()) == [
+        "running.lock"
+    ]
+
+
+def test_load_dependencies_with_templates(tmp_path, mock_clone, mock_load):
+    project_dir = tmp_path / "project"
+    make_project(project_dir, ["python"])
+    templates = EnvironmentTemplates(tmp_path / "templates")
+
+    first = load_dependencies(project_dir, templates=templates)
+    assert mock_load.call_count == 1
+
+    # A fresh checkout is restored from the template, without running the create command
+    shutil.rmtree(project_dir / "env")
+    assert load_dependencies(project_dir, templates=templates) == first
+    assert mock_load.call_count == 1
+    assert (project_dir / "env" / "conda-meta" / "history").exists()
+
+    # Another project with the same environment files starts from the closest template, but
+    # still runs the create command, e.g. to install itself rather than the first project
+    other_dir = tmp_path / "other"
+    make_project(other_dir, ["python"])
+    load_dependencies(other_dir, templates=templates)
+    assert mock_load.call_count == 2
+    assert (other_dir / "env" / "conda-meta" / "history").exists()
+
+    # As does the project once its environment files change
+    shutil.rmtree(project_dir / "env")
+    make_project(project_dir, ["python", "pyyaml"])
+    load_dependencies(project_dir, templates=templates)
+    assert mock_load.call_count == 3
+
+    # Environments created on top of another template are never saved
+    assert mock_clone.call_count == 4
+    assert len(list((tmp_path / "templates").glob("*.ready"))) == 1
+
+
+def test_load_dependencies_closest_template_fallback(
+    tmp_path, mock_clone, mock_load, capsys
+):
+    templates = EnvironmentTemplates(tmp_path / "templates")
+    make_project(tmp_path / "app-a", ["python", "numpy"])
+    load_dependencies(tmp_path / "app-a", templates=templates)
+
+    # A create command which can't update an existing environment
+    def create(command, cwd, **kwargs):
+        if (cwd / "env").exists():
+            raise subprocess.CalledProcessError(1, command)
+        make_prefix(cwd / "env", contents="created")
+
+    mock_load.side_effect = create
+    make_project(tmp_path / "app-b", ["python", "pandas"])
+    load_dependencies(tmp_path / "app-b", templates=templates)
+
+    assert mock_load.call_count == 3
+    history = tmp_path / "app-b" / "env" / "conda-meta" / "history"
+    assert history.read_text() == "created"
+    assert "without a template" in capsys.readouterr().out
+    # Having been created from scratch, the environment is saved as a template
+    assert len(list((tmp_path / "templates").glob("*.ready"))) == 2
@@ -0,0 +1,77 @@
+import shlex
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).parents[1]
+
+COMMAND = shlex.join([sys.executable, "-c", "print('Usage: tool [OPTIONS]')"])
+
+
+@pytest.fixture()
+def generator(monkeypatch, tmp_path):
+    monkeypatch.syspath_prepend(str(REPO_ROOT / "dev"))
+    monkeypatch.delenv("GENERATE_CLI_OUTPUT_REFRESH", raising=False)
+    monkeypatch.setenv("GENERATE_CLI_OUTPUT_CACHE_DIR", str(tmp_path / "cache"))
+    import generate_cli_output
+
+    generate_cli_output.clear_cache()
+    yield generate_cli_output
+    generate_cli_output.clear_cache()
+
+
+def test_identical_commands_run_once(generator, mocker):
+    spy = mocker.spy(generator.subprocess, "check_output")
+
+    outputs = [generator.run_command(COMMAND) for _ in range(3)]
+
+    assert outputs == ["Usage: tool [OPTIONS]\n"] * 3
+    assert spy.call_count == 1
+
+
+def test_output_is_cached_on_disk(generator, mocker, monkeypatch):
+    spy = mocker.spy(generator.subprocess, "check_output")
+    generator.run_command(COMMAND)
+
+    # A new process only has the on-disk cache
+    generator._memo.clear()
+    generator.run_command(COMMAND)
+    assert spy.call_count == 1
+
+    # Unless asked to refresh it, which still only runs each command once per process
+    generator._memo.clear()
+    monkeypatch.setenv("GENERATE_CLI_OUTPUT_REFRESH", "1")
+    generator.run_command(COMMAND)
+    generator.run_command(COMMAND)
+    assert spy.call_count == 2
+
+
+def test_command_key(generator, tmp_path, monkeypatch):
+    args = shlex.split(COMMAND)
+    key = generator.command_key(args, Path.cwd())
+
+    assert key == generator.command_key(args, Path.cwd())
+    assert key != generator.command_key(args, tmp_path)
+    assert key != generator.command_key([*args, "--help"], Path.cwd())
+    monkeypatch.setenv("COLUMNS", "40")
+    assert key != generator.command_key(args, Path.cwd())
+
+
+def test_executable_fingerprint(generator, tmp_path):
+    executable = tmp_path / "tool"
+    executable.write_text("#!/bin/sh\necho 1.0\n")
+    executable.chmod(0o755)
+    fingerprint = generator.executable_fingerprint(str(executable))
+    assert fingerprint != generator.executable_fingerprint("run-cog")
+
+    executable.write_text("#!/bin/sh\necho 2.0.0\n")
+    generator.executable_fingerprint.cache_clear()
+    assert generator.executable_fingerprint(str(executable)) != fingerprint
+
+
+def test_package_sources(generator):
+    sources = generator._package_sources("anaconda_pre_commit_hooks.run_cog:main")
+    paths = [Path(p).name for p in sources if isinstance(p, str)]
+    assert "run_cog.py" in paths
+    assert generator._package_sources("missing_package.module:main") == []
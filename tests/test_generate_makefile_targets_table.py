@@ -0,0 +1,112 @@
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from textwrap import dedent
+
+import pytest
+
+REPO_ROOT = Path(__file__).parents[1]
+
+pytestmark = pytest.mark.skipif(shutil.which("make") is None, reason="Requires make")
+
+# An included makefile, with some of the edge cases of the help target's fgrep/sed/awk pipeline
+INCLUDED_MAKEFILE = dedent("""\
+    lint:  ## Run the linters: ruff & mypy
+    \t@true
+
+    release: \\
+    \tlint  ## Build a release \\
+    \t@true
+    """)
+
+
+@pytest.fixture()
+def generator(monkeypatch):
+    monkeypatch.syspath_prepend(str(REPO_ROOT / "dev"))
+    import generate_makefile_targets_table
+
+    return generate_makefile_targets_table
+
+
+def run_make(directory: Path) -> str:
+    # Don't inherit any make state, e.g. when the tests are run via `make test`
+    env = {k: v for k, v in os.environ.items() if not k.startswith(("MAKE", "MFLAGS"))}
+    return subprocess.check_output(["make"], text=True, cwd=directory, env=env)
+
+
+def test_parse_makefile_matches_make(generator):
+    expected = generator.parse_help_output(run_make(REPO_ROOT))
+    targets = generator.parse_makefile(REPO_ROOT / "Makefile")
+
+    assert targets == expected
+    assert [t.target for t in targets][:2] == ["help", "setup"]
+    assert generator.render_table(targets) == generator.render_table(expected)
+
+
+def test_parse_makefile_with_includes_matches_make(generator, tmp_path):
+    makefile = (REPO_ROOT / "Makefile").read_text()
+    # Include at the end, so that help remains the default goal
+    (tmp_path / "Makefile").write_text(
+        makefile + "\ninclude mk/*.mk\n-include missing.mk\n"
+    )
+    (tmp_path / "mk").mkdir()
+    (tmp_path / "mk" / "lint.mk").write_text(INCLUDED_MAKEFILE)
+
+    targets = generator.parse_makefile(tmp_path / "Makefile")
+
+    assert targets == generator.parse_help_output(run_make(tmp_path))
+    assert ("lint", "Run the linters") in targets
+
+
+def test_load_targets_cache(generator, tmp_path, mocker):
+    shutil.copy(REPO_ROOT / "Makefile", tmp_path / "Makefile")
+    cache = generator.TargetsCache(tmp_path / "cache")
+    parse_spy = mocker.spy(generator, "parse_makefile")
+
+    targets = generator.load_targets(tmp_path, cache)
+    assert generator.load_targets(tmp_path, cache) == targets
+    assert parse_spy.call_count == 1
+
+    # Touching the Makefile doesn't invalidate the cache, since its hash is unchanged
+    os.utime(tmp_path / "Makefile", (0, 0))
+    assert generator.load_targets(tmp_path, cache) == targets
+    assert parse_spy.call_count == 1
+
+    with (tmp_path / "Makefile").open("a") as fp:
+        fp.write("lint:  ## Run the linters\n")
+    assert generator.load_targets(tmp_path, cache)[-1] == ("lint", "Run the linters")
+    assert parse_spy.call_count == 2
+
+
+def test_load_targets_unresolvable_include(generator, tmp_path, mocker):
+    (tmp_path / "Makefile").write_text("include $(HOME)/rules.mk\n")
+    run_make_mock = mocker.patch.object(generator, "run_make", return_value=[])
+
+    assert generator.load_targets(tmp_path) == []
+    run_make_mock.assert_called_once_with(tmp_path)
+
+
+def test_targets_cache_unwritable(generator, tmp_path):
+    shutil.copy(REPO_ROOT / "Makefile", tmp_path / "Makefile")
+    # A file in place of the cache directory, which can't be written to even as root
+    (tmp_path / "cache").write_text("")
+    cache = generator.TargetsCache(tmp_path / "cache" / "makefile-targets")
+
+    targets = generator.load_targets(tmp_path, cache)
+
+    assert targets == generator.parse_makefile(tmp_path / "Makefile")
+    assert cache.get(tmp_path / "Makefile") is None
+
+
+def test_main_without_cache(generator, tmp_path, monkeypatch):
+    shutil.copy(REPO_ROOT / "Makefile", tmp_path / "Makefile")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("GENERATE_MAKEFILE_TARGETS_CACHE_DIR", "")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    lines = []
+
+    generator.main(outl=lines.append)
+
+    assert lines[3].startswith("| `help`")
+    assert not (tmp_path / "cache").exists()
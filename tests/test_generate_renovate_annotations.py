@@ -1,25 +1,41 @@
 import json
+import pickle
 import re
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from textwrap import dedent
 
 import pytest
+import typer
 import yaml
+from typer.testing import CliRunner
 
 from anaconda_pre_commit_hooks import add_renovate_annotations
 from anaconda_pre_commit_hooks.add_renovate_annotations import (
     Dependencies,
     Dependency,
+    LineChange,
     add_comments_to_env_file,
+    annotate_env_files,
+    annotate_env_lines,
     cli,
+    environment_cache_key,
+    environment_key,
+    iter_project_dependencies,
     load_dependencies,
+    load_lockfile_dependencies,
     parse_pip_index_overrides,
     setup_conda_environment,
 )
+from anaconda_pre_commit_hooks.conda_meta import (
+    parse_prefix_selector,
+    read_conda_meta_packages,
+)
 
-# Mock out subprocess run for all tests
-pytestmark = pytest.mark.usefixtures("mock_subprocess_run")
+# Mock out running commands for all tests, and run them outside the repo so that a local
+# development environment in ./env isn't picked up
+pytestmark = pytest.mark.usefixtures("mock_subprocess_run", "isolated_cwd")
 
 DEFAULT_FILES_REGEX_STRING = r"environment[\w-]*\.ya?ml"
 
@@ -45,6 +61,14 @@ def repo_root() -> Path:
     return Path(__file__).parents[1]
 
 
+@pytest.fixture()
+def isolated_cwd(tmp_path, monkeypatch):
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    return cwd
+
+
 def test_ensure_default_files_regex_in_pre_commit_hooks_yaml_matches_tested(repo_root):
     """This test ensures that the regex tested below is the same as what is in .pre-commit-hooks.yaml."""
     pre_commit_hooks_path = repo_root / ".pre-commit-hooks.yaml"
@@ -116,7 +140,7 @@ def test_parse_pip_index_overrides(index_url, packages, expect_empty):
 
 @pytest.fixture()
 def mock_subprocess_run(monkeypatch):
-    old_subprocess_run = subprocess.run
+    old_run_command = add_renovate_annotations.run_command
 
     def f(args, *posargs, **kwargs):
         if args == ["make", "setup"] or args[:3] == ["conda", "env", "create"]:
@@ -157,9 +181,9 @@ def mock_subprocess_run(monkeypatch):
                 "",
             )
         else:
-            return old_subprocess_run(args, *posargs, **kwargs)  # pragma: nocover
+            return old_run_command(args, *posargs, **kwargs)  # pragma: nocover
 
-    monkeypatch.setattr(subprocess, "run", f)
+    monkeypatch.setattr(add_renovate_annotations, "run_command", f)
 
 
 def test_setup_conda_environment():
@@ -240,3 +264,679 @@ def test_cli_override_create_command(tmp_path, mocker):
     assert mock.call_count == 1
     args, kwargs = mock.call_args
     assert args[0] == create_command
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_cli_jobs(tmp_path, jobs):
+    env_file_paths = []
+    for name in ["app-a", "app-b", "app-c"]:
+        env_file_path = tmp_path / name / "environment.yml"
+        env_file_path.parent.mkdir()
+        env_file_path.write_text(ENVIRONMENT_YAML)
+        env_file_paths.append(env_file_path)
+
+    cli(env_files=env_file_paths, jobs=jobs)
+
+    for env_file_path in env_file_paths:
+        assert "- python=3.10.14" in env_file_path.read_text()
+
+
+@pytest.mark.parametrize(
+    "environment_selector, expected_environments",
+    [
+        ("-p ./env", 3),
+        ("-p ../shared-env", 1),
+        ("--name=shared", 1),
+        ("--some-other-selector", 3),
+    ],
+)
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_iter_project_dependencies_shares_environments(
+    tmp_path, mocker, environment_selector, expected_environments, jobs
+):
+    project_dirs = [tmp_path / name for name in ["app-a", "app-b", "app-c"]]
+    run_spy = mocker.spy(add_renovate_annotations, "run_command")
+
+    dependencies = dict(
+        iter_project_dependencies(
+            project_dirs, environment_selector=environment_selector, jobs=jobs
+        )
+    )
+
+    assert sorted(dependencies) == project_dirs
+    assert len({id(deps) for deps in dependencies.values()}) == expected_environments
+    # Each environment is set up and listed exactly once
+    assert run_spy.call_count == 2 * expected_environments
+
+
+@pytest.mark.parametrize(
+    "project_dir, environment_selector, expected_identity",
+    [
+        ("app", "-p ./env", "prefix:{tmp_path}/app/env"),
+        ("app", "--prefix ../env", "prefix:{tmp_path}/env"),
+        ("app", "-n some-env", "name:some-env"),
+        ("app", "--unknown", "selector:{tmp_path}/app:--unknown"),
+    ],
+)
+def test_environment_key(
+    tmp_path, project_dir, environment_selector, expected_identity
+):
+    key = environment_key(tmp_path / project_dir, "make setup", environment_selector)
+    assert key.identity == expected_identity.format(tmp_path=tmp_path.resolve())
+    assert key.create_command == "make setup"
+
+
+def test_iter_project_dependencies_stops_on_failure(tmp_path, mocker, capsys):
+    project_dirs = [tmp_path / name for name in ["app-a", "app-b", "app-c"]]
+    failing_dir = project_dirs[0]
+
+    def setup(command, *, cwd=None, **kwargs):
+        if cwd == failing_dir:
+            result = subprocess.CompletedProcess(["make", "setup"], 2, "out", "err")
+            add_renovate_annotations._report_failure(f"Failed in {cwd}", result)
+            result.check_returncode()
+
+    mocker.patch.object(add_renovate_annotations, "setup_conda_environment", setup)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        dict(iter_project_dependencies(project_dirs, jobs=2))
+
+    assert f"Failed in {failing_dir}\nout\nerr\n" in capsys.readouterr().out
+
+
+def test_load_dependencies_cache(tmp_path, mocker):
+    project_dir = tmp_path / "project"
+    project_dir.mkdir()
+    env_file_path = project_dir / "environment.yml"
+    env_file_path.write_text(ENVIRONMENT_YAML)
+    cache_dir = tmp_path / "cache"
+
+    setup_spy = mocker.spy(add_renovate_annotations, "setup_conda_environment")
+    list_spy = mocker.spy(
+        add_renovate_annotations, "list_packages_in_conda_environment"
+    )
+
+    first = load_dependencies(project_dir, cache_dir=cache_dir)
+    second = load_dependencies(project_dir, cache_dir=cache_dir)
+    assert first == second
+    assert setup_spy.call_count == 1
+    assert list_spy.call_count == 1
+
+    # Changing any environment input invalidates the cache
+    env_file_path.write_text(ENVIRONMENT_YAML + "# A comment\n")
+    load_dependencies(project_dir, cache_dir=cache_dir)
+    assert setup_spy.call_count == 2
+    assert list_spy.call_count == 2
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_iter_project_dependencies_shared_environment_cache(tmp_path, mocker, jobs):
+    project_dirs = [tmp_path / name for name in ["app-a", "app-b"]]
+    for project_dir in project_dirs:
+        project_dir.mkdir()
+        (project_dir / "environment.yml").write_text(ENVIRONMENT_YAML)
+    run_spy = mocker.spy(add_renovate_annotations, "run_command")
+
+    def load():
+        return dict(
+            iter_project_dependencies(
+                project_dirs,
+                environment_selector="-n shared",
+                cache_dir=tmp_path / "cache",
+                jobs=jobs,
+            )
+        )
+
+    load()
+    load()
+    assert run_spy.call_count == 2
+
+    # Changing the environment file of any project sharing the environment invalidates it
+    (project_dirs[1] / "environment.yml").write_text(ENVIRONMENT_YAML + "# A comment\n")
+    load()
+    assert run_spy.call_count == 4
+
+
+def test_environment_cache_key(tmp_path):
+    (tmp_path / "environment.yml").write_text(ENVIRONMENT_YAML)
+    (tmp_path / "README.md").write_text("Some docs")
+
+    key = environment_cache_key(tmp_path, "make setup", "-p ./env")
+    assert key == environment_cache_key(tmp_path, "make setup", "-p ./env")
+    assert key != environment_cache_key(tmp_path, None, "-p ./env")
+    assert key != environment_cache_key(tmp_path, "make setup", "-n name")
+
+    # Files which aren't environment inputs don't affect the key
+    (tmp_path / "README.md").write_text("Some other docs")
+    assert key == environment_cache_key(tmp_path, "make setup", "-p ./env")
+
+    (tmp_path / "Makefile").write_text("setup:\n\ttrue\n")
+    assert key != environment_cache_key(tmp_path, "make setup", "-p ./env")
+
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    (other_dir / "environment.yml").write_text(ENVIRONMENT_YAML)
+    key = environment_cache_key(
+        tmp_path, "make setup", "-n shared", shared_with=[other_dir]
+    )
+    (other_dir / "environment.yml").write_text(ENVIRONMENT_YAML + "# A comment\n")
+    assert key != environment_cache_key(
+        tmp_path, "make setup", "-n shared", shared_with=[other_dir]
+    )
+
+
+def make_conda_prefix(prefix: Path) -> None:
+    """Create a minimal conda prefix, with python installed from conda and click from pip."""
+    conda_meta = prefix / "conda-meta"
+    conda_meta.mkdir(parents=True)
+    site_packages = prefix / "lib" / "python3.10" / "site-packages"
+    site_packages.mkdir(parents=True)
+    (conda_meta / "history").write_text("")
+    (conda_meta / "python-3.10.14-hb885b13_1.json").write_text(
+        json.dumps(
+            {
+                "name": "python",
+                "version": "3.10.14",
+                "build": "hb885b13_1",
+                "build_number": 1,
+                "channel": "https://repo.anaconda.com/pkgs/main/osx-arm64",
+                "subdir": "osx-arm64",
+                "files": ["bin/python3.10"],
+            }
+        )
+    )
+    (conda_meta / "pyyaml-6.0.1-py310_0.json").write_text(
+        json.dumps(
+            {
+                "name": "pyyaml",
+                "version": "6.0.1",
+                "build": "py310_0",
+                "build_number": 0,
+                "channel": "https://conda.anaconda.org/conda-forge/noarch",
+                "subdir": "noarch",
+                "files": [
+                    "lib/python3.10/site-packages/PyYAML-6.0.1.dist-info/METADATA",
+                    "lib/python3.10/site-packages/yaml/__init__.py",
+                ],
+            }
+        )
+    )
+    for dist_info, name, version in [
+        ("PyYAML-6.0.1.dist-info", "PyYAML", "6.0.1"),
+        ("click-8.1.7.dist-info", "click", "8.1.7"),
+        ("Some_Package-1.0.dist-info", "Some_Package", "1.0"),
+    ]:
+        (site_packages / dist_info).mkdir()
+        (site_packages / dist_info / "METADATA").write_text(
+            f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n\nSome description\n"
+        )
+
+
+def test_load_dependencies_from_conda_meta(tmp_path, mocker):
+    make_conda_prefix(tmp_path / "env")
+    list_spy = mocker.spy(add_renovate_annotations, "run_command")
+
+    dependencies = load_dependencies(tmp_path, create_command=None)
+
+    assert list_spy.call_count == 0
+    assert dependencies == Dependencies(
+        pip={
+            "click": Dependency(name="click", channel="pypi", version="8.1.7"),
+            "some-package": Dependency(
+                name="some-package", channel="pypi", version="1.0"
+            ),
+        },
+        conda={
+            "python": Dependency(name="python", channel="main", version="3.10.14"),
+            "pyyaml": Dependency(name="pyyaml", channel="conda-forge", version="6.0.1"),
+        },
+    )
+
+
+def test_read_conda_meta_packages_without_channel(tmp_path):
+    make_conda_prefix(tmp_path / "env")
+    record_path = tmp_path / "env" / "conda-meta" / "pyyaml-6.0.1-py310_0.json"
+    record = json.loads(record_path.read_text())
+    del record["channel"]
+    record_path.write_text(json.dumps(record))
+
+    assert read_conda_meta_packages(tmp_path / "env") is None
+
+
+@pytest.mark.parametrize(
+    "environment_selector, expected",
+    [
+        ("-p ./env", "./env"),
+        ("--prefix /path/to/env", "/path/to/env"),
+        ("--prefix=/path/to/env", "/path/to/env"),
+        ("-n some-environment-name", None),
+        ("--name some-environment-name", None),
+    ],
+)
+def test_parse_prefix_selector(environment_selector, expected):
+    assert parse_prefix_selector(environment_selector) == expected
+
+
+@pytest.mark.parametrize("layout", ["no-conda-meta", "broken-record", "egg-link"])
+def test_load_dependencies_falls_back_to_conda_list(tmp_path, mocker, layout):
+    prefix = tmp_path / "env"
+    if layout != "no-conda-meta":
+        make_conda_prefix(prefix)
+    if layout == "broken-record":
+        (prefix / "conda-meta" / "broken-0.1-0.json").write_text("{")
+    elif layout == "egg-link":
+        site_packages = prefix / "lib" / "python3.10" / "site-packages"
+        (site_packages / "my-package.egg-link").write_text("/path/to/src")
+
+    list_spy = mocker.spy(add_renovate_annotations, "run_command")
+    dependencies = load_dependencies(tmp_path, create_command=None)
+
+    assert list_spy.call_count == 1
+    assert list_spy.call_args.args[0][:2] == ["conda", "list"]
+    # These come from the mocked subprocess
+    assert set(dependencies.conda) == {"python"}
+    assert set(dependencies.pip) == {"click"}
+
+
+def test_add_comments_to_env_file_changes(tmp_path):
+    env_file_path = tmp_path / "environment.yml"
+    env_file_path.write_text(ENVIRONMENT_YAML)
+
+    changes = add_comments_to_env_file(env_file_path, load_dependencies())
+
+    assert [c.package for c in changes] == [
+        "python",
+        "pytest",
+        "pip",
+        "private-package",
+        "fastapi",
+        "click",
+    ]
+    assert changes[0] == LineChange(
+        line_number=4,
+        package="python",
+        datasource="conda",
+        channel="main",
+        old_spec="python=3.10",
+        new_spec="python=3.10.14",
+        old_comment=None,
+        new_comment="# renovate: datasource=conda depName=main/python",
+    )
+    assert changes[1].old_comment == "# renovate: comment to be overridden"
+    assert changes[1].old_spec == changes[1].new_spec == "pytest"
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_add_comments_to_env_file_unchanged(tmp_path, mocker, streaming):
+    env_file_path = tmp_path / "environment.yml"
+    env_file_path.write_text(ENVIRONMENT_YAML)
+    add_comments_to_env_file(env_file_path, load_dependencies(), streaming=streaming)
+    contents = env_file_path.read_text()
+
+    # Running a second time doesn't change or rewrite the file
+    replace_spy = mocker.spy(add_renovate_annotations.os, "replace")
+    changes = add_comments_to_env_file(
+        env_file_path, load_dependencies(), streaming=streaming
+    )
+    assert changes == []
+    assert replace_spy.call_count == 0
+    assert env_file_path.read_text() == contents
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_add_comments_to_env_file_symlink(tmp_path, streaming):
+    target_path = tmp_path / "real.yml"
+    target_path.write_text(ENVIRONMENT_YAML)
+    env_file_path = tmp_path / "environment.yml"
+    env_file_path.symlink_to(target_path.name)
+
+    assert add_comments_to_env_file(
+        env_file_path, load_dependencies(), streaming=streaming
+    )
+
+    # The target is updated through the link, which is kept
+    assert env_file_path.is_symlink()
+    assert "# renovate:" in target_path.read_text()
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        ENVIRONMENT_YAML,
+        ENVIRONMENT_YAML.rstrip("\n"),
+        dedent("""\
+            dependencies:
+            # renovate: datasource=conda depName=main/python
+            - python
+            - pip:
+              # renovate: stale comment
+              - -e .
+              - click
+        """),
+        "name: no-dependencies\n",
+        "",
+    ],
+)
+@pytest.mark.parametrize("dry_run", [False, True])
+def test_add_comments_to_env_file_streaming(tmp_path, contents, dry_run):
+    dependencies = load_dependencies()
+    results = []
+    for streaming in [False, True]:
+        env_file_path = tmp_path / f"streaming-{streaming}" / "environment.yml"
+        env_file_path.parent.mkdir()
+        env_file_path.write_text(contents)
+        changes = add_comments_to_env_file(
+            env_file_path, dependencies, dry_run=dry_run, streaming=streaming
+        )
+        results.append((changes, env_file_path.read_text()))
+
+    # Both engines produce identical output
+    assert results[0] == results[1]
+
+
+def test_cli_check(tmp_path, capsys):
+    env_file_path = tmp_path / "environment.yml"
+    env_file_path.write_text(ENVIRONMENT_YAML)
+
+    with pytest.raises(typer.Exit) as exc_info:
+        cli(env_files=[env_file_path], check=True)
+    assert exc_info.value.exit_code == 1
+
+    # The file isn't modified, and the changes are reported instead
+    assert env_file_path.read_text() == ENVIRONMENT_YAML
+    report = json.loads(capsys.readouterr().out)
+    assert [r["path"] for r in report] == [str(env_file_path)]
+    python_change = report[0]["changes"][0]
+    assert python_change["package"] == "python"
+    assert python_change["channel"] == "main"
+    assert python_change["old_pin"] == "=3.10"
+    assert python_change["new_pin"] == "=3.10.14"
+
+    # Once annotated, the check passes
+    cli(env_files=[env_file_path])
+    cli(env_files=[env_file_path], check=True)
+    assert json.loads(capsys.readouterr().out) == []
+
+
+CONDA_LOCK_YAML = dedent("""\
+    version: 1
+    metadata:
+      platforms:
+      - osx-arm64
+    package:
+    - name: python
+      version: 3.10.14
+      manager: conda
+      platform: osx-arm64
+      url: https://repo.anaconda.com/pkgs/main/osx-arm64/python-3.10.14-hb885b13_1.conda
+    - name: click
+      version: 8.1.7
+      manager: pip
+      platform: osx-arm64
+      url: https://files.pythonhosted.org/packages/00/2e/click-8.1.7-py3-none-any.whl
+""")
+
+EXPLICIT_TXT = dedent("""\
+    # platform: osx-arm64
+    @EXPLICIT
+    https://repo.anaconda.com/pkgs/main/osx-arm64/python-3.10.14-hb885b13_1.conda#abc123
+""")
+
+ENV_EXPORT_JSON = json.dumps(
+    {
+        "name": "some-environment-name",
+        "channels": ["defaults"],
+        "dependencies": [
+            "python=3.10.14=hb885b13_1",
+            {"pip": ["click==8.1.7", "-e ."]},
+        ],
+    }
+)
+
+
+@pytest.mark.parametrize(
+    "lockfile, contents, has_pip",
+    [
+        ("conda-lock.yml", CONDA_LOCK_YAML, True),
+        ("explicit.txt", EXPLICIT_TXT, False),
+        ("environment.json", ENV_EXPORT_JSON, True),
+    ],
+)
+def test_load_lockfile_dependencies(tmp_path, mocker, lockfile, contents, has_pip):
+    (tmp_path / lockfile).write_text(contents)
+    run_spy = mocker.spy(add_renovate_annotations, "run_command")
+
+    dependencies = load_lockfile_dependencies(tmp_path, lockfile)
+
+    assert run_spy.call_count == 0
+    assert dependencies == Dependencies(
+        pip=(
+            {"click": Dependency(name="click", channel="pypi", version="8.1.7")}
+            if has_pip
+            else {}
+        ),
+        conda={"python": Dependency(name="python", channel="main", version="3.10.14")},
+    )
+
+
+def test_cli_lockfile(tmp_path, mocker):
+    env_file_path = tmp_path / "environment.yml"
+    env_file_path.write_text(ENVIRONMENT_YAML)
+    (tmp_path / "conda-lock.yml").write_text(CONDA_LOCK_YAML)
+    run_spy = mocker.spy(add_renovate_annotations, "run_command")
+
+    cli(env_files=[env_file_path], lockfile="conda-lock.yml")
+
+    assert run_spy.call_count == 0
+    contents = env_file_path.read_text()
+    assert "- python=3.10.14" in contents
+    assert "- click[extras]==8.1.7" in contents
+
+
+def test_cli_timings(tmp_path, capsys):
+    env_file_paths = []
+    for name in ["app-a", "app-b"]:
+        env_file_path = tmp_path / name / "environment.yml"
+        env_file_path.parent.mkdir()
+        env_file_path.write_text(ENVIRONMENT_YAML)
+        env_file_paths.append(env_file_path)
+    trace_file = tmp_path / "trace.json"
+
+    cli(env_files=env_file_paths, jobs=2, trace_file=trace_file)
+
+    table = capsys.readouterr().err.splitlines()
+    assert table[0].split() == [
+        "Project",
+        "setup_conda_environment",
+        "list_packages_in_conda_environment",
+        "parse_dependencies",
+        "add_comments_to_env_file",
+        "total",
+    ]
+    assert [row.split()[0] for row in table[2:]] == [
+        str(tmp_path / "app-a"),
+        str(tmp_path / "app-b"),
+        "TOTAL",
+    ]
+
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert len(events) == 8
+    assert {e["args"]["project"] for e in events} == {
+        str(tmp_path / "app-a"),
+        str(tmp_path / "app-b"),
+    }
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+
+
+def test_cli_timings_env_var(tmp_path, monkeypatch):
+    env_file_path = tmp_path / "environment.yml"
+    env_file_path.write_text(ENVIRONMENT_YAML)
+    monkeypatch.setenv(add_renovate_annotations.TIMINGS_ENV_VAR, "1")
+
+    result = CliRunner().invoke(add_renovate_annotations.app, [str(env_file_path)])
+
+    assert result.exit_code == 0
+    assert "setup_conda_environment" in result.output
+
+
+@pytest.mark.parametrize("use_executor", [False, True])
+def test_annotate_env_files(tmp_path, mocker, use_executor):
+    env_file_paths = [
+        tmp_path / "app-b" / "environment.yml",
+        tmp_path / "app-a" / "environment.yml",
+        tmp_path / "app-a" / "environment-dev.yml",
+    ]
+    for env_file_path in env_file_paths:
+        env_file_path.parent.mkdir(exist_ok=True)
+        env_file_path.write_text(ENVIRONMENT_YAML)
+    run_spy = mocker.spy(add_renovate_annotations, "run_command")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = annotate_env_files(
+            env_file_paths,
+            environment_selector="-n shared",
+            executor=executor if use_executor else None,
+        )
+
+    # The shared environment is only set up and listed once
+    assert run_spy.call_count == 2
+    assert [r.path for r in results] == env_file_paths
+    assert all(r.changed for r in results)
+    assert results[0].content == results[1].content == results[2].content
+    assert "- python=3.10.14\n" in results[0].content
+    assert results[0].changes[0].package == "python"
+    # Files aren't modified by default
+    for env_file_path in env_file_paths:
+        assert env_file_path.read_text() == ENVIRONMENT_YAML
+
+
+def test_annotate_env_files_process_pool(tmp_path):
+    env_file_paths = []
+    for name in ["app-a", "app-b"]:
+        env_file_path = tmp_path / name / "environment.yml"
+        env_file_path.parent.mkdir()
+        env_file_path.write_text(ENVIRONMENT_YAML)
+        (env_file_path.parent / "conda-lock.yml").write_text(CONDA_LOCK_YAML)
+        env_file_paths.append(env_file_path)
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = annotate_env_files(
+            env_file_paths, lockfile="conda-lock.yml", write=True, executor=executor
+        )
+
+    for result, env_file_path in zip(results, env_file_paths):
+        assert result.changed
+        assert env_file_path.read_text() == result.content
+        assert "- click[extras]==8.1.7" in result.content
+
+
+@pytest.fixture()
+def indexed_dependencies():
+    return Dependencies(
+        pip=[
+            Dependency(name="zope.interface", channel="pypi", version="6.2"),
+            Dependency(name="typing_extensions", channel="pypi", version="4.11.0"),
+        ],
+        conda=[
+            Dependency(name="ruamel.yaml", channel="main", version="0.17.21"),
+            Dependency(name="typing_extensions", channel="main", version="4.11.0"),
+            Dependency(name="typing-extensions", channel="main", version="4.11.0"),
+            Dependency(name="pyyaml", channel="conda-forge", version="6.0.1"),
+        ],
+    )
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("zope.interface", "zope.interface"),
+        ("Zope_Interface", "zope.interface"),
+        ("zope-interface[test]", "zope.interface"),
+        ("typing.extensions", "typing_extensions"),
+        ("ruamel", None),
+    ],
+)
+def test_dependencies_find_pip(indexed_dependencies, name, expected):
+    dependency = indexed_dependencies.find_pip(name)
+    assert (dependency.name if dependency else None) == expected
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("ruamel.yaml", "ruamel.yaml"),
+        # Separators are significant in conda names
+        ("ruamel-yaml", None),
+        ("typing_extensions", "typing_extensions"),
+        ("typing-extensions", "typing-extensions"),
+        ("PyYAML", "pyyaml"),
+        ("zope.interface", None),
+    ],
+)
+def test_dependencies_find_conda(indexed_dependencies, name, expected):
+    dependency = indexed_dependencies.find_conda(name)
+    assert (dependency.name if dependency else None) == expected
+
+
+def test_dependencies_in_channel(indexed_dependencies):
+    assert [d.name for d in indexed_dependencies.in_channel("conda-forge")] == [
+        "pyyaml"
+    ]
+    assert len(indexed_dependencies.in_channel("pypi")) == 2
+    assert indexed_dependencies.in_channel("missing") == []
+
+
+def test_dependencies_serialization(indexed_dependencies):
+    text = indexed_dependencies.to_json()
+    assert Dependencies.from_json(text) == indexed_dependencies
+    assert pickle.loads(pickle.dumps(indexed_dependencies)) == indexed_dependencies
+
+    # Cache files written by older versions are rejected
+    with pytest.raises(ValueError):
+        Dependencies.from_json(json.dumps([{"name": "python"}]))
+    with pytest.raises(ValueError):
+        Dependencies.from_json(json.dumps({"version": 1, "pip": [["click"]]}))
+
+
+def test_annotate_env_lines_normalized_names(indexed_dependencies):
+    in_lines = [
+        "dependencies:\n",
+        "- ruamel.yaml\n",
+        "- pip:\n",
+        "  - Zope.Interface>=6\n",
+    ]
+
+    out_lines, changes = annotate_env_lines(in_lines, indexed_dependencies)
+
+    assert [c.package for c in changes] == ["ruamel.yaml", "zope.interface"]
+    assert out_lines == [
+        "dependencies:\n",
+        "# renovate: datasource=conda depName=main/ruamel.yaml\n",
+        "- ruamel.yaml=0.17.21\n",
+        "- pip:\n",
+        "  # renovate: datasource=pypi\n",
+        "  - zope.interface==6.2\n",
+    ]
+
+
+def test_annotate_env_lines_conda_underscore_names(indexed_dependencies):
+    in_lines = [
+        "dependencies:\n",
+        "- typing_extensions\n",
+        "- python_abi=3.10\n",
+        "- ruamel-yaml>=0.1\n",
+    ]
+
+    out_lines, _ = annotate_env_lines(in_lines, indexed_dependencies)
+
+    # Conda names are matched as written, and never rewritten to another package
+    assert out_lines == [
+        "dependencies:\n",
+        "# renovate: datasource=conda depName=main/typing_extensions\n",
+        "- typing_extensions=4.11.0\n",
+        "# renovate: datasource=conda depName=main/python_abi\n",
+        "- python_abi=3.10\n",
+        "# renovate: datasource=conda depName=main/ruamel-yaml\n",
+        "- ruamel-yaml>=0.1\n",
+    ]
@@ -0,0 +1,261 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from textwrap import dedent
+
+import pytest
+
+from anaconda_pre_commit_hooks.run_cog import (
+    CogCache,
+    group_by_working_directory,
+    has_cog_markers,
+    main,
+    run_cog,
+)
+
+COG_FILE = dedent("""\
+    <!-- [[[cog
+    import os, cog
+    cog.outl(os.path.basename(os.getcwd()))
+    ]]] -->
+    <!-- [[[end]]] -->
+""")
+
+FAILING_COG_FILE = dedent("""\
+    <!-- [[[cog
+    raise RuntimeError("Something went wrong")
+    ]]] -->
+    <!-- [[[end]]] -->
+""")
+
+
+@pytest.fixture()
+def cog_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    paths = []
+    for name in [
+        "project-a/README.md",
+        "project-a/docs/index.md",
+        "project-b/README.md",
+    ]:
+        path = Path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(COG_FILE)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize(
+    "working_directory_level, expected_groups",
+    [
+        (
+            0,
+            [["project-a/README.md", "project-a/docs/index.md", "project-b/README.md"]],
+        ),
+        (
+            1,
+            [
+                ["project-a/README.md", "project-a/docs/index.md"],
+                ["project-b/README.md"],
+            ],
+        ),
+        (
+            -1,
+            [
+                ["project-a/README.md"],
+                ["project-a/docs/index.md"],
+                ["project-b/README.md"],
+            ],
+        ),
+    ],
+)
+def test_group_by_working_directory(
+    cog_files, working_directory_level, expected_groups
+):
+    groups = group_by_working_directory(
+        [p.as_posix() for p in cog_files], working_directory_level
+    )
+    assert [[p.as_posix() for p in g] for g in groups.values()] == expected_groups
+
+
+@pytest.mark.parametrize("in_process, expected_subprocesses", [(False, 2), (True, 0)])
+def test_run_cog_batches_by_working_directory(
+    cog_files, mocker, in_process, expected_subprocesses
+):
+    run_spy = mocker.spy(subprocess, "run")
+
+    assert run_cog([p.as_posix() for p in cog_files], 1, in_process=in_process) == 0
+
+    assert run_spy.call_count == expected_subprocesses
+    assert Path.cwd() == cog_files[0].parent.resolve().parent
+    assert "project-a" in cog_files[0].read_text()
+    assert "project-a" in cog_files[1].read_text()
+    assert "project-b" in cog_files[2].read_text()
+
+
+@pytest.mark.parametrize("args", [[], ["--in-process"]])
+def test_run_cog_reports_failing_file(cog_files, capsys, args):
+    cog_files[1].write_text(FAILING_COG_FILE)
+
+    return_code = main(["--working-directory-level", "1", *args, *map(str, cog_files)])
+
+    assert return_code != 0
+    assert f"cog failed on {cog_files[1]}" in capsys.readouterr().out
+    # The first file was processed, but processing stopped at the failure
+    assert "project-a" in cog_files[0].read_text()
+    assert cog_files[2].read_text() == COG_FILE
+
+
+def test_run_cog_in_process_shares_imports(cog_files, tmp_path, monkeypatch):
+    (tmp_path / "counter.py").write_text("count = 0\n")
+    for path in cog_files:
+        path.write_text(
+            dedent(f"""\
+                <!-- [[[cog
+                import sys; sys.path.insert(0, {str(tmp_path)!r})
+                import cog, counter
+                counter.count += 1
+                cog.outl(f"count={{counter.count}}")
+                ]]] -->
+                <!-- [[[end]]] -->
+            """)
+        )
+
+    monkeypatch.delitem(sys.modules, "counter", raising=False)
+    assert main(["--in-process", *map(str, cog_files)]) == 0
+    # The module was only imported once, so the count is incremented across files
+    for i, path in enumerate(cog_files, start=1):
+        assert f"\ncount={i}\n" in path.read_text()
+    monkeypatch.delitem(sys.modules, "counter")
+
+
+def test_run_cog_isolated_env_var(cog_files, mocker, monkeypatch):
+    monkeypatch.setenv("RUN_COG_ISOLATED", "1")
+    run_spy = mocker.spy(subprocess, "run")
+
+    assert main(["--in-process", *map(str, cog_files)]) == 0
+    assert run_spy.call_count == 1
+
+
+@pytest.mark.parametrize("in_process", [False, True])
+def test_run_cog_jobs(cog_files, capsys, in_process):
+    cog_files[2].write_text(FAILING_COG_FILE)
+    filenames = [p.as_posix() for p in cog_files]
+
+    return_code = run_cog(filenames, 0, in_process=in_process, jobs=3)
+
+    # Outputs are printed in order, and the return code comes from the failing file
+    assert return_code != 0
+    output = capsys.readouterr().out
+    assert output.index(filenames[0]) < output.index(filenames[1])
+    assert f"cog failed on {cog_files[2]}" in output
+    for path in cog_files[:2]:
+        assert f"\n{Path.cwd().name}\n" in path.read_text()
+
+
+def test_run_cog_cache(cog_files, tmp_path, mocker, capsys):
+    dependency = tmp_path / "dependency.txt"
+    dependency.write_text("v1")
+    args = [
+        "--cache-dir",
+        str(tmp_path / "cache"),
+        "--cache-dependency",
+        str(tmp_path / "*.txt"),
+        *map(str, cog_files),
+    ]
+    run_spy = mocker.spy(subprocess, "run")
+
+    assert main(args) == 0
+    assert run_spy.call_count == 1
+    expected_contents = [p.read_text() for p in cog_files]
+
+    # Both the original and the generated contents are cached
+    for path in cog_files:
+        path.write_text(COG_FILE)
+    assert main(args) == 0
+    assert main(args) == 0
+    assert run_spy.call_count == 1
+    assert [p.read_text() for p in cog_files] == expected_contents
+    assert "Restored the output of 3 file(s)" in capsys.readouterr().out
+
+    # Changing a dependency invalidates the cache
+    dependency.write_text("v2")
+    assert main(args) == 0
+    assert run_spy.call_count == 2
+
+
+def test_run_cog_skips_files_without_markers(cog_files, mocker, capsys):
+    plain_file = Path("project-a/CHANGELOG.md")
+    plain_file.write_text("No markers here\n")
+    empty_file = Path("project-b/empty.md")
+    empty_file.touch()
+    run_spy = mocker.spy(subprocess, "run")
+
+    assert (
+        main(["--working-directory-level", "1", str(plain_file), str(empty_file)]) == 0
+    )
+    assert run_spy.call_count == 0
+    assert "Skipped 2 file(s) without cog markers" in capsys.readouterr().out
+
+    assert (
+        main(["--working-directory-level", "1", *map(str, cog_files), str(plain_file)])
+        == 0
+    )
+    assert run_spy.call_count == 2
+    assert "project-a" in cog_files[0].read_text()
+    assert plain_file.read_text() == "No markers here\n"
+
+
+def test_run_cog_custom_markers(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    custom_file = tmp_path / "custom.md"
+    custom_file.write_text(COG_FILE.replace("[[[", "{{{").replace("]]]", "}}}"))
+    default_file = tmp_path / "default.md"
+    default_file.write_text(COG_FILE)
+    args = ["--markers", "{{{cog }}} {{{end}}}", str(custom_file), str(default_file)]
+
+    assert main(args) == 0
+    assert "Skipped 1 file(s) without cog markers" in capsys.readouterr().out
+    assert f"\n{tmp_path.name}\n" in custom_file.read_text()
+    assert default_file.read_text() == COG_FILE
+
+
+def test_run_cog_invalid_markers(cog_files):
+    with pytest.raises(SystemExit):
+        main(["--markers", "{{{cog }}}", *map(str, cog_files)])
+
+
+def test_has_cog_markers(tmp_path):
+    markers = [b"[[[cog", b"]]]", b"[[[end]]]"]
+    path = tmp_path / "file.md"
+
+    path.write_bytes(b"Text\n" * 10_000)
+    assert not has_cog_markers(path, markers)
+    # A stray end marker is an error, which cog has to report
+    path.write_bytes(b"Text\n" * 10_000 + b"<!-- [[[end]]] -->\n")
+    assert has_cog_markers(path, markers)
+    # Files which can't be read are passed on to cog too
+    assert has_cog_markers(tmp_path / "missing.md", markers)
+
+
+def test_cog_cache_evict(tmp_path):
+    cache = CogCache(tmp_path, max_size=9, max_age=60)
+    for i, key in enumerate(["old", "stale", "recent"]):
+        cache.put(key, b"12345")
+        os.utime(tmp_path / key, (time.time() - [120, 30, 0][i],) * 2)
+
+    cache.evict()
+
+    # "old" is too old, and "stale" is evicted to bring the size under the limit
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["recent"]
+    assert cache.get("recent") == b"12345"
+    assert cache.get("old") is None
+
+
+def test_run_cog_without_files(mocker):
+    run_spy = mocker.spy(subprocess, "run")
+
+    assert main(["--working-directory-level", "1"]) == 0
+    assert run_spy.call_count == 0